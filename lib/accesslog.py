@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from flask import g
+
+# records waiting to be written; further records are dropped while full
+QUEUE_SIZE = 4096
+
+# records written per write call at most
+BATCH_SIZE = 256
+
+@contextmanager
+def timed(stage):
+    '''
+    Add time spent in the block to :stage: of the request's timings, if the
+    request is being logged
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = g.get('stages')
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0) + time.perf_counter() - start
+
+class AccessLog:
+    def __init__(self, path):
+        '''
+        JSONL log of requests at :path:, written by a background thread so
+        requests never wait for log I/O; records are dropped if it falls
+        behind, or for good if the log can't be opened
+        '''
+        self._path = path
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self._stats = {
+            'logged':   0,
+            'dropped':  0,
+            'error':    None
+        }
+
+    def log(self, record):
+        '''
+        Queue :record: (JSON-serializable dict) for writing
+        '''
+        with self._lock:
+            # the writer gave up on the log
+            if self._stats['error']:
+                self._stats['dropped'] += 1
+                return
+            # writer of this process, started by its first record
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            try:
+                self._queue.put_nowait(record)
+            except queue.Full:
+                self._stats['dropped'] += 1
+
+    def stats(self):
+        '''
+        Return dict of records written, dropped and pending, with the error
+        disabling the log if any
+        '''
+        with self._lock:
+            ret = dict(self._stats)
+        ret['pending'] = self._queue.qsize()
+
+        return ret
+
+    def _run(self):
+        '''
+        Write queued records, batching those queued meanwhile
+        '''
+        # one append per batch, processes sharing the log don't interleave
+        # within a line
+        try:
+            fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o644)
+        except OSError as e:
+            self._disable(e)
+            return
+        while True:
+            records = [self._queue.get()]
+            while len(records) < BATCH_SIZE:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                os.write(fd, ''.join(json.dumps(x) + '\n'
+                                     for x in records).encode())
+            except OSError:
+                # e.g. disk full, later writes may succeed
+                with self._lock:
+                    self._stats['dropped'] += len(records)
+                continue
+            with self._lock:
+                self._stats['logged'] += len(records)
+
+    def _disable(self, error):
+        '''
+        Stop logging after :error: opening the log, dropping queued and further
+        records; reported once, instead of by a writer started for each record
+        '''
+        now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        print('%s access log disabled: %s' % (now, error))
+        with self._lock:
+            self._stats['error'] = '%s: %s' % (type(error).__name__, error)
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._stats['dropped'] += 1
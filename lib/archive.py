@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import struct
+import tarfile
+import zipfile
+
+# archives scanned for books, members must be stored uncompressed
+ARCHIVE_EXTENSIONS = ('.tar', '.zip')
+
+# zip local file header: signature ... file name length, extra field length
+ZIP_LOCAL_HEADER = struct.Struct('<4s22xHH')
+
+class FileSlice(io.RawIOBase):
+    def __init__(self, path, offset, size):
+        '''
+        Read-only file object over :size: bytes at :offset: of file at :path:,
+        e.g. a member stored in an archive
+
+        Reads don't move a shared file position (pread), wrap in
+        io.BufferedReader for buffered reads
+        '''
+        self._fd = os.open(path, os.O_RDONLY)
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        return self._fd
+
+    def readinto(self, b):
+        n = max(min(len(b), self._size - self._pos), 0)
+        data = os.pread(self._fd, n, self._offset + self._pos)
+        b[:len(data)] = data
+        self._pos += len(data)
+
+        return len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError('negative seek position %d' % offset)
+        self._pos = offset
+
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+def is_archive(path):
+    '''
+    Return True if :path: has a supported archive extension
+    '''
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def get_members(path):
+    '''
+    Return list of (name, offset, size) of regular files stored uncompressed
+    in archive at :path:; compressed or encrypted members are left out
+
+    Offsets are of the member's data within the archive file
+    '''
+    ret = []
+    if path.lower().endswith('.zip'):
+        with open(path, 'rb') as f, zipfile.ZipFile(f) as z:
+            for info in z.infolist():
+                if (info.is_dir() or info.compress_type != zipfile.ZIP_STORED
+                        or info.flag_bits & 0x1):
+                    continue
+                # data follows the local header, whose extra field may differ
+                # from the one in the central directory
+                f.seek(info.header_offset)
+                header = f.read(ZIP_LOCAL_HEADER.size)
+                sig, name_len, extra_len = ZIP_LOCAL_HEADER.unpack(header)
+                if sig != b'PK\x03\x04':
+                    continue
+                offset = (info.header_offset + ZIP_LOCAL_HEADER.size +
+                          name_len + extra_len)
+                ret.append((info.filename, offset, info.file_size))
+    else:
+        # 'r:' refuses compressed tars, their members can't be served as is
+        with tarfile.open(path, 'r:') as t:
+            for info in t:
+                if info.isreg() and not info.issparse():
+                    ret.append((info.name, info.offset_data, info.size))
+
+    return ret
@@ -2,37 +2,193 @@
 
 import datetime
 import hashlib
+import io
 import json
 import math
 import os
+import signal
+import tarfile
+import threading
+import time
+import zipfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from flask import Flask
-from lib.tinytag import TinyTag
+from lib.archive import FileSlice, get_members, is_archive
+from lib.throttle import ThrottledReader
+from lib.tinytag import ID3, TinyTag
+from lib.util import (CACHE_VERSION, cache_generation, get_shard_path,
+                      index_entry, read_book, upgrade_cache, write_json)
 
 ABS_PATH = os.path.dirname(os.path.abspath(__file__))
 CACHE_PATH = os.path.join(ABS_PATH, '../', 'cache')
 JSON_PATH = os.path.join(CACHE_PATH, 'audiobooks.json')
+SHARDS_PATH = os.path.dirname(get_shard_path(JSON_PATH, ''))
+FINGERPRINTS_PATH = os.path.join(CACHE_PATH, 'fingerprints.json')
+DURATIONS_PATH = os.path.join(CACHE_PATH, 'durations.json')
+COVERS_PATH = os.path.join(CACHE_PATH, 'covers')
+JOURNAL_PATH = os.path.join(CACHE_PATH, 'scan.journal')
+VERIFY_PATH = os.path.join(CACHE_PATH, 'verify.json')
+SCAN_PATH = os.path.join(CACHE_PATH, 'scan.json')
+
+# cover art formats served, by file signature
+COVER_TYPES = ((b'\xff\xd8\xff', 'jpg'), (b'\x89PNG\r\n\x1a\n', 'png'))
+
+# sampled fingerprints hash the file size, its head (ID3 header) and blocks at
+# fixed fractions of the file instead of every byte
+FINGERPRINT_HEAD = 64 * 1024
+FINGERPRINT_BLOCK = 16 * 1024
+FINGERPRINT_SAMPLES = 8
+
+# read size used when hashing tracks in full
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# tags used for track attributes, other tags and cover art aren't read
+TAG_FIELDS = ('album', 'artist', 'title', 'track')
+
+# threads parsing the tracks of a book
+TAG_WORKERS = 4
+
+# version of durations counted by the frame walk; durations stored by an older
+# walk (which mis-measured MPEG-2/2.5 tracks) are counted again
+DURATIONS_VERSION = 2
+
+# supported track extensions; m4b seems to be unsupported by Apple
+TRACK_EXTENSIONS = ('mp3',)
+
+# minimum seconds between scan progress reports
+PROGRESS_INTERVAL = 10
+
+# tracks with ID3 chapters or longer than CHAPTER_LENGTH seconds are split into
+# virtual chapters, 0 disables
+CHAPTER_LENGTH = 0
 
 class Books:
-    def __init__(self):
+    def __init__(self, config=None, throttle=None):
         '''
         Book-related handlers (r/w cache) and track discovery
+
+        :config: app config; FINGERPRINT enables sampled fingerprints in place
+                 of full-file MD5 hashes as book/track keys, HASH_BUFFER_SIZE
+                 and HASH_DROP_CACHE tune reads of full-file hashing,
+                 EXACT_DURATION counts every MP3 frame instead of estimating
+                 duration, TAG_WORKERS sets threads parsing tags,
+                 CHAPTER_LENGTH splits long tracks into virtual chapters,
+                 COVERS extracts cover art
+        :throttle: optional TokenBucket limiting bytes read per second by
+                   hashing, fingerprinting and parsing (tags, cover art, exact
+                   durations and chapter splitting)
         '''
+        self._config = config or {}
+        self._throttle = throttle
+        self._use_fingerprint = self._config.get('FINGERPRINT', False)
+        self._drop_cache = self._config.get('HASH_DROP_CACHE', True)
+        self._exact_duration = self._config.get('EXACT_DURATION', False)
+        self._chapter_length = self._config.get('CHAPTER_LENGTH', CHAPTER_LENGTH)
+        self._covers = self._config.get('COVERS', False)
+
+        # reused by every full-file hash of a scan thread
+        self._hash_buffer_size = self._config.get('HASH_BUFFER_SIZE',
+                                                  HASH_BUFFER_SIZE)
+        self._local = threading.local()
+
+        # filesystem calls made by a scan (directory listings, stats, opens),
+        # reported when it completes
+        self._fs_calls = Counter()
+        self._fs_lock = threading.Lock()
+
+        # books completed by the current scan are appended to the journal, an
+        # interrupted scan resumes from it; set to stop a scan between books
+        self._journal = None
+        self._journal_lock = threading.Lock()
+        self._journaled = dict()
+        self._stop = threading.Event()
+
+        # bytes to scan by book path, done and total books/bytes of a scan
+        self._planned = dict()
+        self._progress = Counter()
+        self._progress_lock = threading.Lock()
+
         if os.path.exists(JSON_PATH):
             self._cache = self._read_cache()
         else:
             self._cache = {}
 
+        # books whose shard must be (re)written by write_cache
+        self._shards = {}
+
+        # fingerprint: MD5 key of tracks/books hashed in full, keeps existing
+        # keys (feed URLs, app listening history) stable in fingerprint mode
+        self._fingerprints = self._read_json(FINGERPRINTS_PATH)
+        self._fingerprints_changed = False
+
+        # fingerprint: exact duration, counting frames is only done once per
+        # track even if its book is rescanned
+        durations = self._read_json(DURATIONS_PATH)
+        if durations.get('version') == DURATIONS_VERSION:
+            self._durations = durations['durations']
+        else:
+            self._durations = {}
+        self._durations_changed = False
+
+    def _count(self, call, n=1):
+        '''
+        Record :n: filesystem :call: (scandir, stat, open) made by the scan
+        '''
+        with self._fs_lock:
+            self._fs_calls[call] += n
+
     def _get_dirs(self, path):
         '''
-        Return list of directories recursively discovered in :path:
+        Return dict of directories and archives recursively discovered in
+        :path:, e.g. nested Author/Series/Book layouts
+
+        '/home/user/audiobooks/book': (device, [os.DirEntry of each file])
+
+        Archives have no file list
         '''
-        s = os.scandir(path)
-        ret = [x.path for x in s if not x.name.startswith('.') and x.is_dir()]
-        s.close()
+        ret = dict()
+        self._count('stat')
+        st = os.stat(path)
+        self._walk(path, st.st_dev, ret, {(st.st_dev, st.st_ino)})
 
         return ret
 
+    def _walk(self, path, dev, ret, seen):
+        '''
+        List directory :path: on device :dev:, adding directories and archives
+        below it to :ret: (see _get_dirs); return os.DirEntry of its files
+
+        Each directory is listed once and file types come from the listing;
+        entries are passed on so each track is stat'ed once, for its size.
+        Symlinked directories are followed unless already walked (:seen:
+        (device, inode) pairs), so links back to a parent aren't looped over
+        '''
+        self._count('scandir')
+        with os.scandir(path) as s:
+            entries = [x for x in s if not x.name.startswith('.')]
+
+        files = []
+        for x in entries:
+            if x.is_dir():
+                # stat'ed once per directory, mounts may be nested
+                self._count('stat')
+                st = x.stat()
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+                ret[x.path] = None # parent listed before its children
+                ret[x.path] = (st.st_dev, self._walk(x.path, st.st_dev, ret,
+                                                     seen))
+            elif x.is_file():
+                if is_archive(x.name):
+                    ret[x.path] = (dev, None)
+                else:
+                    files.append(x)
+
+        return files
+
     def _get_path_hash_dict(self):
         '''
         Return dict of book paths and their hash from cache, used to check paths
@@ -42,29 +198,449 @@ class Books:
         '''
         ret = {}
         for k, _ in self._cache.items():
-            path = self._cache[k]['path']
-            if os.path.exists(path):
-                ret[path] = k
+            # only consulted for discovered paths, which exist
+            ret[self._cache[k]['path']] = k
 
         return ret
 
     def write_cache(self):
         '''
-        Dump contents of :books: to :json_path:
+        Dump index of :books: to :json_path: and write shards of new or changed
+        books; shards of books no longer present are removed
+
+        The index is only rewritten if books changed, as each write starts a
+        new cache generation; completion of the scan is recorded in SCAN_PATH
         '''
-        if not os.path.exists(CACHE_PATH):
-            os.mkdir(CACHE_PATH)
-        with open(JSON_PATH, 'w') as cache:
-            json.dump(self.books, cache, indent=4)
+        changed = bool(self._shards) or self.books != self._cache
+        os.makedirs(SHARDS_PATH, exist_ok=True)
+        for b_key, book in self._shards.items():
+            write_json(get_shard_path(JSON_PATH, b_key), book)
+        self._shards = {}
+
+        if self._fingerprints_changed:
+            write_json(FINGERPRINTS_PATH, self._fingerprints)
+            self._fingerprints_changed = False
+        if self._durations_changed:
+            write_json(DURATIONS_PATH, {'version': DURATIONS_VERSION,
+                                        'durations': self._durations})
+            self._durations_changed = False
+
+        # index is written last so it never references a missing shard
+        if changed or not os.path.exists(JSON_PATH):
+            write_json(JSON_PATH, {'version': CACHE_VERSION, 'books': self.books})
+            self._cache = self.books
+        write_json(SCAN_PATH, {'time': int(time.time()),
+                               'books': len(self.books), 'changed': changed})
+
+        # scanned books are in the index now
+        if os.path.exists(JOURNAL_PATH):
+            os.remove(JOURNAL_PATH)
+
+        for f in os.listdir(SHARDS_PATH):
+            if f.endswith('.json') and f[:-len('.json')] not in self.books:
+                os.remove(os.path.join(SHARDS_PATH, f))
+
+        # covers are shared between books with the same art
+        if os.path.isdir(COVERS_PATH):
+            covers = set(x.get('cover') for x in self.books.values())
+            for f in os.listdir(COVERS_PATH):
+                if f not in covers:
+                    os.remove(os.path.join(COVERS_PATH, f))
+
+    def verify(self, nbytes=None):
+        '''
+        Re-read tracks of cached books and check them against their keys, least
+        recently verified first, until :nbytes: bytes were read (every track if
+        None); repeated calls cover the library round-robin
+
+        Last verification time of each track, tracks failing verification and
+        the start and completion time of passes over every track are kept in
+        VERIFY_PATH. Return dict of 'book/track' key: failure (path, status,
+        time) of tracks currently failing
+        '''
+        state = self._read_json(VERIFY_PATH)
+        # a pass is complete once every track was verified since it started
+        pass_start = state.get('pass_start')
+        completed = state.get('completed')
+        if pass_start is None or (completed or 0) >= pass_start:
+            pass_start = time.time()
+        tracks = dict()
+        for b_key in self._cache:
+            book = read_book(JSON_PATH, b_key)
+            if not book:
+                continue
+            for f_key, track in book['files'].items():
+                tracks['%s/%s' % (b_key, f_key)] = track
+
+        # tracks no longer cached are forgotten
+        verified = {k: v for k, v in state.get('verified', {}).items()
+                    if k in tracks}
+        failures = {k: v for k, v in state.get('failures', {}).items()
+                    if k in tracks}
+
+        count = 0
+        spent = 0
+        try:
+            # never verified first, ties in index order
+            for key in sorted(tracks, key=lambda x: verified.get(x, 0)):
+                if nbytes is not None and spent >= nbytes:
+                    break
+                track = tracks[key]
+                status, nread = self._verify_track(key.split('/')[1], track)
+                now = time.time()
+                verified[key] = now
+                count += 1
+                spent += nread
+                if status:
+                    if failures.get(key, {}).get('status') != status:
+                        self._log('%s: %s' % (track['path'], status))
+                    failures[key] = {'path': track['path'], 'status': status,
+                                     'time': int(now)}
+                else:
+                    failures.pop(key, None)
+        finally:
+            if all(verified.get(x, 0) >= pass_start for x in tracks):
+                completed = time.time()
+            write_json(VERIFY_PATH, {'verified': verified, 'failures': failures,
+                                     'pass_start': pass_start,
+                                     'completed': completed})
+            self._log('verify: %d tracks, %.1f MB, %d failing' %
+                      (count, spent / 1e6, len(failures)))
+
+        return failures
+
+    def _verify_track(self, f_key, track):
+        '''
+        Return (status, bytes read) of :track:, status is None if it still
+        matches its key :f_key:, else 'missing', 'unreadable' or 'corrupt'
+
+        Tracks keyed by their fingerprint are checked against it, others are
+        hashed in full
+        '''
+        path, offset, size = track['path'], track.get('offset'), track['size_bytes']
+        try:
+            if offset is None and os.stat(path).st_size != size:
+                return ('corrupt', 0)
+            if f_key == track.get('fingerprint'):
+                digest = self._fingerprint(path, size, offset)
+                nread = min(size, FINGERPRINT_HEAD +
+                            (FINGERPRINT_SAMPLES + 1) * FINGERPRINT_BLOCK)
+            else:
+                file_hash = hashlib.md5()
+                # tracks being served may be among those verified, keep
+                # them cached
+                self._hash_file(path, (file_hash,), offset, size,
+                                drop_cache=False)
+                digest = file_hash.hexdigest()
+                nread = size
+        except FileNotFoundError:
+            return ('missing', 0)
+        except OSError:
+            return ('unreadable', 0)
+
+        return (None if digest == f_key else 'corrupt', nread)
 
     def _read_cache(self):
         '''
-        Return dict of existing cache
+        Return dict of existing cache index, upgraded in place if written by an
+        older version
         '''
+        generation = cache_generation(JSON_PATH)
         with open(JSON_PATH, 'r') as cache:
             data = json.load(cache)
 
-        return data
+        return upgrade_cache(JSON_PATH, data, generation)
+
+    def _open(self, path, offset=None, size=None):
+        '''
+        Return unbuffered file object of track at :path:, or of the :size:
+        bytes at :offset: of :path: for tracks stored in an archive
+        '''
+        self._count('open')
+        if offset is None:
+            return open(path, 'rb', buffering=0)
+
+        return FileSlice(path, offset, size)
+
+    def _reader(self, path, offset=None, size=None):
+        '''
+        Return buffered file object of track (see _open) for parsing its tags,
+        frames or cover art; reads are taken from the throttle
+        '''
+        f = self._open(path, offset, size)
+        if self._throttle:
+            f = ThrottledReader(f, self._throttle)
+
+        return io.BufferedReader(f)
+
+    def _fingerprint(self, path, size, offset=None):
+        '''
+        Return sampled fingerprint of file at :path: of :size: bytes (at
+        :offset: if stored in an archive)
+        '''
+        if self._throttle:
+            self._throttle.consume(min(size, FINGERPRINT_HEAD +
+                (FINGERPRINT_SAMPLES + 1) * FINGERPRINT_BLOCK))
+        fingerprint = hashlib.blake2b(str(size).encode(), digest_size=16)
+        with io.BufferedReader(self._open(path, offset, size)) as f:
+            fingerprint.update(f.read(FINGERPRINT_HEAD))
+            for i in range(1, FINGERPRINT_SAMPLES + 1):
+                f.seek(size * i // (FINGERPRINT_SAMPLES + 1))
+                fingerprint.update(f.read(FINGERPRINT_BLOCK))
+            # trailing block, covers ID3v1 tag
+            f.seek(max(size - FINGERPRINT_BLOCK, 0))
+            fingerprint.update(f.read(FINGERPRINT_BLOCK))
+
+        return fingerprint.hexdigest()
+
+    def _hash_file(self, path, hashes, offset=None, size=None, drop_cache=True):
+        '''
+        Update each of :hashes: with the contents of file at :path: (its :size:
+        bytes at :offset: if stored in an archive)
+
+        Reads are hinted as sequential and, unless not :drop_cache:, the file's
+        pages are dropped from the page cache afterwards, so a scan doesn't
+        evict tracks being served
+        '''
+        buf = getattr(self._local, 'hash_buffer', None)
+        if buf is None:
+            buf = self._local.hash_buffer = bytearray(self._hash_buffer_size)
+        view = memoryview(buf)
+        fadvise = hasattr(os, 'posix_fadvise')
+        start, length = offset or 0, size or 0
+        with self._open(path, offset, size) as f:
+            if fadvise:
+                os.posix_fadvise(f.fileno(), start, length,
+                                 os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                for h in hashes:
+                    h.update(view[:n])
+                if self._throttle:
+                    self._throttle.consume(n)
+            if fadvise and drop_cache and self._drop_cache:
+                os.posix_fadvise(f.fileno(), start, length,
+                                 os.POSIX_FADV_DONTNEED)
+
+    def _map_fingerprint(self, fingerprint, key):
+        '''
+        Record :key: (MD5 hexdigest) as the key identified by :fingerprint:
+        '''
+        if self._fingerprints.get(fingerprint) != key:
+            self._fingerprints[fingerprint] = key
+            self._fingerprints_changed = True
+
+    def _backfill_fingerprints(self, b_key, book):
+        '''
+        Fingerprint tracks of cached :book: hashed before fingerprints were
+        recorded, mapping them (and the book) to their existing keys
+        '''
+        if 'files' not in book:
+            book = read_book(JSON_PATH, b_key)
+        files = book['files']
+        if all('fingerprint' in t for t in files.values()):
+            return
+
+        book = dict(book, files=dict(files))
+        folder_fingerprint = hashlib.blake2b(digest_size=16)
+        # same order as tracks are hashed in _check_dir
+        for f_key in sorted(files, key=lambda x: files[x]['filename']):
+            track = files[f_key]
+            if 'fingerprint' not in track:
+                track = dict(track, fingerprint=self._fingerprint(
+                    track['path'], track['size_bytes'], track.get('offset')))
+                book['files'][f_key] = track
+            self._map_fingerprint(track['fingerprint'], f_key)
+            folder_fingerprint.update(track['fingerprint'].encode())
+        self._map_fingerprint(folder_fingerprint.hexdigest(), b_key)
+        self._shards[b_key] = book
+
+    def _store_cover(self, image):
+        '''
+        Write cover art :image: to the cover store unless present; return its
+        filename (content hash), None if not a supported image
+        '''
+        for magic, ext in COVER_TYPES:
+            if image and image.startswith(magic):
+                break
+        else:
+            return None
+
+        name = '%s.%s' % (hashlib.blake2b(image, digest_size=16).hexdigest(),
+                          ext)
+        path = os.path.join(COVERS_PATH, name)
+        if not os.path.exists(path):
+            os.makedirs(COVERS_PATH, exist_ok=True)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(image)
+            os.replace(tmp_path, path)
+
+        return name
+
+    def _backfill_cover(self, b_key, book):
+        '''
+        Extract cover art of cached :book: scanned before covers were enabled;
+        return its index entry
+        '''
+        book = self._shards.get(b_key) or read_book(JSON_PATH, b_key)
+        tracks = dict()
+        for f_key, track in book['files'].items():
+            # the key only needs the extension to pick a tag parser
+            tracks['%s/%s' % (f_key, track['filename'])] = (
+                track['path'], track.get('offset'), track['size_bytes'])
+
+        cover = None
+        for _, tag, err in TinyTag.get_many(
+                tracks, workers=self._config.get('TAG_WORKERS', TAG_WORKERS),
+                opener=lambda x: self._reader(*tracks[x]),
+                fields=('title',), duration=False, image=True):
+            image = tag and tag.get_image()
+            if image and len(image) > len(cover or b''):
+                cover = image
+
+        book = dict(book, cover=self._store_cover(cover))
+        self._shards[b_key] = book
+
+        return index_entry(book)
+
+    def _read_json(self, path):
+        '''
+        Return contents of JSON file at :path:, empty dict if it doesn't exist
+        '''
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _get_tags(self, tracks, fingerprints):
+        '''
+        Return dict of path: TinyTag of :tracks: (path: (file path, offset,
+        size)) with :fingerprints: (path: fingerprint), parsed in parallel by
+        TAG_WORKERS threads; tracks that fail to parse are logged and left out.
+        In exact duration mode durations are taken from the duration cache by
+        fingerprint if known. Only the tag holding the book's cover art (the
+        largest image) keeps its image
+        '''
+        workers = self._config.get('TAG_WORKERS', TAG_WORKERS)
+
+        # archive members are parsed from their slice of the archive, sizes
+        # are known from discovery
+        opener = lambda x: self._reader(*tracks[x])
+        filesizes = {x: t[2] for x, t in tracks.items()}
+
+        if not self._exact_duration:
+            batches = [(list(fingerprints), {})]
+        else:
+            known = [x for x in fingerprints if fingerprints[x] in self._durations]
+            unknown = [x for x in fingerprints
+                       if fingerprints[x] not in self._durations]
+            batches = [(known, {'duration': False}), (unknown, {})]
+
+        ret = {}
+        cover = None # (size, track order) and tag of the largest cover art
+        order = {x: i for i, x in enumerate(tracks)}
+        for paths, kwargs in batches:
+            for path, tag, err in TinyTag.get_many(
+                    paths, workers=workers, opener=opener, filesizes=filesizes,
+                    fields=TAG_FIELDS,
+                    exact_duration=self._exact_duration, image=self._covers,
+                    chapters=bool(self._chapter_length), **kwargs):
+                if err:
+                    self._log('%s: %s' % (path, err))
+                    continue
+                ret[path] = tag
+
+                # only the book's cover is kept, art of every track of a large
+                # book would otherwise be held until the book is done; the
+                # first of equally large images in track order wins
+                image = tag.get_image()
+                if not image:
+                    continue
+                duration = tag.duration or (self._exact_duration and
+                    self._durations.get(fingerprints[path]))
+                if not duration:
+                    tag._image_data = None # not a track, see _check_dir
+                    continue
+                rank = (len(image), -order[path])
+                if cover is None or rank > cover[0]:
+                    if cover is not None:
+                        cover[1]._image_data = None
+                    cover = (rank, tag)
+                else:
+                    tag._image_data = None
+
+        if self._exact_duration:
+            for path, fingerprint in fingerprints.items():
+                tag = ret.get(path)
+                if not tag:
+                    continue
+                if fingerprint in self._durations:
+                    tag.duration = self._durations[fingerprint]
+                elif tag.duration:
+                    self._durations[fingerprint] = tag.duration
+                    self._durations_changed = True
+
+        return ret
+
+    def _split_track(self, track, tag, title):
+        '''
+        Return exact duration and virtual chapters of :track: (file path,
+        offset, size) with parsed :tag:, split at its ID3 chapters if present,
+        otherwise into parts of about CHAPTER_LENGTH seconds titled after track
+        :title:
+
+        Chapters start at MP3 frame boundaries and are served as byte ranges of
+        the track, leaving the file as is
+        '''
+        path, base, size = track
+        # only MP3s are split, tracks stored in an archive are parsed from
+        # their slice of it
+        file_obj = lambda: self._reader(*track)
+
+        marks = tag.get_chapters()
+        if len(marks) > 1:
+            seek = ID3.get(path, fields=('title',), file_obj=file_obj(),
+                           filesize=size, seek_times=[x['start'] for x in marks])
+            offsets = seek.get_seek_offsets()
+        else:
+            # duration is estimated until every frame is walked (VBR estimates
+            # can be far off); build a seek table of one second resolution up
+            # to the longest possible duration, the size at the lowest MP3
+            # bitrate (8 kbit/s), and cut it into equal parts of the exact one
+            seek = ID3.get(path, fields=('title',), file_obj=file_obj(),
+                           filesize=size, seek_times=range(size // 1000 + 1))
+            table = seek.get_seek_offsets()
+            parts = math.ceil(seek.duration / self._chapter_length)
+            offsets = [table[min(int(seek.duration * i / parts), len(table) - 1)]
+                       for i in range(parts)]
+            marks = [{'title': None}] * parts
+
+        chapters = []
+        for idx, (start, offset) in enumerate(offsets):
+            if idx + 1 < len(offsets):
+                end, end_offset = offsets[idx + 1]
+            else:
+                end, end_offset = seek.duration, seek.filesize
+            # marks closer than a frame apart
+            if end_offset <= offset:
+                continue
+
+            # 1:02:03
+            duration_str = str(timedelta(seconds=end - start))
+
+            chapters.append({
+                'title':        self._validate(marks[idx]['title'], '%s (%d/%d)' %
+                                    (title, idx + 1, len(offsets))),
+                'duration':     end - start,
+                'duration_str': duration_str.split('.')[0],
+                'offset':       (base or 0) + offset,
+                'size_bytes':   end_offset - offset
+            })
+
+        return seek.duration, chapters
 
     def _validate(self, v, b):
         '''
@@ -84,32 +660,250 @@ class Books:
 
     def scan_books(self, audiobook_path=None):
         '''
-        Discover audiobooks under :root_path: and populate books object
+        Discover audiobooks under :audiobook_path: (root path or list of root
+        paths) and populate books object
 
         :cache: existing JSON cache, used to determine which content is new
                 (existing content is not re-hashed)
+
+        Books are scanned sequentially per device (st_dev) to avoid seeking
+        between books on spinning disks, devices are scanned in parallel
+
+        Each newly scanned book is checkpointed (shard and journal entry) when
+        done; a scan that didn't reach write_cache resumes after the books it
+        completed. SIGINT stops the scan after the books in progress, raising
+        KeyboardInterrupt
         '''
+        if isinstance(audiobook_path, str):
+            audiobook_path = [audiobook_path]
+        self._fs_calls.clear()
+        self._stop.clear()
         ex = self._get_path_hash_dict()
-        dirs = self._get_dirs(audiobook_path)
+        dirs = dict()
+        for root in audiobook_path:
+            dirs.update(self._get_dirs(root)) # roots may overlap
+
+        self._journaled = self._read_journal()
+        if self._journaled:
+            self._log('resuming scan, %d books journaled' % len(self._journaled))
+        self._plan(dirs, ex)
+
+        devices = dict()
+        for path, (dev, _) in dirs.items():
+            devices.setdefault(dev, []).append(path)
+
+        # signal handlers can only be set from the main thread
+        handler = None
+        if threading.current_thread() is threading.main_thread():
+            handler = signal.signal(signal.SIGINT, self._interrupt)
+
+        scanned = dict()
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        self._journal = open(JOURNAL_PATH, 'a')
+        try:
+            with ThreadPoolExecutor(max_workers=max(len(devices), 1)) as executor:
+                futures = [executor.submit(self._scan_device, dev, paths, dirs,
+                                           ex, scanned)
+                           for dev, paths in devices.items()]
+                for future in futures:
+                    future.result()
+        finally:
+            self._journal.close()
+            self._journal = None
+            if handler is not None:
+                signal.signal(signal.SIGINT, handler)
 
+        if self._stop.is_set():
+            raise KeyboardInterrupt('scan interrupted, run again to resume')
+
+        # discovery order, regardless of which device finished first
         books = dict()
         for path in dirs:
-            if path in ex:
-                _hash = ex[path]
-                books[_hash] = self._cache[_hash]
+            if scanned.get(path):
+                b_key, entry, _ = scanned[path]
+                books[b_key] = entry
+
+        self.books = books
+        self._log('scan: %d directory listings, %d stats, %d opens' %
+                  (self._fs_calls['scandir'], self._fs_calls['stat'],
+                   self._fs_calls['open']))
+
+    def progress(self):
+        '''
+        Return dict of books/bytes scanned and total books/bytes to scan of
+        the scan in progress (or the last scan)
+        '''
+        with self._progress_lock:
+            p = self._progress
+            return {x: p[x] for x in ('books', 'bytes', 'total_books',
+                                      'total_bytes')}
+
+    def _interrupt(self, signum, frame):
+        '''
+        SIGINT handler of a scan, stops it once books in progress are done
+        '''
+        self._log('interrupted, finishing books in progress')
+        self._stop.set()
+
+    def _read_journal(self):
+        '''
+        Return dict of book path: hash of books checkpointed by an interrupted
+        scan
+        '''
+        ret = dict()
+        if not os.path.exists(JOURNAL_PATH):
+            return ret
+        with open(JOURNAL_PATH, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break # torn write of a crashed scan
+                ret[entry['path']] = entry['key']
+
+        return ret
+
+    def _checkpoint(self, path, b_key, book):
+        '''
+        Write shard of newly scanned :book: at :path: and append it to the
+        journal, durably, so it isn't scanned again if the scan is interrupted
+        '''
+        os.makedirs(SHARDS_PATH, exist_ok=True)
+        write_json(get_shard_path(JSON_PATH, b_key), book)
+        with self._journal_lock:
+            self._journal.write(json.dumps({'path': path, 'key': b_key}) + '\n')
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def _restore_maps(self, b_key, book):
+        '''
+        Record fingerprints and durations of journaled :book: as _check_dir
+        would have
+        '''
+        files = book['files']
+        if not self._use_fingerprint:
+            folder_fingerprint = hashlib.blake2b(digest_size=16)
+            for f_key in sorted(files, key=lambda x: files[x]['filename']):
+                self._map_fingerprint(files[f_key]['fingerprint'], f_key)
+                folder_fingerprint.update(files[f_key]['fingerprint'].encode())
+            self._map_fingerprint(folder_fingerprint.hexdigest(), b_key)
+        if self._exact_duration:
+            for track in files.values():
+                if track['fingerprint'] not in self._durations:
+                    self._durations[track['fingerprint']] = track['duration']
+                    self._durations_changed = True
+
+    def _plan(self, dirs, ex):
+        '''
+        Record bytes to scan of each path of :dirs: not in cache (:ex:) or
+        journal, used for progress reports; directories without tracks (e.g.
+        Author/Series levels) aren't books and aren't counted
+        '''
+        self._planned = dict()
+        for path, (_, files) in dirs.items():
+            if path in ex or path in self._journaled:
+                continue
+            if files is None:
+                self._count('stat')
+                self._planned[path] = os.stat(path).st_size
                 continue
-            book = self._check_dir(path)
+            tracks = [f for f in files
+                      if f.name.split('.')[-1].lower() in TRACK_EXTENSIONS]
+            if not tracks:
+                continue
+            # stat data is kept by the entry, _check_dir doesn't stat again
+            self._count('stat', len(tracks))
+            self._planned[path] = sum(f.stat().st_size for f in tracks)
+
+        self._progress = Counter(total_books=len(self._planned),
+                                 total_bytes=sum(self._planned.values()))
+        self._progress_start = time.monotonic()
+        self._progress_logged = self._progress_start
+
+    def _report_progress(self, path):
+        '''
+        Count planned :path: as scanned, logging progress, throughput and ETA
+        at most every PROGRESS_INTERVAL seconds
+        '''
+        with self._progress_lock:
+            p = self._progress
+            p['books'] += 1
+            p['bytes'] += self._planned.get(path, 0)
+            now = time.monotonic()
+            if (now - self._progress_logged < PROGRESS_INTERVAL and
+                    p['books'] < p['total_books']):
+                return
+            self._progress_logged = now
+
+        rate = p['bytes'] / max(now - self._progress_start, 1e-6)
+        eta = (p['total_bytes'] - p['bytes']) / rate if rate else 0
+        self._log('progress: %d/%d books, %.1f/%.1f GB, %.1f MB/s, ETA %s' %
+                  (p['books'], p['total_books'], p['bytes'] / 1e9,
+                   p['total_bytes'] / 1e9, rate / 1e6,
+                   str(timedelta(seconds=int(eta)))))
+
+    def _scan_device(self, dev, paths, dirs, ex, scanned):
+        '''
+        Scan book :paths: on device :dev: in order, storing (hash, index entry,
+        new) or None by path in :scanned:; logs the device's throughput
+
+        :dirs: discovered paths, see _get_dirs
+        '''
+        start = time.monotonic()
+        new = 0
+        nbytes = 0
+        for path in paths:
+            if self._stop.is_set():
+                return
+            scanned[path] = self._scan_path(path, dirs[path][1], ex)
+            if path in self._planned:
+                self._report_progress(path)
+            if scanned[path] and scanned[path][2]:
+                new += 1
+                nbytes += scanned[path][1]['size_bytes']
+
+        elapsed = time.monotonic() - start
+        self._log('device %x: %d books (%d new), %.1f MB in %.1fs (%.1f MB/s)' %
+                  (dev, len([x for x in paths if scanned[x]]), new,
+                   nbytes / 1e6, elapsed, nbytes / 1e6 / max(elapsed, 1e-6)))
+
+    def _scan_path(self, path, files, ex):
+        '''
+        Return (hash, index entry, new) of book at :path: (with os.DirEntry
+        :files:), taken from cache if present in :ex: (path: hash) or from the
+        journal of an interrupted scan, None if :path: isn't a book
+        '''
+        if path in ex:
+            _hash = ex[path]
+            cached = self._cache[_hash]
+            if os.path.exists(get_shard_path(JSON_PATH, _hash)):
+                if self._use_fingerprint:
+                    self._backfill_fingerprints(_hash, cached)
+                entry = index_entry(cached)
+                if self._covers and 'cover' not in cached:
+                    entry = self._backfill_cover(_hash, cached)
+                return (_hash, entry, False)
+        if path in self._journaled:
+            _hash = self._journaled[path]
+            book = read_book(JSON_PATH, _hash)
             if book:
-                books[book[0]] = book[1]
+                self._restore_maps(_hash, book)
+                return (_hash, index_entry(book), False)
+        book = self._check_dir(path, files)
+        if book:
+            self._checkpoint(path, book[0], book[1])
+            return (book[0], index_entry(book[1]), True)
 
-        self.books = books
+        return None
 
-    def _check_dir(self, path):
+    def _check_dir(self, path, files=None):
         '''
-        Determine if :path: contains (supported) audio files; return populated
-        book dict or None
+        Determine if :path: (directory or archive) contains (supported) audio
+        files; return populated book dict or None
+
+        :files: os.DirEntry of files in directory :path:, listed if not given
         '''
-        ext = ['mp3'] # m4b seems to be unsupported by Apple
+        ext = TRACK_EXTENSIONS
         is_book = False
 
         # book attributes to be populated
@@ -124,50 +918,105 @@ class Books:
             'title':        None
         }
 
+        # largest cover art of the book's tracks
+        cover = None
+
         # hash of each supported track in directory path
         folder_hash = hashlib.md5()
+        folder_fingerprint = hashlib.blake2b(digest_size=16)
 
-        for f in sorted(os.listdir(path)):
-            # must be a file and have a supported extension
-            file_path = os.path.join(path, f)
-            if not os.path.isfile(file_path) or not f.split('.')[-1].lower() in ext:
-                continue
+        # supported tracks (track path: (file path, offset, size)), must be a
+        # file and have a supported extension; tracks stored in an archive are
+        # read from their offset within it, without extraction
+        tracks = dict()
+        name = os.path.split(path)[1]
+        if is_archive(path):
+            name = os.path.splitext(name)[0]
+            try:
+                self._count('open')
+                members = get_members(path)
+            except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+                self._log('%s: %s' % (path, e))
+                return None
+            for member, offset, size in sorted(members):
+                if member.split('.')[-1].lower() in ext:
+                    tracks[os.path.join(path, member)] = (path, offset, size)
+        else:
+            if files is None:
+                self._count('scandir')
+                with os.scandir(path) as s:
+                    files = [x for x in s if x.is_file()]
+                self._count('stat', len(files))
+            for f in sorted(files, key=lambda x: x.name):
+                if not f.name.split('.')[-1].lower() in ext:
+                    continue
+                tracks[f.path] = (f.path, None, f.stat().st_size)
+
+        fingerprints = dict()
+        for file_path, (f_path, offset, size) in tracks.items():
+            fingerprints[file_path] = self._fingerprint(f_path, size, offset)
+
+        # tags of a book's tracks are parsed in parallel, tracks are still
+        # hashed in filename order below
+        tags = self._get_tags(tracks, fingerprints)
+
+        for file_path, fingerprint in fingerprints.items():
+            f_path, offset, size = tracks[file_path]
 
             # tracks at minimum must have a duration tag (required by podcast
             # apps)
-            tag = TinyTag.get(file_path)
-            if not tag.duration:
+            tag = tags.get(file_path)
+            if not tag or not tag.duration:
                 continue
 
             # previous conditions met, we've found at least one track
             is_book = True
-            self._log(os.path.join(path, f))
-
-            # hash track (used as a key) and update folder hash
-            file_hash = hashlib.md5()
-            with open(file_path, 'rb') as f:
-                while True:
-                    data = f.read(1024)
-                    if not data:
-                        break
-                    folder_hash.update(data)
-                    file_hash.update(data)
+            self._log(file_path)
+
+            image = tag.get_image()
+            if image and len(image) > len(cover or b''):
+                cover = image
+
+            # hash track (used as a key) and update folder hash; in fingerprint
+            # mode the MD5 key is only known if recorded by an earlier scan
+            folder_fingerprint.update(fingerprint.encode())
+            if self._use_fingerprint:
+                file_key = self._fingerprints.get(fingerprint, fingerprint)
+            else:
+                file_hash = hashlib.md5()
+                self._hash_file(f_path, (folder_hash, file_hash), offset, size)
+                file_key = file_hash.hexdigest()
+                self._map_fingerprint(fingerprint, file_key)
+
+            # long single-file books are published as virtual chapters
+            chapters = None
+            if self._chapter_length and (len(tag.get_chapters()) > 1 or
+                                         tag.duration > self._chapter_length):
+                title = self._validate(tag.title, os.path.split(file_path)[1])
+                tag.duration, chapters = self._split_track(tracks[file_path],
+                                                           tag, title)
 
             # 1 day, 10:59:58
             duration_str = str(timedelta(seconds=tag.duration))
 
             # per-file atributes, some values are populated conditionally
             track = {
-                'album':        self._validate(tag.album, os.path.split(path)[1]),
+                'album':        self._validate(tag.album, name),
                 'author':       self._validate(tag.artist, 'Unknown'),
                 'duration':     tag.duration,
                 'duration_str': duration_str.split('.')[0],
                 'filename':     os.path.split(file_path)[1],
-                'path':         file_path,
+                'fingerprint':  fingerprint,
+                'path':         f_path,
                 'size_bytes':   tag.filesize,
                 'title':        self._validate(tag.title, os.path.split(file_path)[1]),
                 'track':        tag.track
             }
+            if chapters:
+                track['chapters'] = chapters
+            # archive member, served as a byte range of the archive
+            if offset is not None:
+                track['offset'] = offset
 
             # we assume author and album attributes are unchanged between tracks
             book['author'] = track['author']
@@ -178,11 +1027,17 @@ class Books:
             book['size_bytes'] += tag.filesize
 
             # hexdigest: track dict
-            book['files'][file_hash.hexdigest()] = track
+            book['files'][file_key] = track
 
         # final book processing routine; update total size, duration
         if is_book:
-            folder_hash = folder_hash.hexdigest()
+            folder_fingerprint = folder_fingerprint.hexdigest()
+            if self._use_fingerprint:
+                folder_hash = self._fingerprints.get(folder_fingerprint,
+                                                     folder_fingerprint)
+            else:
+                folder_hash = folder_hash.hexdigest()
+                self._map_fingerprint(folder_fingerprint, folder_hash)
             total_size = book['size_bytes']
 
             # bytes -> readable file size, used in audiobook index
@@ -202,6 +1057,9 @@ class Books:
             duration_str = str(timedelta(seconds=book['duration']))
             book['duration_str'] = duration_str.split('.')[0]
 
+            if self._covers:
+                book['cover'] = self._store_cover(cover)
+
             return (folder_hash, book)
 
         return None
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+# pending read-ahead requests; further requests are dropped while full
+QUEUE_SIZE = 16
+
+class Prefetcher:
+    def __init__(self, nbytes=4 * 1024 * 1024, budget=256 * 1024 * 1024,
+                 window=60, ttl=600):
+        '''
+        Background page-cache warming of tracks likely to be requested next
+
+        :nbytes: bytes read ahead from the start of each track
+        :budget: maximum bytes read ahead per :window: seconds
+        :ttl: seconds a read-ahead track is considered warm; requests for it
+              within :ttl: count as hits, otherwise the read-ahead expires
+        '''
+        self._nbytes = nbytes
+        self._budget = budget
+        self._window = window
+        self._ttl = ttl
+
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._issued = {} # (path, offset): time read-ahead was issued
+        self._spent = deque() # (time, bytes) of read-ahead within window
+
+        self._stats = {
+            'issued':           0,
+            'issued_bytes':     0,
+            'hits':             0,
+            'expired':          0,
+            'skipped_budget':   0,
+            'skipped_queue':    0,
+            'skipped_warm':     0
+        }
+
+    def prefetch(self, path, offset=0):
+        '''
+        Queue read-ahead of the start of track at :path: (at :offset: if stored
+        in an archive)
+        '''
+        with self._lock:
+            self._expire()
+            if (path, offset) in self._issued:
+                self._stats['skipped_warm'] += 1
+                return
+
+            # started by the first request of a worker process, and again if
+            # it died
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+            try:
+                self._queue.put_nowait((path, offset))
+            except queue.Full:
+                self._stats['skipped_queue'] += 1
+
+    def hit(self, path, offset=0):
+        '''
+        Record request of track at :path: (:offset:), counting a hit if it was
+        read ahead
+        '''
+        with self._lock:
+            self._expire()
+            if self._issued.pop((path, offset), None) is not None:
+                self._stats['hits'] += 1
+
+    def stats(self):
+        '''
+        Return dict of read-ahead counters and hit rate
+        '''
+        with self._lock:
+            self._expire()
+            ret = dict(self._stats)
+            ret['pending'] = len(self._issued)
+            # read-ahead still within ttl may yet be hit, exclude from rate
+            done = ret['hits'] + ret['expired']
+            ret['hit_rate'] = round(ret['hits'] / done, 4) if done else None
+
+        return ret
+
+    def _expire(self):
+        '''
+        Drop read-ahead older than ttl and budget spent outside the window;
+        caller must hold the lock
+        '''
+        now = time.monotonic()
+        for key, issued in list(self._issued.items()):
+            if now - issued > self._ttl:
+                del self._issued[key]
+                self._stats['expired'] += 1
+        while self._spent and now - self._spent[0][0] > self._window:
+            self._spent.popleft()
+
+    def _run(self):
+        '''
+        Issue queued read-ahead within budget
+        '''
+        while True:
+            key = self._queue.get()
+            with self._lock:
+                self._expire()
+                if key in self._issued:
+                    continue
+                if sum(x[1] for x in self._spent) + self._nbytes > self._budget:
+                    self._stats['skipped_budget'] += 1
+                    continue
+            try:
+                nbytes = self._readahead(*key)
+            except OSError:
+                continue
+            with self._lock:
+                now = time.monotonic()
+                self._issued[key] = now
+                self._spent.append((now, nbytes))
+                self._stats['issued'] += 1
+                self._stats['issued_bytes'] += nbytes
+
+    def _readahead(self, path, offset):
+        '''
+        Ask the kernel to read :path: from :offset: into the page cache; return
+        number of bytes requested
+        '''
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            nbytes = max(min(self._nbytes, os.fstat(fd).st_size - offset), 0)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, offset, nbytes, os.POSIX_FADV_WILLNEED)
+            else:
+                # no readahead hint available, touch the pages instead
+                os.pread(fd, nbytes, offset)
+        finally:
+            os.close(fd)
+
+        return nbytes
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+import datetime
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from lib.books import CACHE_PATH, SCAN_PATH, VERIFY_PATH, Books
+from lib.throttle import TokenBucket
+
+# held while scanning/verifying, so only one process sharing the cache runs
+# each at a time
+LOCK_PATH = os.path.join(CACHE_PATH, 'scan.lock')
+VERIFY_LOCK_PATH = os.path.join(CACHE_PATH, 'verify.lock')
+
+# nice value of background job threads; I/O priority of the CFQ/BFQ schedulers
+# follows it (best-effort, lowest level)
+SCAN_NICE = 19
+
+# bytes verified per background verification run, state is saved after each
+VERIFY_BATCH = 256 * 1024 * 1024
+
+# seconds between runs of a verification pass, and between the completion of a
+# pass over every track and the start of the next
+VERIFY_PAUSE = 1
+VERIFY_INTERVAL = 24 * 60 * 60
+
+# default bytes read per second by verification, which must be limited in the
+# background
+VERIFY_RATE = 10 * 1024 * 1024
+
+# seconds to wait before retrying a job running in another process
+LOCKED_WAIT = 60
+
+@contextmanager
+def scan_lock(blocking=True, path=LOCK_PATH):
+    '''
+    Hold the scan lock (or lock at :path:) of the cache; raises
+    BlockingIOError if it is held by another process and not :blocking:
+    '''
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    with open(path, 'w') as f:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        fcntl.flock(f, flags)
+        yield # released when closed
+
+def _timestamp(t):
+    '''
+    Return epoch :t: as ISO-8601 local time, None if not set
+    '''
+    if t is None:
+        return None
+    return datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%dT%H:%M:%S")
+
+class Job:
+    # file whose age schedules the job and lock held while it runs
+    state_path = None
+    lock_path = None
+
+    def __init__(self, config, interval, rate=0):
+        '''
+        Cache maintenance run periodically in a background thread
+
+        :config: app config, passed to Books
+        :interval: seconds between runs, counted from the last write of
+                   state_path by any process sharing the cache (e.g. uwsgi
+                   workers, cron)
+        :rate: maximum bytes read per second, 0 for no limit
+
+        Jobs run at the lowest CPU (and, following it, I/O) priority; only one
+        process sharing the cache runs a job at a time
+        '''
+        self._config = config
+        self._interval = interval
+        self._throttle = TokenBucket(rate) if rate else None
+
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self._status = {
+            'state':            'idle',
+            'runs':             0,
+            'errors':           0,
+            'skipped_locked':   0,
+            'last_error':       None,
+            'last_start':       None,
+            'last_seconds':     None,
+            'next_run':         None
+        }
+
+    def start(self):
+        '''
+        Start the job thread unless running; called on each request, as a
+        thread started before uwsgi forks its workers doesn't exist in them
+        (the same goes for the prefetch and access log threads, which start
+        on first use)
+        '''
+        with self._lock:
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def stats(self):
+        '''
+        Return dict of job state and counters
+        '''
+        with self._lock:
+            return dict(self._status)
+
+    def _due(self):
+        '''
+        Return seconds until the next run is due, 0 if it is
+        '''
+        try:
+            age = time.time() - os.stat(self.state_path).st_mtime
+        except FileNotFoundError:
+            return 0
+
+        return max(self._interval - age, 0)
+
+    def _run(self):
+        '''
+        Run job whenever due, taking turns with other processes
+        '''
+        # nice applies to the calling thread only on Linux, elsewhere it would
+        # slow down serving as well
+        if sys.platform.startswith('linux'):
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(),
+                               SCAN_NICE)
+            except OSError:
+                pass
+
+        while True:
+            wait = self._due()
+            if not wait:
+                try:
+                    with scan_lock(blocking=False, path=self.lock_path):
+                        # another process may have run it while we waited
+                        if not self._due():
+                            self._run_once()
+                    wait = self._due() or self._interval
+                except BlockingIOError:
+                    with self._lock:
+                        self._status['skipped_locked'] += 1
+                    wait = LOCKED_WAIT
+            with self._lock:
+                self._status['next_run'] = _timestamp(time.time() + wait)
+            time.sleep(wait)
+
+    def _run_once(self):
+        '''
+        Run job, recording state and errors; caller must hold the lock
+        '''
+        start = time.time()
+        with self._lock:
+            self._status['state'] = 'running'
+            self._status['last_start'] = _timestamp(start)
+        try:
+            self._work(Books(self._config, throttle=self._throttle))
+        except Exception as e:
+            with self._lock:
+                self._status['errors'] += 1
+                self._status['last_error'] = '%s: %s' % (type(e).__name__, e)
+        finally:
+            with self._lock:
+                self._status['state'] = 'idle'
+                self._status['runs'] += 1
+                self._status['last_seconds'] = round(time.time() - start, 1)
+
+    def _work(self, books):
+        raise NotImplementedError
+
+class Scanner(Job):
+    state_path = SCAN_PATH
+    lock_path = LOCK_PATH
+
+    def __init__(self, config, roots, interval, rate=0):
+        '''
+        Periodic incremental scans of library :roots:, see Job
+
+        Shards are written before the index is replaced, so requests see
+        either the previous cache generation or the new one
+        '''
+        super().__init__(config, interval, rate)
+        self._roots = roots
+        self._books = None # Books of the scan in progress
+        self._status['last_books'] = None
+
+    def stats(self):
+        '''
+        Return dict of scan state and counters, with progress of the scan in
+        progress
+        '''
+        ret = super().stats()
+        books = self._books
+        if books:
+            ret['progress'] = books.progress()
+
+        return ret
+
+    def _work(self, books):
+        self._books = books
+        try:
+            books.scan_books(self._roots)
+            books.write_cache()
+        finally:
+            self._books = None
+        with self._lock:
+            self._status['last_books'] = len(books.books)
+
+class Verifier(Job):
+    state_path = VERIFY_PATH
+    lock_path = VERIFY_LOCK_PATH
+
+    def __init__(self, config, interval=VERIFY_INTERVAL, rate=VERIFY_RATE):
+        '''
+        Periodic verification of cached tracks against their keys, see Job and
+        Books.verify; a pass over every track is made in runs of VERIFY_BATCH
+        bytes, VERIFY_PAUSE seconds apart, and passes start :interval: seconds
+        after the previous one completed. :rate: can't be 0 (no limit)
+        '''
+        if not rate:
+            raise ValueError('background verification needs a read rate limit')
+        super().__init__(config, interval, rate)
+
+    def stats(self):
+        '''
+        Return dict of verification state and counters, with tracks failing
+        verification by any process
+        '''
+        ret = super().stats()
+        try:
+            with open(VERIFY_PATH, 'r') as f:
+                ret['failures'] = json.load(f)['failures']
+        except (OSError, ValueError):
+            ret['failures'] = {}
+
+        return ret
+
+    def _due(self):
+        try:
+            age = time.time() - os.stat(VERIFY_PATH).st_mtime
+            with open(VERIFY_PATH, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return 0
+
+        # pass in progress, runs only wait for each other
+        completed = state.get('completed')
+        if completed is None or completed < state.get('pass_start', 0):
+            return max(VERIFY_PAUSE - age, 0)
+
+        return max(self._interval - (time.time() - completed), 0)
+
+    def _work(self, books):
+        books.verify(VERIFY_BATCH)
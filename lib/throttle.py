@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import io
+import threading
+import time
+
+# bytes a client may receive ahead of its rate, about one response chunk
+SHAPER_BURST = 256 * 1024
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        '''
+        Thread-safe limit of :rate: units (e.g. bytes) per second, allowing
+        bursts of up to :burst: units (one second of :rate: by default)
+
+        Consumers may take more than is available; the debt is paid by
+        sleeping, so large reads are limited as well as small ones
+        '''
+        self._rate = rate
+        self._fixed_burst = burst
+        self._burst = burst or rate
+        self._tokens = self._burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        '''
+        Change rate to :rate: units per second, e.g. as the share of a limit
+        shared by several buckets changes
+        '''
+        with self._lock:
+            self._rate = rate
+            self._burst = self._fixed_burst or rate
+            self._tokens = min(self._tokens, self._burst)
+
+    def consume(self, n):
+        '''
+        Take :n: units, sleeping until the bucket is back out of debt; return
+        seconds slept
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._last) * self._rate,
+                               self._burst)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+        return wait
+
+class ThrottledReader(io.RawIOBase):
+    def __init__(self, raw, bucket):
+        '''
+        Unbuffered file object reading from :raw: (unbuffered, seekable), each
+        read taking its bytes from TokenBucket :bucket:
+        '''
+        self._raw = raw
+        self._bucket = bucket
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        return self._raw.fileno()
+
+    def readinto(self, b):
+        n = self._raw.readinto(b)
+        if n:
+            self._bucket.consume(n)
+
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._raw.seek(offset, whence)
+
+    def tell(self):
+        return self._raw.tell()
+
+    def close(self):
+        self._raw.close()
+        super().close()
+
+class Shaper:
+    def __init__(self, rate=0, client_rate=0):
+        '''
+        Bandwidth limits of streamed responses: at most :rate: bytes per second
+        in total, shared equally between clients with active downloads, and at
+        most :client_rate: bytes per second per client; 0 for no limit
+
+        Streams of the same client share its limit, so parallel downloads
+        don't get a client more than its share
+        '''
+        self._rate = rate
+        self._client_rate = client_rate
+        self._lock = threading.Lock()
+        self._clients = dict() # client: [TokenBucket, active streams]
+
+        self._stats = {
+            'streams':          0,
+            'bytes':            0,
+            'throttled_bytes':  0,
+            'wait_seconds':     0.0
+        }
+
+    def stream(self, client, chunks):
+        '''
+        Yield :chunks: (bytes) of a response to :client:, waiting as needed to
+        keep within limits
+        '''
+        with self._lock:
+            if client not in self._clients:
+                self._clients[client] = [TokenBucket(
+                    self._client_rate or self._rate, SHAPER_BURST), 0]
+            state = self._clients[client]
+            state[1] += 1
+            self._stats['streams'] += 1
+            self._share()
+        try:
+            for chunk in chunks:
+                wait = state[0].consume(len(chunk))
+                with self._lock:
+                    self._stats['bytes'] += len(chunk)
+                    if wait:
+                        self._stats['throttled_bytes'] += len(chunk)
+                        self._stats['wait_seconds'] += wait
+                yield chunk
+        finally:
+            # also releases the file of an unfinished response
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            with self._lock:
+                state[1] -= 1
+                if not state[1]:
+                    del self._clients[client]
+                self._share()
+
+    def stats(self):
+        '''
+        Return dict of shaping counters and active clients/streams
+        '''
+        with self._lock:
+            ret = dict(self._stats)
+            ret['wait_seconds'] = round(ret['wait_seconds'], 3)
+            ret['active_clients'] = len(self._clients)
+            ret['active_streams'] = sum(x[1] for x in self._clients.values())
+
+        return ret
+
+    def _share(self):
+        '''
+        Set rate of each active client to its share of the limits; caller
+        must hold the lock
+        '''
+        if not self._clients:
+            return
+        rate = self._client_rate
+        if self._rate:
+            share = self._rate / len(self._clients)
+            rate = min(rate, share) if rate else share
+        for bucket, _ in self._clients.values():
+            bucket.set_rate(rate)
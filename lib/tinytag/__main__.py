@@ -1,10 +1,12 @@
 import os
+import csv
 import json
 import sys
-from tinytag import TinyTag, TinyTagException
+from .tinytag import TinyTag, TinyTagException
 
 def usage():
-    print('usage: tinytag <filename> [--save-image <image-path>] [--format json|csv|tsv]')
+    print('usage: tinytag <filename|directory>... [--save-image <image-path>] '
+          '[--format json|jsonl|csv|tsv] [--workers <n>]')
     sys.exit(1)
 
 def pop_param(name, _default):
@@ -14,25 +16,75 @@ def pop_param(name, _default):
         return sys.argv.pop(idx)
     return _default
 
-try:
-    save_image_path = pop_param('--save-image', None)
-    formatting = pop_param('--format', 'json')
-    filename = sys.argv[1]
-except:
-    usage()
+def iter_files(paths):
+    # files are yielded as directories are walked, parsing starts right away
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                if TinyTag.is_supported(f):
+                    yield os.path.join(root, f)
 
-try:
+def print_single(filename):
     tag = TinyTag.get(filename, image=save_image_path is not None)
     if save_image_path:
         image = tag.get_image()
         if image:
             with open(save_image_path, 'wb') as fh:
                 fh.write(image)
-    if formatting == 'json':
+    if formatting in ('json', 'jsonl'):
         print(json.dumps(tag.as_dict()))
     elif formatting == 'csv':
         print('\n'.join('%s,%s' % (k, v) for k, v in tag.as_dict().items()))
     elif formatting == 'tsv':
         print('\n'.join('%s\t%s' % (k, v) for k, v in tag.as_dict().items()))
-except TinyTagException as e:
-    sys.stderr.write(str(e))
\ No newline at end of file
+
+def print_many(paths):
+    # one line per file in completion order, filename is the first column
+    writer = None
+    if formatting in ('csv', 'tsv'):
+        delimiter = ',' if formatting == 'csv' else '\t'
+        writer = csv.writer(sys.stdout, delimiter=delimiter, lineterminator='\n')
+        header = None
+
+    failed = False
+    for filename, tag, err in TinyTag.get_many(iter_files(paths), workers=workers):
+        if err:
+            failed = True
+            sys.stderr.write('%s: %s\n' % (filename, err))
+            continue
+        data = dict(filename=filename, **tag.as_dict())
+        if writer is None:
+            print(json.dumps(data))
+        else:
+            if header is None:
+                header = list(data)
+                writer.writerow(header)
+            writer.writerow([data[k] for k in header])
+        sys.stdout.flush()
+
+    return failed
+
+try:
+    save_image_path = pop_param('--save-image', None)
+    formatting = pop_param('--format', 'json')
+    workers = int(pop_param('--workers', os.cpu_count() or 4))
+    paths = sys.argv[1:]
+    if not paths or formatting not in ('json', 'jsonl', 'csv', 'tsv'):
+        raise ValueError
+except:
+    usage()
+
+try:
+    if len(paths) == 1 and not os.path.isdir(paths[0]):
+        print_single(paths[0])
+    else:
+        if save_image_path:
+            usage()
+        sys.exit(1 if print_many(paths) else 0)
+except (TinyTagException, OSError) as e:
+    sys.stderr.write(str(e))
+    sys.exit(1)
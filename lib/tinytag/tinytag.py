@@ -35,11 +35,13 @@ from __future__ import print_function
 
 import re
 from collections.abc import MutableMapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import codecs
 from functools import reduce
 import struct
 import os
 import io
+import mmap
 import sys
 from io import BytesIO
 DEBUG = os.environ.get('DEBUG', False)  # some of the parsers will print some debug info when set to True
@@ -56,6 +58,51 @@ def _read(fh, nbytes):  # helper function to check if we haven't reached EOF
     return b
 
 
+class _MemoryReader(object):
+    """read-only file-like object over a buffer (bytes, mmap, memoryview);
+    read() returns memoryview slices, so parsing does no copies or syscalls"""
+
+    PEEK_SIZE = 4096
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self._view = memoryview(buffer)
+        self._pos = 0
+
+    def read(self, size=-1):
+        pos = self._pos
+        data = self._view[pos:] if size is None or size < 0 else self._view[pos:pos + size]
+        self._pos = pos + len(data)
+        return data
+
+    def peek(self, size=0):
+        # like BufferedReader.peek: may return more than size bytes
+        start = min(self._pos, len(self._view))
+        return self._view[start:start + max(size, self.PEEK_SIZE)].tobytes()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError('negative seek position %d' % offset)
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._view.release()
+
+
+def _sub_reader(data):
+    # file-like walker over a block of already read data, without copying it
+    # when it is a view of an mmap
+    return BytesIO(data) if isinstance(data, bytes) else _MemoryReader(data)
+
+
 def stderr(*args):
     sys.stderr.write('%s\n' % ' '.join(args))
     sys.stderr.flush()
@@ -93,6 +140,12 @@ class TinyTag(object):
         self.year = None
         self._load_image = False
         self._image_data = None
+        self._load_chapters = False
+        self._chapters = []
+        self._seek_times = None  # times to find the starting frames of
+        self._seek_offsets = []
+        self._fields = None  # names of the fields to parse, None for all
+        self._exact_duration = False  # never estimate duration from a sample
         self._ignore_errors = ignore_errors
 
     def as_dict(self):
@@ -105,6 +158,16 @@ class TinyTag(object):
     def get_image(self):
         return self._image_data
 
+    def get_chapters(self):
+        """chapters as list of dicts with title, start and end (in seconds),
+        requires get(..., chapters=True)"""
+        return self._chapters
+
+    def get_seek_offsets(self):
+        """(time, byte offset) of the frame starting at or after each of the
+        times passed to get(..., seek_times=...)"""
+        return self._seek_offsets
+
     @classmethod
     def _get_parser_for_filename(cls, filename, exception=False):
         mapping = {
@@ -122,19 +185,81 @@ class TinyTag(object):
             raise TinyTagException('No tag reader found to support filetype! ')
 
     @classmethod
-    def get(cls, filename, tags=True, duration=True, image=False, ignore_errors=False):
+    def get(cls, filename, tags=True, duration=True, image=False, ignore_errors=False,
+            fields=None, exact_duration=False, use_mmap=False, chapters=False,
+            seek_times=None, file_obj=None, filesize=None):
         filename = os.path.expanduser(str(filename))  # cast pathlib.Path to str
-        size = os.path.getsize(filename)
+        if file_obj is not None:
+            # parse an open binary file (e.g. an archive member) instead, the
+            # filename only selects the parser. it is closed when done
+            size = file_obj.seek(0, os.SEEK_END) if filesize is None else filesize
+            file_obj.seek(0)
+            use_mmap = False
+        else:  # size may be already known (e.g. from os.scandir), saves a stat
+            size = os.path.getsize(filename) if filesize is None else filesize
         if not size > 0:
+            if file_obj is not None:
+                file_obj.close()
             return TinyTag(None, 0)
         if cls == TinyTag:  # if `get` is invoked on TinyTag, find parser by ext
             parser_class = cls._get_parser_for_filename(filename, exception=True)
         else:  # otherwise use the class on which `get` was invoked
             parser_class = cls
-        with io.open(filename, 'rb') as af:
-            tag = parser_class(af, size, ignore_errors=ignore_errors)
-            tag.load(tags=tags, duration=duration, image=image)
-            return tag
+        with file_obj or io.open(filename, 'rb') as af:
+            if not use_mmap:
+                tag = parser_class(af, size, ignore_errors=ignore_errors)
+                tag.load(tags=tags, duration=duration, image=image, fields=fields,
+                         exact_duration=exact_duration, chapters=chapters,
+                         seek_times=seek_times)
+                return tag
+            # parse straight from the page cache through memoryview slices
+            mm = mmap.mmap(af.fileno(), 0, access=mmap.ACCESS_READ)
+            reader = _MemoryReader(mm)
+            try:
+                tag = parser_class(reader, size, ignore_errors=ignore_errors)
+                tag.load(tags=tags, duration=duration, image=image, fields=fields,
+                         exact_duration=exact_duration, chapters=chapters,
+                         seek_times=seek_times)
+                tag._filehandler = None
+                return tag
+            finally:
+                try:
+                    reader.close()
+                    mm.close()
+                except BufferError:
+                    pass  # slices still referenced (by a traceback), left to gc
+
+    @classmethod
+    def get_many(cls, filenames, workers=4, opener=None, filesizes=None, **kwargs):
+        """parse many files in parallel, yielding (filename, tag, exception)
+        tuples as they complete. errors don't abort the batch: a file that
+        failed has tag None and the raised exception, otherwise exception is
+        None. if given, opener(filename) returns the file object to parse (see
+        `file_obj` of `get`) and filesizes maps filenames to known sizes (see
+        `filesize` of `get`). keyword arguments are passed on to `get`"""
+        def get(filename):
+            try:
+                file_obj = opener(filename) if opener else None
+                filesize = filesizes.get(filename) if filesizes else None
+                return filename, cls.get(filename, file_obj=file_obj,
+                                         filesize=filesize, **kwargs), None
+            except Exception as e:
+                return filename, None, e
+
+        filenames = iter(filenames)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            while True:
+                # bounded number of files in flight, filenames may be a stream
+                for filename in filenames:
+                    pending.add(executor.submit(get, filename))
+                    if len(pending) >= workers * 4:
+                        break
+                if not pending:
+                    return
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
 
     def __str__(self):
         return str(dict(
@@ -144,8 +269,19 @@ class TinyTag(object):
     def __repr__(self):
         return str(self)
 
-    def load(self, tags, duration, image=False):
+    def load(self, tags, duration, image=False, fields=None, exact_duration=False,
+             chapters=False, seek_times=None):
         self._load_image = image
+        self._load_chapters = chapters
+        if seek_times is not None:  # frames are only found by walking all
+            if isinstance(seek_times, range) and seek_times.step > 0:
+                self._seek_times = seek_times  # sorted, and lazy if long
+            else:
+                self._seek_times = sorted(seek_times)
+            exact_duration = True
+        # parsers supporting it skip other fields and stop once all are found
+        self._fields = set(fields) if fields else None
+        self._exact_duration = exact_duration
         if tags:
             self._parse_tag(self._filehandler)
         if duration:
@@ -185,6 +321,12 @@ class TinyTag(object):
     def _parse_tag(self, fh):
         raise NotImplementedError()
 
+    def _wants_field(self, fieldname):
+        return self._fields is None or fieldname in self._fields
+
+    def _has_wanted_fields(self):
+        return self._fields is not None and all(getattr(self, f) for f in self._fields)
+
     def update(self, other):
         # update the values of this tag with the values from another tag
         for key in ['track', 'track_total', 'title', 'artist',
@@ -206,13 +348,13 @@ class MP4(TinyTag):
     class Parser:
         # https://developer.apple.com/library/mac/documentation/QuickTime/QTFF/Metadata/Metadata.html#//apple_ref/doc/uid/TP40000939-CH1-SW34
         ATOM_DECODER_BY_TYPE = {
-            0: lambda x: x,  # 'reserved',
+            0: lambda x: bytes(x),  # 'reserved',
             1: lambda x: codecs.decode(x, 'utf-8', 'replace'),   # UTF-8
             2: lambda x: codecs.decode(x, 'utf-16', 'replace'),  # UTF-16
             3: lambda x: codecs.decode(x, 's/jis', 'replace'),   # S/JIS
             # 16: duration in millis
-            13: lambda x: x,  # JPEG
-            14: lambda x: x,  # PNG
+            13: lambda x: bytes(x),  # JPEG
+            14: lambda x: bytes(x),  # PNG
             21: lambda x: struct.unpack('>b', x)[0],  # BE Signed int
             22: lambda x: struct.unpack('>B', x)[0],  # BE Unsigned int
             23: lambda x: struct.unpack('>f', x)[0],  # BE Float32
@@ -263,14 +405,14 @@ class MP4(TinyTag):
             # this atom also contains the esds atom:
             # https://ffmpeg.org/doxygen/0.6/mov_8c-source.html
             # http://xhelmboyx.tripod.com/formats/mp4-layout.txt
-            datafh = BytesIO(data)
+            datafh = _sub_reader(data)
             datafh.seek(16, os.SEEK_CUR)  # jump over version and flags
             channels = struct.unpack('>H', datafh.read(2))[0]
             datafh.seek(2, os.SEEK_CUR)   # jump over bit_depth
             datafh.seek(2, os.SEEK_CUR)   # jump over QT compr id & pkt size
             sr = struct.unpack('>I', datafh.read(4))[0]
             esds_atom_size = struct.unpack('>I', data[28:32])[0]
-            esds_atom = BytesIO(data[36:36 + esds_atom_size])
+            esds_atom = _sub_reader(data[36:36 + esds_atom_size])
             # http://sasperger.tistory.com/103
             esds_atom.seek(22, os.SEEK_CUR)  # jump over most data...
             esds_atom.seek(4, os.SEEK_CUR)   # jump over max bitrate
@@ -280,7 +422,7 @@ class MP4(TinyTag):
         @classmethod
         def parse_mvhd(cls, data):
             # http://stackoverflow.com/a/3639993/1191373
-            walker = BytesIO(data)
+            walker = _sub_reader(data)
             version = struct.unpack('b', walker.read(1))[0]
             walker.seek(3, os.SEEK_CUR)  # jump over flags
             if version == 0:  # uses 32 bit integers for timestamps
@@ -395,10 +537,15 @@ class ID3(TinyTag):
         'TPE2': 'albumartist', 'TCOM': 'composer',
     }
     IMAGE_FRAME_IDS = {'APIC', 'PIC'}
+    CHAPTER_FRAME_ID = 'CHAP'
     PARSABLE_FRAME_IDS = set(FRAME_ID_TO_FIELD.keys()).union(IMAGE_FRAME_IDS)
     _MAX_ESTIMATION_SEC = 30
     _CBR_DETECTION_FRAME_COUNT = 5
     _USE_XING_HEADER = True  # much faster, but can be deactivated for testing
+    _FRAME_BLOCK_SIZE = 256 * 1024  # bytes read at once when walking mp3 frames
+    # a frame (or the part of the first frame holding a xing header) must be
+    # buffered before it is parsed
+    _MAX_FRAME_HEADER_BYTES = 2048
 
     ID3V1_GENRES = [
         'Blues', 'Classic Rock', 'Country', 'Dance', 'Disco',
@@ -475,6 +622,15 @@ class ID3(TinyTag):
         [None, v1l3, v1l2, v1l1],  # MPEG Version 1    # reserved
     ]
     samples_per_frame = 1152  # the default frame size for mp3
+    samples_per_frame_by_version_by_layer = [
+        [None, 576, 1152, 384],   # MPEG Version 2.5
+        None,                     # reserved
+        [None, 576, 1152, 384],   # MPEG Version 2
+        [None, 1152, 1152, 384],  # MPEG Version 1
+    ]
+    # layer 3 side information size (the xing/info header follows it) by
+    # version, mono/stereo
+    side_info_size_by_version = [(17, 9), None, (17, 9), (32, 17)]
     channels_per_channel_mode = [
         2,  # 00 Stereo
         2,  # 01 Joint stereo (Stereo)
@@ -483,36 +639,99 @@ class ID3(TinyTag):
     ]
 
     @staticmethod
-    def _parse_xing_header(fh):
+    def _parse_xing_header(buf, offset):
         # see: http://www.mp3-tech.org/programmer/sources/vbrheadersdk.zip
-        fh.seek(4, os.SEEK_CUR)  # read over Xing header
-        header_flags = struct.unpack('>i', fh.read(4))[0]
+        offset += 4  # read over Xing header
+        header_flags = struct.unpack_from('>i', buf, offset)[0]
+        offset += 4
         frames = byte_count = toc = vbr_scale = None
         if header_flags & 1:  # FRAMES FLAG
-            frames = struct.unpack('>i', fh.read(4))[0]
+            frames = struct.unpack_from('>i', buf, offset)[0]
+            offset += 4
         if header_flags & 2:  # BYTES FLAG
-            byte_count = struct.unpack('>i', fh.read(4))[0]
+            byte_count = struct.unpack_from('>i', buf, offset)[0]
+            offset += 4
         if header_flags & 4:  # TOC FLAG
-            toc = [struct.unpack('>i', fh.read(4))[0] for _ in range(100)]
+            toc = list(bytearray(buf[offset:offset + 100]))
+            offset += 100
         if header_flags & 8:  # VBR SCALE FLAG
-            vbr_scale = struct.unpack('>i', fh.read(4))[0]
-        return frames, byte_count, toc, vbr_scale
+            vbr_scale = struct.unpack_from('>i', buf, offset)[0]
+            offset += 4
+        return frames, byte_count, toc, vbr_scale, offset
+
+    @staticmethod
+    def _parse_lame_header(buf, offset):
+        # LAME extension directly following a xing/info header, also written
+        # by ffmpeg. see: http://gabriel.mp3-tech.org/mp3infotag.html
+        if buf[offset:offset + 4] not in (b'LAME', b'Lavc', b'Lavf', b'Lavu'):
+            return 0, 0
+        delays = buf[offset + 21:offset + 24]
+        if len(delays) < 3:
+            return 0, 0
+        delays = _bytes_to_int(bytearray(delays))
+        return delays >> 12, delays & 0xFFF  # encoder delay, padding (samples)
+
+    @staticmethod
+    def _parse_vbri_header(buf, offset):
+        # Fraunhofer encoder header, 32 bytes after the frame header
+        # see: http://www.codeproject.com/Articles/8295/MPEG-Audio-Frame-Header
+        vbri = buf[offset:offset + 18]
+        if len(vbri) < 18 or vbri[:4] != b'VBRI':
+            return None
+        _, version, delay, quality, byte_count, frames = struct.unpack('>4sHHHII', vbri)
+        return frames, byte_count, offset + 18
+
+    def _parse_vbr_header(self, buf, i, frame_length, mpeg_id, layer_id, channel_mode):
+        """find a xing, info or vbri header in the frame starting at buf[i];
+        returns frames, bytes, encoder delay, padding and the end position of
+        the header, None if the frame has no such header"""
+        if layer_id == 1:  # layer 3: headers are at a known position
+            side_info = ID3.side_info_size_by_version[mpeg_id][channel_mode == 3]
+            offset = i + 4 + side_info
+            if buf[offset:offset + 4] not in (b'Xing', b'Info'):
+                offset = -1
+        else:
+            offset = -1
+        if offset == -1:
+            offset = buf.find(b'Xing', i, i + frame_length)
+        if offset != -1:
+            xframes, byte_count, toc, vbr_scale, end = ID3._parse_xing_header(buf, offset)
+            enc_delay, enc_padding = ID3._parse_lame_header(buf, end)
+            return xframes, byte_count, enc_delay, enc_padding, end
+        vbri = ID3._parse_vbri_header(buf, i + 36)
+        if vbri:
+            return vbri[0], vbri[1], 0, 0, vbri[2]
+        return None
 
     def _determine_duration(self, fh):
         max_estimation_frames = (ID3._MAX_ESTIMATION_SEC * 44100) // ID3.samples_per_frame
         frame_size_accu = 0
-        header_bytes = 4
         frames = 0  # count frames for determining mp3 duration
         bitrate_accu = 0    # add up bitrates to find average bitrate to detect
         last_bitrates = []  # CBR mp3s (multiple frames with same bitrates)
-        # seek to first position after id3 tag (speedup for large header)
-        fh.seek(self._bytepos_after_id3v2)
+        # frame headers are parsed from blocks read into memory, instead of a
+        # peek and seek per frame. start after id3 tag (speedup for large header)
+        pos = self._bytepos_after_id3v2  # file position of the current header
+        buf = b''
+        buf_pos = pos  # file position of buf[0]
+        eof = False    # buf reaches the end of the file
+        seek_times = self._seek_times
+        samples = 0  # samples before the current frame
+        vbr_header_skipped = False
+        if isinstance(fh, _MemoryReader) and hasattr(fh.buffer, 'find'):
+            buf, buf_pos, eof = fh.buffer, 0, True  # whole file is addressable
         while True:
-            # reading through garbage until 11 '1' sync-bits are found
-            b = fh.peek(4)
-            if len(b) < 4:
+            i = pos - buf_pos
+            if i + ID3._MAX_FRAME_HEADER_BYTES > len(buf) and not eof:
+                fh.seek(pos)  # current frame might not be buffered, read block
+                buf = fh.read(ID3._FRAME_BLOCK_SIZE)
+                buf_pos = pos
+                eof = len(buf) < ID3._FRAME_BLOCK_SIZE
+                i = 0
+            if i + 4 > len(buf):
                 break  # EOF
-            sync, conf, bitrate_freq, rest = struct.unpack('BBBB', b[0:4])
+            # reading through garbage until 11 '1' sync-bits are found
+            sync, conf, bitrate_freq, rest = buf[i], buf[i + 1], buf[i + 2], buf[i + 3]
             br_id = (bitrate_freq >> 4) & 0x0F  # biterate id
             sr_id = (bitrate_freq >> 2) & 0x03  # sample rate id
             padding = 1 if bitrate_freq & 0x02 > 0 else 0
@@ -520,11 +739,11 @@ class ID3(TinyTag):
             layer_id = (conf >> 1) & 0x03
             channel_mode = (rest >> 6) & 0x03
             # check for eleven 1s, validate bitrate and sample rate
-            if not b[:2] > b'\xFF\xE0' or br_id > 14 or br_id == 0 or sr_id == 3 or layer_id == 0 or mpeg_id == 1:
-                idx = b.find(b'\xFF', 1)  # invalid frame, find next sync header
+            if sync != 0xFF or conf <= 0xE0 or br_id > 14 or br_id == 0 or sr_id == 3 or layer_id == 0 or mpeg_id == 1:
+                idx = buf.find(b'\xFF', i + 1)  # invalid frame, find next sync header
                 if idx == -1:
-                    idx = len(b)  # not found: jump over the current peek buffer
-                fh.seek(max(idx, 1), os.SEEK_CUR)
+                    idx = len(buf)  # not found: jump over the current block
+                pos = buf_pos + idx
                 continue
             try:
                 self.channels = self.channels_per_channel_mode[channel_mode]
@@ -532,53 +751,73 @@ class ID3(TinyTag):
                 self.samplerate = ID3.samplerates[mpeg_id][sr_id]
             except (IndexError, TypeError):
                 raise TinyTagException('mp3 parsing failed')
-            # There might be a xing header in the first frame that contains
-            # all the info we need, otherwise parse multiple frames to find the
-            # accurate average bitrate
-            if frames == 0 and ID3._USE_XING_HEADER:
-                xing_header_offset = b.find(b'Xing')
-                if xing_header_offset != -1:
-                    fh.seek(xing_header_offset, os.SEEK_CUR)
-                    xframes, byte_count, toc, vbr_scale = ID3._parse_xing_header(fh)
-                    if xframes and xframes != 0 and byte_count:
-                        self.duration = xframes * ID3.samples_per_frame / float(self.samplerate)
+            spf = ID3.samples_per_frame_by_version_by_layer[mpeg_id][layer_id]
+            if layer_id == 3:  # layer 1: 4 byte slots
+                frame_length = ((12000 * frame_bitrate) // self.samplerate + padding) * 4
+            else:  # spf / 8 bytes per kbit/s, e.g. 144000 for mpeg 1 layer 3
+                frame_length = (spf * 125 * frame_bitrate) // self.samplerate + padding
+            # There might be a xing, info (CBR) or vbri header in the first
+            # frame that contains all the info we need, otherwise parse multiple
+            # frames to find the accurate average bitrate
+            if frames == 0 and ID3._USE_XING_HEADER and not vbr_header_skipped:
+                vbr_header = self._parse_vbr_header(buf, i, frame_length, mpeg_id, layer_id, channel_mode)
+                if vbr_header and seek_times is not None:
+                    # the header frame holds no audio, seek offsets are found
+                    # by walking the frames after it
+                    vbr_header_skipped = True
+                    pos += frame_length
+                    continue
+                if vbr_header:
+                    xframes, byte_count, enc_delay, enc_padding, end = vbr_header
+                    if xframes and xframes > 0 and byte_count:
+                        samples = xframes * spf
+                        if samples > enc_delay + enc_padding:  # gapless info
+                            samples -= enc_delay + enc_padding
+                        self.duration = samples / float(self.samplerate)
                         self.bitrate = byte_count * 8 / self.duration / 1000
-                        self.audio_offset = fh.tell()
+                        self.audio_offset = pos + frame_length  # after header frame
                         return
+                    pos = buf_pos + end
                     continue
 
+            if seek_times is not None:
+                frame_time = samples / float(self.samplerate)
+                while (len(self._seek_offsets) < len(seek_times) and
+                       frame_time >= seek_times[len(self._seek_offsets)]):
+                    self._seek_offsets.append((frame_time, pos))
+            samples += spf
             frames += 1  # it's most probably an mp3 frame
             bitrate_accu += frame_bitrate
             if frames == 1:
-                self.audio_offset = fh.tell()
+                self.audio_offset = pos
             if frames <= ID3._CBR_DETECTION_FRAME_COUNT:
                 last_bitrates.append(frame_bitrate)
-            fh.seek(4, os.SEEK_CUR)  # jump over peeked bytes
 
-            frame_length = (144000 * frame_bitrate) // self.samplerate + padding
             frame_size_accu += frame_length
             # if bitrate does not change over time its probably CBR
             is_cbr = (frames == ID3._CBR_DETECTION_FRAME_COUNT and
                       len(set(last_bitrates)) == 1)
-            if frames == max_estimation_frames or is_cbr:
+            if (frames == max_estimation_frames or is_cbr) and not self._exact_duration:
                 # try to estimate duration
                 fh.seek(-128, 2)  # jump to last byte (leaving out id3v1 tag)
                 audio_stream_size = fh.tell() - self.audio_offset
                 est_frame_count = audio_stream_size / (frame_size_accu / float(frames))
-                samples = est_frame_count * ID3.samples_per_frame
+                samples = est_frame_count * spf
                 self.duration = samples / float(self.samplerate)
                 self.bitrate = bitrate_accu / frames
                 return
 
-            if frame_length > 1:  # jump over current frame body
-                fh.seek(frame_length - header_bytes, os.SEEK_CUR)
+            pos += frame_length  # jump over current frame
         if self.samplerate:
-            self.duration = frames * ID3.samples_per_frame / float(self.samplerate)
+            self.duration = samples / float(self.samplerate)
 
     def _parse_tag(self, fh):
         self._parse_id3v2(fh)
-        has_all_tags = all((self.track, self.track_total, self.title,
-            self.artist, self.album, self.albumartist, self.year, self.genre))
+        if self._fields is not None:
+            has_all_tags = self._has_wanted_fields()
+        else:
+            has_all_tags = all((self.track, self.track_total, self.title,
+                self.artist, self.album, self.albumartist, self.year, self.genre))
         if not has_all_tags and self.filesize > 128:
             fh.seek(-128, os.SEEK_END)  # try parsing id3v1 in last 128 bytes
             self._parse_id3v1(fh)
@@ -609,6 +848,9 @@ class ID3(TinyTag):
                 if frame_size == 0:
                     break
                 parsed_size += frame_size
+                if (self._has_wanted_fields() and not self._load_image and
+                        not self._load_chapters):
+                    break  # everything requested was found, skip the rest
             fh.seek(end_pos, os.SEEK_SET)
 
     def _parse_id3v1(self, fh):
@@ -621,11 +863,11 @@ class ID3(TinyTag):
             self._set_field('album', fields[60:90], transfunc=asciidecode)
             self._set_field('year', fields[90:94], transfunc=asciidecode)
             comment = fields[94:124]
-            if b'\x00\x00' < comment[-2:] < b'\x01\x00':
-                self._set_field('track', str(ord(comment[-1:])))
+            if comment[-2] == 0 and comment[-1] != 0:
+                self._set_field('track', str(comment[-1]))
                 comment = comment[:-2]
             self._set_field('comment', comment, transfunc=asciidecode)
-            genre_id = ord(fields[124:125])
+            genre_id = fields[124]
             if genre_id < len(ID3.ID3V1_GENRES):
                 self.genre = ID3.ID3V1_GENRES[genre_id]
 
@@ -645,14 +887,23 @@ class ID3(TinyTag):
             stderr('Found id3 Frame %s at %d-%d of %d' % (frame_id, fh.tell(), fh.tell() + frame_size, self.filesize))
         if frame_size > 0:
             # flags = frame[1+frame_size_bytes:] # dont care about flags.
-            if frame_id not in ID3.PARSABLE_FRAME_IDS:  # jump over unparsable frames
+            fieldname = ID3.FRAME_ID_TO_FIELD.get(frame_id)
+            if fieldname:
+                parse = self._wants_field(fieldname)
+            elif frame_id == self.CHAPTER_FRAME_ID:
+                parse = self._load_chapters
+            else:
+                parse = frame_id in self.IMAGE_FRAME_IDS and self._load_image
+            if not parse:  # jump over unparsable, unwanted and image frames
                 fh.seek(frame_size, os.SEEK_CUR)
                 return frame_size
             content = fh.read(frame_size)
-            fieldname = ID3.FRAME_ID_TO_FIELD.get(frame_id)
             if fieldname:
                 self._set_field(fieldname, content, self._decode_string)
-            elif frame_id in self.IMAGE_FRAME_IDS and self._load_image:
+            elif frame_id == self.CHAPTER_FRAME_ID:
+                self._parse_chapter(bytes(content), id3version)
+            else:
+                content = bytes(content)  # may be a view of an mmap
                 # See section 4.14: http://id3.org/id3v2.4.0-frames
                 if frame_id == 'PIC':  # ID3 v2.2:
                     desc_end_pos = content.index(b'\x00', 1) + 1
@@ -666,6 +917,22 @@ class ID3(TinyTag):
             return frame_size
         return 0
 
+    def _parse_chapter(self, content, id3version):
+        # see: https://id3.org/id3v2-chapters-1.0
+        id_end_pos = content.find(b'\x00')
+        if id_end_pos == -1 or len(content) < id_end_pos + 17:
+            return
+        start, end = struct.unpack('>II', content[id_end_pos + 1:id_end_pos + 9])
+        # embedded frames follow the fixed fields, only the title is used
+        sub = ID3(_sub_reader(content[id_end_pos + 17:]), 0,
+                  ignore_errors=self._ignore_errors)
+        sub._fields = {'title'}
+        while sub._parse_frame(sub._filehandler, id3version=id3version):
+            pass
+        self._chapters.append({'title': sub.title, 'start': start / 1000.0,
+                               'end': end / 1000.0})
+        self._chapters.sort(key=lambda c: c['start'])
+
     def _decode_string(self, b):
         try:  # it's not my fault, this is the spec.
             first_byte = b[:1]
@@ -728,7 +995,7 @@ class Ogg(TinyTag):
     def _parse_tag(self, fh):
         page_start_pos = fh.tell()  # set audio_offest later if its audio data
         for packet in self._parse_pages(fh):
-            walker = BytesIO(packet)
+            walker = _sub_reader(packet)
             if packet[0:7] == b"\x01vorbis":
                 (channels, self.samplerate, max_bitrate, bitrate,
                  min_bitrate) = struct.unpack("<B4i", packet[11:28])
@@ -799,14 +1066,14 @@ class Ogg(TinyTag):
             for segsize in segsizes:  # read all segments
                 total += segsize
                 if total < 255:  # less than 255 bytes means end of page
-                    yield previous_page + fh.read(total)
+                    yield previous_page + fh.read(total) if previous_page else fh.read(total)
                     previous_page = b''
                     total = 0
             if total != 0:
                 if total % 255 == 0:
                     previous_page += fh.read(total)
                 else:
-                    yield previous_page + fh.read(total)
+                    yield previous_page + fh.read(total) if previous_page else fh.read(total)
                     previous_page = b''
             header_data = fh.read(27)
 
@@ -854,11 +1121,11 @@ class Wave(TinyTag):
                 if is_info != b'INFO':  # jump over non-INFO sections
                     fh.seek(subchunksize - 4, os.SEEK_CUR)
                 else:
-                    sub_fh = BytesIO(fh.read(subchunksize - 4))
+                    sub_fh = _sub_reader(fh.read(subchunksize - 4))
                     field = sub_fh.read(4)
                     while len(field):
                         data_length = struct.unpack('I', sub_fh.read(4))[0]
-                        data = sub_fh.read(data_length).split(b'\x00', 1)[0]  # strip zero-byte
+                        data = bytes(sub_fh.read(data_length)).split(b'\x00', 1)[0]  # strip zero-byte
                         data = codecs.decode(data, 'utf-8')
                         fieldname = self.riff_mapping.get(field)
                         if fieldname:
@@ -882,7 +1149,8 @@ class Flac(TinyTag):
     METADATA_STREAMINFO = 0
     METADATA_VORBIS_COMMENT = 4
 
-    def load(self, tags, duration, image=False):
+    def load(self, tags, duration, image=False, fields=None, exact_duration=False,
+             chapters=False, seek_times=None):
         header = self._filehandler.peek(4)
         if header[:3] == b'ID3':  # parse ID3 header if it exists
             id3 = ID3(self._filehandler, 0)
@@ -997,7 +1265,7 @@ class Wma(TinyTag):
         if value_type == 0:  # Unicode string
             return self.__decode_string(value)
         elif value_type == 1:  # BYTE array
-            return value
+            return bytes(value)
         elif 1 < value_type < 6:  # DWORD / QWORD / WORD
             return _bytes_to_int_le(value)
 
@@ -1,32 +1,386 @@
+import functools
 import json
 import os
 import re
 import sys
+import threading
 import xml.etree.cElementTree as ET
 from collections import OrderedDict
 from datetime import date, timedelta
 from flask import Flask, request, Response, send_file, send_from_directory
+from werkzeug.datastructures import ContentRange
 from xml.dom import minidom
 
+# number of per-book cache shards kept in memory
+SHARD_CACHE_SIZE = 32
+
+# read size when streaming byte ranges of a file
+RANGE_CHUNK_SIZE = 256 * 1024
+
+# version of the cache layout written by scans, older caches are upgraded in
+# place when read (see _UPGRADES)
+CACHE_VERSION = 3
+
+class _CachedFile:
+    def __init__(self, fd, st):
+        '''
+        Open descriptor :fd: and its stat result :st:, with count of responses
+        reading from it
+        '''
+        self.fd = fd
+        self.st = st
+        self.refs = 0
+        self.evicted = False
+
+class FileCache:
+    def __init__(self, size=64):
+        '''
+        Bounded LRU of :size: open track descriptors and their stat results,
+        keyed by file hash and path (copies of a track, e.g. one stored in an
+        archive, share its hash); entries are dropped when the cache
+        generation changes, descriptors still being read are closed once
+        released
+        '''
+        self._size = size
+        self._lock = threading.Lock()
+        self._files = OrderedDict() # (key, path): _CachedFile
+        self._generation = None
+
+        self._stats = {
+            'hits':             0,
+            'opens':            0,
+            'evictions':        0,
+            'invalidations':    0
+        }
+
+    def set_generation(self, generation):
+        '''
+        Drop all entries if :generation: differs from the cached files' one
+        '''
+        with self._lock:
+            if generation == self._generation:
+                return
+            if self._generation is not None:
+                self._stats['invalidations'] += 1
+            for entry in self._files.values():
+                self._evict(entry)
+            self._files.clear()
+            self._generation = generation
+
+    def acquire(self, key, path):
+        '''
+        Return _CachedFile of track :key: at :path:, opening it if not cached;
+        must be released when done
+        '''
+        key = (key, path)
+        with self._lock:
+            entry = self._files.get(key)
+            if entry:
+                self._files.move_to_end(key)
+                self._stats['hits'] += 1
+                entry.refs += 1
+                return entry
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            entry = _CachedFile(fd, os.fstat(fd))
+        except OSError:
+            os.close(fd)
+            raise
+        entry.refs = 1
+
+        with self._lock:
+            self._stats['opens'] += 1
+            if key in self._files:
+                # opened concurrently, keep the cached one
+                entry.evicted = True
+                return entry
+            self._files[key] = entry
+            while len(self._files) > self._size:
+                self._evict(self._files.popitem(last=False)[1])
+                self._stats['evictions'] += 1
+
+        return entry
+
+    def release(self, entry):
+        '''
+        Release :entry: acquired by acquire, closing it if evicted meanwhile
+        '''
+        with self._lock:
+            entry.refs -= 1
+            if entry.evicted and not entry.refs:
+                os.close(entry.fd)
+
+    def stat(self, key, path):
+        '''
+        Return stat result of track :key: at :path:
+        '''
+        entry = self.acquire(key, path)
+        self.release(entry)
+
+        return entry.st
+
+    def stats(self):
+        '''
+        Return dict of file cache counters and open descriptors
+        '''
+        with self._lock:
+            ret = dict(self._stats)
+            ret['open'] = len(self._files)
+
+        return ret
+
+    def _evict(self, entry):
+        '''
+        Close :entry: unless being read, in which case its last release does;
+        caller must hold the lock
+        '''
+        entry.evicted = True
+        if not entry.refs:
+            os.close(entry.fd)
+
+class SingleFlight:
+    def __init__(self):
+        '''
+        Coalesce concurrent calls sharing a key into a single computation;
+        callers arriving while it is in progress wait for and share its result
+        '''
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args):
+        '''
+        Return fn(*args), or the result of the in-progress call for :key:
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn(*args)
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+        return call['result']
+
+_flight = SingleFlight()
+_loaded = {} # json_path: (cache generation, books)
+
+def _load_cache(json_path):
+    '''
+    Return books dict of cache at :json_path:, sorted by title
+    '''
+    generation = cache_generation(json_path)
+    try:
+        with open(json_path, 'r') as cache:
+            data = json.load(cache)
+    except Exception:
+        raise ValueError('error loading JSON cache')
+
+    books = upgrade_cache(json_path, data, generation)
+    books = OrderedDict(sorted(
+        books.items(),
+        key=lambda x: x[1]['title']
+    ))
+
+    return books
+
+def cache_generation(json_path):
+    '''
+    Return generation of cache at :json_path:, changes whenever it is written
+    '''
+    try:
+        st = os.stat(json_path)
+    except FileNotFoundError:
+        raise ValueError('cache not found, run ./roka.py --scan')
+
+    # cache is replaced atomically, new generation means new mtime/size
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
 def read_cache(json_path):
     '''
-    Populate books dict from cache at :json_path:
+    Populate books dict from cache at :json_path:; each cache generation is
+    loaded once, concurrent loads of a new generation are coalesced
+    '''
+    generation = cache_generation(json_path)
+    loaded = _loaded.get(json_path)
+    if loaded and loaded[0] == generation:
+        return loaded[1]
+
+    books = _flight.do((json_path, generation), _load_cache, json_path)
+    _loaded[json_path] = (generation, books)
+
+    return books
+
+def get_shard_path(json_path, book):
+    '''
+    Return path of the per-book cache shard of :book: stored alongside the
+    cache index at :json_path:
     '''
-    if os.path.exists(json_path):
+    return os.path.join(os.path.dirname(json_path), 'books', book + '.json')
+
+@functools.lru_cache(maxsize=SHARD_CACHE_SIZE)
+def _load_shard(shard_path, mtime):
+    '''
+    Return parsed contents of :shard_path:; :mtime: is part of the LRU key so a
+    rewritten shard is never served stale
+    '''
+    with open(shard_path, 'r') as shard:
+        return json.load(shard)
+
+def read_book(json_path, book):
+    '''
+    Return book dict (including tracks) of :book: from its cache shard, None if
+    the book isn't cached
+    '''
+    # book hash is user-provided, keep it from escaping the shard directory
+    if not re.fullmatch('[0-9a-f]+', book):
+        return None
+
+    shard_path = get_shard_path(json_path, book)
+    try:
+        mtime = os.stat(shard_path).st_mtime_ns
+    except FileNotFoundError:
+        # an older monolithic cache is split into shards by its first read;
+        # books that couldn't be split keep their tracks in the index
+        entry = _read_entry(json_path, book)
+        if not entry or 'files' in entry:
+            return entry
         try:
-            with open(json_path, 'r') as cache:
-                books = json.load(cache)
-            books = OrderedDict(sorted(
-                books.items(),
-                key=lambda x: x[1]['title']
-            ))
-        except Exception:
-            raise ValueError('error loading JSON cache')
-    else:
-        raise ValueError('cache not found, run ./roka.py --scan')
+            mtime = os.stat(shard_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    try:
+        return _load_shard(shard_path, mtime)
+    except Exception:
+        raise ValueError('error loading JSON cache shard')
+
+def _read_entry(json_path, book):
+    '''
+    Return cache index entry of :book:, upgrading the cache if it is of an
+    older version; None if the book isn't cached
+    '''
+    if not os.path.exists(json_path):
+        return None
+
+    return read_cache(json_path).get(book)
+
+def index_entry(book):
+    '''
+    Return copy of :book: suitable for the cache index, tracks replaced by
+    their count
+    '''
+    entry = {k: v for k, v in book.items() if k != 'files'}
+    if 'files' in book:
+        entry['tracks'] = len(book['files'])
+
+    return entry
+
+def _split_shards(json_path, books):
+    '''
+    Upgrade version 1 (monolithic, tracks stored in the index) to 2: move each
+    book to its shard, the index keeps its track count
+
+    Books whose shard can't be written (read-only cache) keep their tracks in
+    the index, read_book serves them from there
+    '''
+    for b_key, book in books.items():
+        if 'files' not in book:
+            continue
+        entry = index_entry(book)
+        try:
+            os.makedirs(os.path.dirname(get_shard_path(json_path, '')),
+                        exist_ok=True)
+            write_json(get_shard_path(json_path, b_key), book)
+        except OSError:
+            entry['files'] = book['files']
+        books[b_key] = entry
+
+    return books
 
+def _add_version(json_path, books):
+    '''
+    Upgrade version 2 (unversioned) to 3: books are unchanged, the index
+    records its version
+    '''
     return books
 
+# upgrade from each version to the next, given the cache path and books dict
+# of that version; upgrades may only derive fields from cached data or tag
+# headers, never re-hash tracks. Shards are upgraded along with the index,
+# which is written last
+_UPGRADES = {
+    1: _split_shards,
+    2: _add_version
+}
+
+def get_cache_version(data):
+    '''
+    Return version of parsed cache index :data:; versions before 3 are a bare
+    books dict, 1 if tracks are stored in the index
+    '''
+    if isinstance(data.get('version'), int):
+        return data['version']
+    if any('files' in x for x in data.values()):
+        return 1
+
+    return 2
+
+def upgrade_cache(json_path, data, generation=None):
+    '''
+    Return books dict of parsed cache index :data: of :json_path:, upgrading
+    older versions to CACHE_VERSION and writing the result in place
+
+    :generation: cache generation :data: was read at; the upgrade isn't
+                 written if the cache was replaced meanwhile (e.g. by a scan)
+    '''
+    version = get_cache_version(data)
+    if version > CACHE_VERSION:
+        raise ValueError('cache version %d is newer than supported (%d)' %
+                         (version, CACHE_VERSION))
+    books = data['books'] if version >= 3 else data
+    if version == CACHE_VERSION:
+        return books
+
+    for v in range(version, CACHE_VERSION):
+        books = _UPGRADES[v](json_path, books)
+
+    # an index still holding tracks of unsplit books isn't written, the upgrade
+    # is retried by the next reader instead
+    if any('files' in x for x in books.values()):
+        return books
+    try:
+        if generation is None or cache_generation(json_path) == generation:
+            write_json(json_path, {'version': CACHE_VERSION, 'books': books})
+    except OSError:
+        # read-only cache, serve it upgraded in memory
+        pass
+
+    return books
+
+def write_json(path, data):
+    '''
+    Atomically replace :path: with JSON dump of :data:
+    '''
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
 def check_auth(app, username, password):
     '''
     Authenticate against configured user/pass
@@ -78,58 +432,151 @@ def escape(s):
 
     return s
 
-def generate_rss(base_url, book, books, static=False):
-    # we only make use of the itunes ns, others provided for posterity
-    namespaces = {
-        'itunes':'http://www.itunes.com/dtds/podcast-1.0.dtd',
-        'googleplay':'http://www.google.com/schemas/play-podcasts/1.0',
-        'atom':'http://www.w3.org/2005/Atom',
-        'media':'http://search.yahoo.com/mrss/',
-        'content':'http://purl.org/rss/1.0/modules/content/',
-    }
+def _read_range(path, offset, length, fds=None, key=None):
+    '''
+    Yield :length: bytes of file at :path: starting at :offset:, read from its
+    descriptor in FileCache :fds: (as :key:) if given
+    '''
+    # acquired on first read, an unstarted response holds nothing
+    if fds:
+        entry = fds.acquire(key, path)
+        fd = entry.fd
+    else:
+        fd = os.open(path, os.O_RDONLY)
+    try:
+        while length > 0:
+            data = os.pread(fd, min(length, RANGE_CHUNK_SIZE), offset)
+            if not data:
+                break
+            offset += len(data)
+            length -= len(data)
+            yield data
+    finally:
+        if fds:
+            fds.release(entry)
+        else:
+            os.close(fd)
 
-    rss = ET.Element('rss')
-    for k, v in namespaces.items():
-        rss.set('xmlns:%s' % k, v)
-    rss.set('version', '2.0')
+def send_range(path, offset, length, mimetype='audio/mpeg', shaper=None,
+               client=None, fds=None, key=None):
+    '''
+    Return response serving :length: bytes (None for the rest of the file) of
+    file at :path: from :offset: as a file of its own, honouring Range and
+    conditional request headers
 
-    channel = ET.SubElement(rss, 'channel')
+    :shaper: optional Shaper limiting bandwidth of the response to :client:
+    :fds: optional FileCache the file is opened and stat'ed from, as :key:
+    '''
+    st = fds.stat(key, path) if fds else os.stat(path)
+    if length is None:
+        length = st.st_size - offset
+    etag = '%x-%x-%x-%x' % (st.st_mtime_ns, st.st_size, offset, length)
 
-    book_title = ET.SubElement(channel, 'title')
-    book_title.text = escape(books[book]['title'])
+    rv = Response(mimetype=mimetype)
+    rv.set_etag(etag)
+    rv.last_modified = int(st.st_mtime)
+    rv.accept_ranges = 'bytes'
+    if etag in request.if_none_match:
+        rv.status_code = 304
+        return rv
+
+    start, stop = 0, length
+    # a range request only applies to the same slice (If-Range)
+    if_range = request.if_range
+    if request.range and (if_range.etag in (None, etag) and not if_range.date):
+        rng = request.range.range_for_length(length)
+        if rng is None and len(request.range.ranges) == 1:
+            rv.status_code = 416
+            rv.content_range = ContentRange('bytes', None, None, length)
+            return rv
+        if rng is not None:
+            start, stop = rng
+            rv.status_code = 206
+            rv.content_range = ContentRange('bytes', start, stop, length)
+
+    rv.response = _read_range(path, offset + start, stop - start, fds, key)
+    if shaper:
+        rv.response = shaper.stream(client, rv.response)
+    rv.content_length = stop - start
+    rv.direct_passthrough = True
+
+    return rv
 
+def sort_tracks(book):
+    '''
+    Return file hashes of :book: in feed (listening) order
+    '''
     # use filename sort if ignore_tracknum file present in book dir
-    ignore_tracknum = os.path.join(books[book]['path'], 'ignore_tracknum')
+    ignore_tracknum = os.path.join(book['path'], 'ignore_tracknum')
     if os.path.exists(ignore_tracknum):
         # remove leading zeros from digits (natural sort)
         conv = lambda s: [int(x) if x.isdigit() else x.lower() for x in
             re.split('(\d+)', s)]
-        key = lambda x: conv(books[book]['files'][x]['filename'])
+        key = lambda x: conv(book['files'][x]['filename'])
     else:
         # sort by track number, alphanumerically if track is absent
         track_list = [] # account for duplicates
-        for a_file in books[book]['files']:
-            track = books[book]['files'][a_file]['track']
+        for a_file in book['files']:
+            track = book['files'][a_file]['track']
             if not track or track in track_list:
                 # remove leading zeros from digits (natural sort)
                 conv = lambda s: [int(x) if x.isdigit() else x.lower()
                         for x in re.split('(\d+)', s)]
-                key = lambda x: conv(books[book]['files'][x]['filename'])
+                key = lambda x: conv(book['files'][x]['filename'])
                 break
             track_list.append(track)
         else:
             # we have populated and unique track values, use those
-            key = lambda x: int(books[book]['files'][x]['track'])
+            key = lambda x: int(book['files'][x]['track'])
+
+    return sorted(book['files'], key=key)
+
+def generate_rss(base_url, b_key, book, static=False):
+    # we only make use of the itunes ns, others provided for posterity
+    namespaces = {
+        'itunes':'http://www.itunes.com/dtds/podcast-1.0.dtd',
+        'googleplay':'http://www.google.com/schemas/play-podcasts/1.0',
+        'atom':'http://www.w3.org/2005/Atom',
+        'media':'http://search.yahoo.com/mrss/',
+        'content':'http://purl.org/rss/1.0/modules/content/',
+    }
+
+    rss = ET.Element('rss')
+    for k, v in namespaces.items():
+        rss.set('xmlns:%s' % k, v)
+    rss.set('version', '2.0')
+
+    channel = ET.SubElement(rss, 'channel')
+
+    book_title = ET.SubElement(channel, 'title')
+    book_title.text = escape(book['title'])
+
+    # cover art extracted during scan, served by /covers (copied if static)
+    if book.get('cover'):
+        ET.SubElement(channel, 'itunes:image',
+                      href='{}covers/{}'.format(base_url, book['cover']))
+
+    # feed items: (track, chapter index); tracks split into virtual chapters
+    # are published as one item per chapter, static feeds serve whole files
+    url_format = '{}{}/{}.mp3' if static else '{}?a={}&f={}'
+    items = []
+    for f in sort_tracks(book):
+        chapters = book['files'][f].get('chapters')
+        if chapters and not static:
+            items.extend((f, c) for c in range(len(chapters)))
+        else:
+            items.append((f, None))
 
     # populate XML attribute values required by Apple podcasts
-    for idx, f in enumerate(sorted(books[book]['files'], key=key)):
+    for idx, (f, c) in enumerate(items):
+        chapter = None if c is None else book['files'][f]['chapters'][c]
         item = ET.SubElement(channel, 'item')
 
         title = ET.SubElement(item, 'title')
-        title.text = escape(books[book]['files'][f]['title'])
+        title.text = escape((chapter or book['files'][f])['title'])
 
         author = ET.SubElement(item, 'itunes:author')
-        author.text = escape(books[book]['files'][f]['author'])
+        author.text = escape(book['files'][f]['author'])
 
         category = ET.SubElement(item, 'itunes:category')
         category.text = 'Book'
@@ -144,20 +591,22 @@ def generate_rss(base_url, book, books, static=False):
         description.text = 'Audiobook served by audiobook-rss'
 
         duration = ET.SubElement(item, 'itunes:duration')
-        duration.text = str(books[book]['files'][f]['duration_str'])
+        duration.text = str((chapter or book['files'][f])['duration_str'])
 
         guid = ET.SubElement(item, 'guid', isPermaLink='false')
-        guid.text = f # file hash
+        guid.text = f if c is None else '%s.%d' % (f, c) # file hash (chapter)
 
         # pubDate descending, day decremented w/ each iteration
         pub_date = ET.SubElement(item, 'pubDate')
         pub_format = '%a, %d %b %Y %H:%M:%S %z'
         pub_date.text = (date(2000, 12, 31) - timedelta(days=idx)).strftime(
                 pub_format)
-        url_format = '{}{}/{}.mp3' if static else '{}?a={}&f={}'
+        url = url_format.format(base_url, b_key, f)
+        if c is not None:
+            url += '&c=%d' % c
         enc_attr = {
-            'url': url_format.format(base_url, book, f),
-            'length': str(books[book]['files'][f]['size_bytes']),
+            'url': url,
+            'length': str((chapter or book['files'][f])['size_bytes']),
             'type': 'audio/mpeg'
         }
         ET.SubElement(item, 'enclosure', enc_attr)
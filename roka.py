@@ -2,12 +2,24 @@
 
 import argparse
 import os
+import re
 import shutil
+import inspect
 import json
-from flask import Flask, request, Response, render_template, send_file, templating
+import time
+from flask import (Flask, g, request, Response, jsonify, render_template,
+                   send_file, send_from_directory, stream_template, templating)
 from flask.globals import app_ctx
-from lib.books import Books
-from lib.util import check_auth, escape, generate_rss, read_cache
+from lib.accesslog import AccessLog, timed
+from lib.archive import FileSlice
+from lib.books import COVERS_PATH, Books
+from lib.prefetch import Prefetcher
+from lib.scanner import (VERIFY_INTERVAL, VERIFY_LOCK_PATH, VERIFY_RATE,
+                         Scanner, Verifier, scan_lock)
+from lib.throttle import Shaper, TokenBucket
+from lib.util import (FileCache, SingleFlight, cache_generation, check_auth,
+                      escape, generate_rss, read_book, read_cache, send_range,
+                      sort_tracks)
 
 abs_path = os.path.dirname(os.path.abspath(__file__))
 app = Flask(__name__)
@@ -17,6 +29,270 @@ if config_exists or __name__.startswith('uwsgi'):
     app.config.from_pyfile(config_path)
 cache_path = os.path.join(abs_path, 'cache')
 json_path = os.path.join(cache_path, 'audiobooks.json')
+feeds = SingleFlight()
+indexes = {} # (cache generation, SHOW_PATH): rendered book listing
+
+# rows of the book listing are sent in pieces of this many characters as
+# they are rendered
+INDEX_CHUNK_SIZE = 16 * 1024
+
+# request headers recorded by the access log, enough to replay a request
+LOGGED_HEADERS = ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since')
+
+# covers are immutable, clients may cache them for a year
+COVER_MAX_AGE = 365 * 24 * 60 * 60
+
+def get_prefetcher():
+    '''
+    Return next-track prefetcher if enabled by PREFETCH, created on first use
+    '''
+    if not app.config.get('PREFETCH', False):
+        return None
+    if 'prefetcher' not in app.extensions:
+        app.extensions['prefetcher'] = Prefetcher(
+            nbytes=app.config.get('PREFETCH_BYTES', 4 * 1024 * 1024),
+            budget=app.config.get('PREFETCH_BUDGET', 256 * 1024 * 1024))
+
+    return app.extensions['prefetcher']
+
+def get_shaper():
+    '''
+    Return download bandwidth shaper if enabled by SERVE_RATE or CLIENT_RATE,
+    created on first use
+    '''
+    rate = app.config.get('SERVE_RATE', 0)
+    client_rate = app.config.get('CLIENT_RATE', 0)
+    if not rate and not client_rate:
+        return None
+    if 'shaper' not in app.extensions:
+        app.extensions['shaper'] = Shaper(rate, client_rate)
+
+    return app.extensions['shaper']
+
+def get_file_cache():
+    '''
+    Return cache of open track descriptors if enabled by FILE_CACHE_SIZE,
+    created on first use
+    '''
+    if not app.config.get('FILE_CACHE_SIZE', 0):
+        return None
+    if 'file_cache' not in app.extensions:
+        app.extensions['file_cache'] = FileCache(app.config['FILE_CACHE_SIZE'])
+
+    return app.extensions['file_cache']
+
+def get_access_log():
+    '''
+    Return JSONL access log if enabled by ACCESS_LOG (its path), created on
+    first use
+    '''
+    if not app.config.get('ACCESS_LOG'):
+        return None
+    if 'access_log' not in app.extensions:
+        app.extensions['access_log'] = AccessLog(app.config['ACCESS_LOG'])
+
+    return app.extensions['access_log']
+
+def get_root_paths():
+    '''
+    Return list of library roots from ROOT_PATH, a directory or list of them
+    '''
+    root_path = app.config['ROOT_PATH']
+    if isinstance(root_path, str):
+        root_path = [root_path]
+
+    return [os.path.expanduser(x) for x in root_path]
+
+def get_scanner():
+    '''
+    Return background scanner if enabled by SCAN_INTERVAL, created on first use
+    '''
+    if not app.config.get('SCAN_INTERVAL', 0):
+        return None
+    if 'scanner' not in app.extensions:
+        app.extensions['scanner'] = Scanner(
+            app.config, get_root_paths(), app.config['SCAN_INTERVAL'],
+            rate=app.config.get('SCAN_RATE', 0))
+
+    return app.extensions['scanner']
+
+def get_verifier():
+    '''
+    Return background verifier if enabled by VERIFY, created on first use
+    '''
+    if not app.config.get('VERIFY', False):
+        return None
+    if 'verifier' not in app.extensions:
+        app.extensions['verifier'] = Verifier(
+            app.config,
+            interval=app.config.get('VERIFY_INTERVAL', VERIFY_INTERVAL),
+            rate=app.config.get('VERIFY_RATE', VERIFY_RATE))
+
+    return app.extensions['verifier']
+
+@app.before_request
+def start_jobs():
+    '''
+    Start background scans/verification in this process (worker) if enabled
+    '''
+    for job in (get_scanner(), get_verifier()):
+        if job:
+            job.start()
+
+@app.before_request
+def start_timing():
+    '''
+    Start per-stage timings of a request if it is logged
+    '''
+    if get_access_log():
+        g.ts = time.time()
+        g.start = time.perf_counter()
+        g.stages = {}
+
+def route_type():
+    '''
+    Return type of the current request: index, feed, track, chapter, cover,
+    stats, or other for unknown routes
+    '''
+    if request.endpoint != 'list_books':
+        return request.endpoint or 'other'
+    if request.args.get('a') and request.args.get('f'):
+        return 'chapter' if request.args.get('c') is not None else 'track'
+    if request.args.get('a'):
+        return 'feed'
+
+    return 'index'
+
+@app.after_request
+def log_request(rv):
+    '''
+    Queue access log record of the request once its response is sent, with
+    time spent by stage (ms): cache, prefetch, feed and render within handler
+    (the whole view), then send (streaming the body, which includes rendering
+    of streamed pages)
+    '''
+    access_log = get_access_log()
+    if not access_log or g.get('stages') is None:
+        return rv
+
+    handled = time.perf_counter()
+    stages = g.stages
+    stages['handler'] = handled - g.start
+    record = {
+        'ts':       round(g.ts, 3),
+        'method':   request.method,
+        'path':     request.full_path.rstrip('?'),
+        'route':    route_type(),
+        'book':     request.args.get('a'),
+        'file':     request.args.get('f'),
+        'chapter':  request.args.get('c'),
+        'status':   rv.status_code,
+        'client':   request.remote_addr,
+        'headers':  {k: request.headers[k] for k in LOGGED_HEADERS
+                     if k in request.headers}
+    }
+    sent = [rv.content_length]
+
+    def done(send=True):
+        if send:
+            stages['send'] = time.perf_counter() - handled
+        record['bytes'] = sent[0] or 0
+        record['ms'] = {k: round(v * 1e3, 3) for k, v in stages.items()}
+        access_log.log(record)
+
+    # passed through bodies skip close callbacks: ranges (send_range) are only
+    # passed through to skip encoding, send them the usual way instead; files
+    # (send_file) may be sent with sendfile, log them without send time rather
+    # than wrapping them
+    if rv.direct_passthrough and inspect.isgenerator(rv.response):
+        rv.direct_passthrough = False
+    if rv.direct_passthrough:
+        done(send=False)
+        return rv
+
+    # streamed bodies have no length up front, count them as they are sent
+    if sent[0] is None and not rv.is_sequence:
+        rv.response = counted(rv.response, sent)
+    rv.call_on_close(done)
+
+    return rv
+
+def counted(chunks, sent):
+    '''
+    Yield :chunks: of a response body, adding their length to sent[0]
+    '''
+    sent[0] = 0
+    try:
+        for chunk in chunks:
+            sent[0] += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def render_index():
+    '''
+    Return book listing response, revalidated by ETag; the listing is rendered
+    once per cache generation and SHOW_PATH, streamed as it is rendered
+    '''
+    show_path = app.config.get('SHOW_PATH', True)
+    with timed('cache'):
+        generation = cache_generation(json_path)
+    key = (generation, show_path)
+    etag = '%x-%x-%x-%d' % (*generation, show_path)
+
+    page = indexes.get(key)
+    if etag in request.if_none_match:
+        rv = Response(status=304)
+    elif page:
+        rv = Response(page, mimetype='text/html')
+    else:
+        with timed('cache'):
+            books = read_cache(json_path)
+        with timed('render'):
+            page = stream_template('index.html', books=books,
+                                   show_path=show_path)
+        rv = Response(keep_index(key, page), mimetype='text/html')
+
+    # behind authentication, browsers revalidate on every load
+    rv.set_etag(etag)
+    rv.cache_control.private = True
+    rv.cache_control.no_cache = True
+    return rv
+
+def keep_index(key, chunks):
+    '''
+    Yield rendered book listing :chunks: in INDEX_CHUNK_SIZE pieces, keeping
+    the complete page for :key:
+    '''
+    page = []
+    pending = []
+    size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        size += len(chunk)
+        if size >= INDEX_CHUNK_SIZE:
+            page.append(''.join(pending).encode())
+            yield page[-1]
+            pending = []
+            size = 0
+    page.append(''.join(pending).encode())
+    yield page[-1]
+
+    # only the latest generation is kept
+    indexes.clear()
+    indexes[key] = b''.join(page)
+
+def unauthorized():
+    '''
+    Return 401 response if request lacks configured credentials, else None
+    '''
+    auth = request.authorization
+    if not auth or not check_auth(app, auth.username, auth.password):
+        form = {'WWW-Authenticate': 'Basic realm="o/"'}
+        return Response('unauthorized', 401, form)
+
+    return None
 
 @app.route('/')
 def list_books():
@@ -25,45 +301,138 @@ def list_books():
 
     :a: audiobook hash; if provided without :f: (track) return RSS
     :f: file hash; requires associated audiobook (:a:) to download
+    :c: chapter index; optional, serves a virtual chapter of file (:f:)
 
     Listing of audiobooks returned if no params provided
     '''
-    books = read_cache(json_path)
-
     book = request.args.get('a')  # audiobook hash
     track = request.args.get('f') # file hash
+    chapter = request.args.get('c') # chapter index
 
     # audiobook and file parameters provided: serve up file
     if book and track:
-        if not books.get(book) or not books[book]['files'].get(track):
+        with timed('cache'):
+            cached = read_book(json_path, book) or {'files': {}}
+        files = cached['files']
+        if not files.get(track):
             return 'book or file not found', 404
 
-        track_path = books[book]['files'][track]['path']
+        track_path = files[track]['path']
+        offset = files[track].get('offset') # stored in an archive
+
+        # clients play tracks in feed order, warm up the start of the next one
+        prefetcher = get_prefetcher()
+        with timed('prefetch'):
+            if prefetcher:
+                prefetcher.hit(track_path, offset or 0)
+                order = sort_tracks(cached)
+                idx = order.index(track)
+                if idx + 1 < len(order):
+                    next_track = files[order[idx + 1]]
+                    prefetcher.prefetch(next_track['path'],
+                                        next_track.get('offset', 0))
+
+        # downloads are streamed through the shaper if limits are set, per
+        # client address, and read from cached descriptors if enabled
+        shaper = get_shaper()
+        fds = get_file_cache()
+        if fds:
+            with timed('cache'):
+                fds.set_generation(cache_generation(json_path))
+        serve = dict(shaper=shaper, client=request.remote_addr, fds=fds,
+                     key=track)
+
+        # virtual chapters are byte ranges of the track
+        if chapter is not None:
+            chapters = files[track].get('chapters', [])
+            if not chapter.isdigit() or int(chapter) >= len(chapters):
+                return 'chapter not found', 404
+            c = chapters[int(chapter)]
+            return send_range(track_path, c['offset'], c['size_bytes'], **serve)
+
+        if offset is not None:
+            return send_range(track_path, offset, files[track]['size_bytes'],
+                              **serve)
+        if shaper or fds:
+            return send_range(track_path, 0, None, **serve)
+
         return send_file(track_path, conditional=True)
 
     # serve up audiobook RSS feed; only audiobook hash provided
     elif book:
-        if not books.get(book):
+        with timed('cache'):
+            cached = read_book(json_path, book)
+        if not cached:
             return 'book not found', 404
 
-        rss = generate_rss(request.base_url, book, books)
-        return Response(rss, mimetype='text/xml')
+        # shards are shared between requests until rewritten, concurrent polls
+        # of the same book generation build its feed once
+        key = (request.base_url, book, id(cached))
+        with timed('feed'):
+            rss = feeds.do(key, generate_rss, request.base_url, book, cached)
+
+        # podcast apps poll feeds, revalidate them by content
+        rv = Response(rss, mimetype='text/xml')
+        rv.add_etag()
+        return rv.make_conditional(request)
 
     else:
-        auth = request.authorization
-        if not auth or not check_auth(app, auth.username, auth.password):
-            form = {'WWW-Authenticate': 'Basic realm="o/"'}
-            return Response('unauthorized', 401, form)
+        denied = unauthorized()
+        if denied:
+            return denied
+
+        return render_index()
+
+@app.route('/covers/<name>')
+def cover(name):
+    '''
+    Cover art extracted during scan; named by content hash, so never changes
+    '''
+    if not re.fullmatch('[0-9a-f]+\\.(jpg|png)', name):
+        return 'cover not found', 404
+
+    rv = send_from_directory(COVERS_PATH, name, max_age=COVER_MAX_AGE)
+    rv.cache_control.immutable = True
+    return rv
 
-        return render_template('index.html', books=books,
-                               show_path=app.config.get('SHOW_PATH', True))
+@app.route('/stats')
+def stats():
+    '''
+    Runtime counters of optional serving features, requires authentication
+    '''
+    denied = unauthorized()
+    if denied:
+        return denied
+
+    ret = {}
+    prefetcher = get_prefetcher()
+    if prefetcher:
+        ret['prefetch'] = prefetcher.stats()
+    scanner = get_scanner()
+    if scanner:
+        ret['scan'] = scanner.stats()
+    verifier = get_verifier()
+    if verifier:
+        ret['verify'] = verifier.stats()
+    shaper = get_shaper()
+    if shaper:
+        ret['shaping'] = shaper.stats()
+    fds = get_file_cache()
+    if fds:
+        ret['file_cache'] = fds.stats()
+    access_log = get_access_log()
+    if access_log:
+        ret['access_log'] = access_log.stats()
+
+    return jsonify(ret)
 
 def generate(static_path, base_url, audiobook_dirs):
     static_index_path = os.path.join(static_path, 'index.html')
 
-    books = Books()
-    books.scan_books(audiobook_dirs)
-    books.write_cache()
+    with scan_lock():
+        books = Books(app.config)
+        books.scan_books(audiobook_dirs)
+        books.write_cache()
     books = read_cache(json_path)
     # A bit of a hack, but push to the app context stack so we can render a
     # template outside of a Flask request
@@ -78,8 +447,17 @@ def generate(static_path, base_url, audiobook_dirs):
     indexfile.write(index)
     indexfile.close()
 
-    for b_key, book in books.items():
-        rss = generate_rss(base_url, b_key, books, static=True)
+    for b_key in books:
+        book = read_book(json_path, b_key)
+        if not book:
+            continue
+        if book.get('cover'):
+            covers_dir = os.path.join(static_path, 'covers')
+            os.makedirs(covers_dir, exist_ok=True)
+            shutil.copyfile(os.path.join(COVERS_PATH, book['cover']),
+                            os.path.join(covers_dir, book['cover']))
+
+        rss = generate_rss(base_url, b_key, book, static=True)
         rss_path = os.path.join(static_path, b_key + '.xml')
         rssfile = open(rss_path, 'w')
         rssfile.write(rss.decode('utf-8'))
@@ -91,7 +469,14 @@ def generate(static_path, base_url, audiobook_dirs):
         for f_key, file in book['files'].items():
             f_path = file['path']
             copy_path = os.path.join(book_dir, f_key + '.mp3')
-            if not os.path.exists(copy_path):
+            if os.path.exists(copy_path):
+                continue
+            if 'offset' in file:
+                # archive member, copy its slice of the archive
+                with FileSlice(f_path, file['offset'], file['size_bytes']) as src, \
+                        open(copy_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+            else:
                 shutil.copyfile(f_path, copy_path)
 
 if __name__ == '__main__':
@@ -103,6 +488,9 @@ if __name__ == '__main__':
     parser.add_argument('--generate', dest='static_path', type=str, action='store',
                         help='Output directory to generate static files',
                         required=False)
+    parser.add_argument('--verify', dest='verify', action='store_true',
+                        help='verify cached tracks against their hashes',
+                        required=False)
     parser.add_argument('--config', dest='config', type=str, action='store',
                         help='Json configuration instead of app.cfg',
                         required=False)
@@ -118,13 +506,28 @@ if __name__ == '__main__':
     elif not config_exists:
         raise Exception(f"Config file '{config_path}' doesn't exist")
 
-    root_path = os.path.expanduser(app.config['ROOT_PATH'])
-
-    if args.scan:
-        books = Books()
-        books.scan_books(root_path)
-        books.write_cache()
-    elif args.static_path:
-        generate(args.static_path, app.config['BASE_URL'], root_path)
-    else:
+    if not args.scan and not args.static_path and not args.verify:
         app.run(host='127.0.0.1', port='8085', threaded=True)
+        raise SystemExit(0)
+
+    try:
+        if args.scan:
+            # waits for a background scan of the server to finish
+            with scan_lock():
+                books = Books(app.config)
+                books.scan_books(get_root_paths())
+                books.write_cache()
+        elif args.static_path:
+            generate(args.static_path, app.config['BASE_URL'], get_root_paths())
+        else:
+            rate = app.config.get('VERIFY_RATE', VERIFY_RATE)
+            with scan_lock(path=VERIFY_LOCK_PATH):
+                books = Books(app.config,
+                              throttle=TokenBucket(rate) if rate else None)
+                failures = books.verify()
+            raise SystemExit(1 if failures else 0)
+    except KeyboardInterrupt:
+        # completed books (verified tracks) are recorded, the next run resumes
+        # after them
+        print('interrupted, run again to resume')
+        raise SystemExit(130)
@@ -0,0 +1,104 @@
+import os
+import struct
+import sys
+
+import pytest
+
+# tests import roka's modules (lib.*) from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.util import get_shard_path
+
+# layer III frame header fields: version bits, sample rates and bitrates (kbit/s)
+# by bitrate index, see lib/tinytag ID3
+MPEG_VERSIONS = {1: 3, 2: 2, 2.5: 0}
+SAMPLERATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000),
+               2.5: (11025, 12000, 8000)}
+BITRATES = {1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+            2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)}
+BITRATES[2.5] = BITRATES[2]
+
+def samples_per_frame(version):
+    return 1152 if version == 1 else 576
+
+def frame(version, bitrate, samplerate):
+    '''
+    Return mono layer III frame without padding, its payload filled with
+    zeros
+    '''
+    header = bytes((
+        0xFF,
+        0xE0 | MPEG_VERSIONS[version] << 3 | 1 << 1 | 1, # layer III, no CRC
+        BITRATES[version].index(bitrate) << 4 |
+        SAMPLERATES[version].index(samplerate) << 2,
+        0xC0)) # mono
+    length = samples_per_frame(version) * 125 * bitrate // samplerate
+
+    return header + bytes(length - len(header))
+
+def xing_frame(version, bitrate, samplerate, frames, nbytes, tag=b'Xing',
+               lame=None):
+    '''
+    Return layer III frame holding a xing header (:tag: Info for CBR) of
+    :frames: frames and :nbytes: bytes of audio, followed by a LAME extension
+    of :lame: (encoder delay, padding) samples if given
+    '''
+    side_info = 17 if version == 1 else 9 # mono
+    header = tag + struct.pack('>III', 0x3, frames, nbytes)
+    if lame:
+        delays = lame[0] << 12 | lame[1]
+        header += b'LAME3.100' + bytes(12) + delays.to_bytes(3, 'big')
+    data = bytearray(frame(version, bitrate, samplerate))
+    data[4 + side_info:4 + side_info + len(header)] = header
+
+    return bytes(data)
+
+def vbri_frame(version, bitrate, samplerate, frames, nbytes):
+    '''
+    Return layer III frame holding a VBRI header of :frames: frames and
+    :nbytes: bytes of audio, 32 bytes after the frame header
+    '''
+    header = b'VBRI' + struct.pack('>HHHII', 1, 0, 75, nbytes, frames)
+    data = bytearray(frame(version, bitrate, samplerate))
+    data[36:36 + len(header)] = header
+
+    return bytes(data)
+
+def write_mp3(path, frames, tag=b''):
+    '''
+    Write MP3 of :frames: (list of (frame bytes, count)) at :path:, after an
+    ID3v2 tag holding :tag: frames
+    '''
+    size = bytes((len(tag) >> x) & 0x7F for x in (21, 14, 7, 0))
+    with open(path, 'wb') as f:
+        f.write(b'ID3\x03\x00\x00' + size + tag)
+        for data, count in frames:
+            f.write(data * count)
+
+    return path
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    '''
+    Point Books' cache paths at an empty directory; return its path
+    '''
+    from lib import books, scanner
+
+    path = str(tmp_path / 'cache')
+    json_path = os.path.join(path, 'audiobooks.json')
+    paths = {
+        'CACHE_PATH':           path,
+        'JSON_PATH':            json_path,
+        'SHARDS_PATH':          os.path.dirname(get_shard_path(json_path, '')),
+        'FINGERPRINTS_PATH':    os.path.join(path, 'fingerprints.json'),
+        'DURATIONS_PATH':       os.path.join(path, 'durations.json'),
+        'COVERS_PATH':          os.path.join(path, 'covers'),
+        'JOURNAL_PATH':         os.path.join(path, 'scan.journal'),
+        'VERIFY_PATH':          os.path.join(path, 'verify.json'),
+        'SCAN_PATH':            os.path.join(path, 'scan.json')
+    }
+    for k, v in paths.items():
+        monkeypatch.setattr(books, k, v)
+        if hasattr(scanner, k):
+            monkeypatch.setattr(scanner, k, v)
+
+    return path
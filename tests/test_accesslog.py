@@ -0,0 +1,41 @@
+import json
+import time
+
+from lib.accesslog import AccessLog
+
+def wait_for(cond, timeout=5):
+    '''
+    Wait until :cond: returns true, at most :timeout: seconds
+    '''
+    deadline = time.time() + timeout
+    while not cond() and time.time() < deadline:
+        time.sleep(0.01)
+
+    return cond()
+
+def test_log_writes_records(tmp_path):
+    path = tmp_path / 'access.jsonl'
+    log = AccessLog(str(path))
+    for i in range(10):
+        log.log({'n': i})
+
+    assert wait_for(lambda: log.stats()['logged'] == 10)
+    with open(path) as f:
+        assert [json.loads(x)['n'] for x in f] == list(range(10))
+
+def test_unopenable_log_is_disabled_once(tmp_path, capsys):
+    log = AccessLog(str(tmp_path / 'missing' / 'access.jsonl'))
+    log.log({'n': 0})
+    assert wait_for(lambda: log.stats()['error'])
+
+    thread = log._thread
+    for i in range(100):
+        log.log({'n': i})
+    # no writer is started again
+    assert log._thread is thread and not thread.is_alive()
+
+    stats = log.stats()
+    assert stats['error'].startswith('FileNotFoundError')
+    assert stats['logged'] == 0 and stats['pending'] == 0
+    assert stats['dropped'] == 101
+    assert capsys.readouterr().out.count('access log disabled') == 1
@@ -0,0 +1,110 @@
+import io
+import os
+import random
+import tarfile
+import zipfile
+
+import pytest
+from flask import Flask
+
+from lib.archive import FileSlice, get_members
+from lib.util import FileCache, send_range
+
+# member name: data, sizes around block and buffer boundaries
+MEMBERS = {
+    'book/01.mp3': random.Random(1).randbytes(1),
+    'book/02.mp3': random.Random(2).randbytes(511),
+    'book/03.mp3': random.Random(3).randbytes(70000),
+    # long names move tar data behind extra headers
+    'book/' + 'x' * 150 + '.mp3': bytes(range(256)) * 8
+}
+
+def make_zip(path):
+    with zipfile.ZipFile(path, 'w') as z:
+        for name, data in MEMBERS.items():
+            info = zipfile.ZipInfo(name)
+            info.compress_type = zipfile.ZIP_STORED
+            info.extra = b'\xfe\xca\x04\x00roka' # local header grows too
+            z.writestr(info, data)
+        # compressed members can't be served as ranges of the archive
+        z.writestr('book/compressed.mp3', b'a' * 1000,
+                   compress_type=zipfile.ZIP_DEFLATED)
+        z.writestr('book/sub/', b'')
+
+def make_tar(path):
+    with tarfile.open(path, 'w', format=tarfile.GNU_FORMAT) as t:
+        for name, data in MEMBERS.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            t.addfile(info, io.BytesIO(data))
+        info = tarfile.TarInfo('book/sub')
+        info.type = tarfile.DIRTYPE
+        t.addfile(info)
+
+@pytest.fixture(params=[('zip', make_zip), ('tar', make_tar)],
+                ids=lambda x: x[0])
+def archive(request, tmp_path):
+    '''
+    Return (path, {name: (offset, size)}) of an archive of MEMBERS
+    '''
+    ext, make = request.param
+    path = str(tmp_path / ('book.' + ext))
+    make(path)
+
+    return path, {x[0]: x[1:] for x in get_members(path)}
+
+def test_members(archive):
+    path, members = archive
+    assert set(members) == set(MEMBERS)
+    with open(path, 'rb') as f:
+        for name, (offset, size) in members.items():
+            assert size == len(MEMBERS[name])
+            f.seek(offset)
+            assert f.read(size) == MEMBERS[name]
+
+def test_file_slice_reads(archive):
+    path, members = archive
+    for name, (offset, size) in members.items():
+        data = MEMBERS[name]
+        with FileSlice(path, offset, size) as f:
+            assert f.read() == data
+            assert f.read() == b''
+            # reads stop at the end of the member, not of the archive
+            f.seek(size - 1)
+            assert f.read(100) == data[-1:]
+            f.seek(-min(size, 10), os.SEEK_END)
+            assert f.read() == data[-10:]
+            f.seek(size // 2)
+            assert f.tell() == size // 2
+            assert f.read(7) == data[size // 2:size // 2 + 7]
+
+        with io.BufferedReader(FileSlice(path, offset, size), 64) as f:
+            assert f.read(size // 3) == data[:size // 3]
+            assert f.read() == data[size // 3:]
+
+@pytest.mark.parametrize('cached', [False, True], ids=['stat', 'fds'])
+def test_send_range(archive, cached):
+    path, members = archive
+    fds = FileCache(4) if cached else None
+    app = Flask(__name__)
+    for name, (offset, size) in members.items():
+        data = MEMBERS[name]
+        ranges = [('bytes=0-0', data[:1]),
+                  ('bytes=-1', data[-1:]),
+                  ('bytes=%d-' % (size // 2), data[size // 2:]),
+                  ('bytes=0-%d' % (size + 100), data)]
+        if size > 2:
+            ranges.append(('bytes=1-%d' % (size - 2), data[1:-1]))
+
+        with app.test_request_context():
+            rv = send_range(path, offset, size, fds=fds, key=name)
+            assert rv.status_code == 200
+            assert b''.join(rv.response) == data
+        for rng, expected in ranges:
+            with app.test_request_context(headers={'Range': rng}):
+                rv = send_range(path, offset, size, fds=fds, key=name)
+                assert rv.status_code == 206, rng
+                assert rv.content_length == len(expected)
+                assert b''.join(rv.response) == expected, rng
+        with app.test_request_context(headers={'Range': 'bytes=%d-' % size}):
+            assert send_range(path, offset, size).status_code == 416
@@ -0,0 +1,154 @@
+import json
+import math
+import os
+
+from conftest import frame, write_mp3
+from lib.books import Books
+from lib.util import cache_generation, read_book
+
+def scan(root, config=None):
+    '''
+    Scan :root: into the test cache; return Books
+    '''
+    books = Books(config)
+    books.scan_books(root)
+    books.write_cache()
+
+    return books
+
+def test_split_vbr_track_longer_than_estimate(tmp_path, cache):
+    # VBR without a xing header: a few 320 kbit/s frames lead the estimate to
+    # about a tenth of the real length
+    root = tmp_path / 'lib'
+    (root / 'book').mkdir(parents=True)
+    path = write_mp3(str(root / 'book' / '01.mp3'), [
+        (frame(1, 320, 44100), 5),
+        (frame(1, 32, 44100), 24000)
+    ])
+    duration = (5 + 24000) * 1152 / 44100
+
+    books = scan(str(root), {'CHAPTER_LENGTH': 60})
+    (b_key,) = books.books
+    (track,) = read_book(os.path.join(cache, 'audiobooks.json'),
+                         b_key)['files'].values()
+
+    assert track['duration'] == duration
+    chapters = track['chapters']
+    assert len(chapters) == math.ceil(duration / 60)
+    assert sum(x['size_bytes'] for x in chapters) == (
+        os.path.getsize(path) - chapters[0]['offset'])
+    for c in chapters:
+        assert 0 < c['duration'] <= 61
+
+def apic(image):
+    '''
+    Return ID3v2.3 APIC frame of front cover JPEG :image:
+    '''
+    payload = b'\x00image/jpeg\x00\x03\x00' + image
+    return b'APIC' + len(payload).to_bytes(4, 'big') + b'\x00\x00' + payload
+
+def test_cover_keeps_largest_image_only(tmp_path, cache):
+    root = tmp_path / 'lib'
+    (root / 'book').mkdir(parents=True)
+    images = [b'\xff\xd8\xff' + bytes([i]) * n
+              for i, n in enumerate((1000, 5000, 5000, 2000))]
+    for i, image in enumerate(images):
+        write_mp3(str(root / 'book' / ('%02d.mp3' % i)),
+                  [(frame(1, 128, 44100), 100)], tag=apic(image))
+
+    books = Books({'COVERS': True})
+    tracks = {str(x): (str(x), None, x.stat().st_size)
+              for x in sorted((root / 'book').iterdir())}
+    tags = books._get_tags(tracks, {x: x for x in tracks})
+    kept = [x.get_image() for x in tags.values() if x.get_image()]
+    assert kept == [images[1]] # first of the largest
+
+    books.scan_books(str(root))
+    books.write_cache()
+    (entry,) = books.books.values()
+    with open(os.path.join(cache, 'covers', entry['cover']), 'rb') as f:
+        assert f.read() == images[1]
+
+def test_walk_skips_symlink_loops(tmp_path, cache):
+    root = tmp_path / 'lib'
+    book = root / 'Author' / 'Book'
+    book.mkdir(parents=True)
+    write_mp3(str(book / '01.mp3'), [(frame(1, 128, 44100), 100)])
+    (book / 'up').symlink_to('..') # back to Author
+    (root / 'Author' / 'root').symlink_to(root)
+
+    # linked directories outside the library are still followed
+    other = tmp_path / 'other' / 'Book'
+    other.mkdir(parents=True)
+    write_mp3(str(other / '01.mp3'), [(frame(1, 128, 44100), 200)])
+    (root / 'linked').symlink_to(other.parent)
+
+    dirs = Books()._get_dirs(str(root))
+    assert sorted(os.path.relpath(x, root) for x in dirs) == [
+        'Author', 'Author/Book', 'linked', 'linked/Book']
+
+    books = scan(str(root))
+    assert sorted(x['path'] for x in books.books.values()) == [
+        str(book), str(root / 'linked' / 'Book')]
+
+def test_progress_counts_books_only(tmp_path, cache):
+    root = tmp_path / 'lib'
+    for author, series, book in (('A', 'S', 'B1'), ('A', 'S', 'B2'),
+                                 ('C', 'T', 'B3')):
+        path = root / author / series / book
+        path.mkdir(parents=True)
+        write_mp3(str(path / '01.mp3'), [(frame(1, 128, 44100), 100)])
+    (root / 'A' / 'notes').mkdir()
+    (root / 'A' / 'notes' / 'readme.txt').write_text('not a book')
+
+    books = scan(str(root))
+    size = os.path.getsize(str(root / 'A' / 'S' / 'B1' / '01.mp3'))
+    assert books.progress() == {'books': 3, 'bytes': 3 * size,
+                                'total_books': 3, 'total_bytes': 3 * size}
+
+class CountingBucket:
+    '''
+    TokenBucket stand-in counting bytes taken, without waiting
+    '''
+    def __init__(self):
+        self.taken = 0
+
+    def consume(self, n):
+        self.taken += n
+        return 0
+
+def test_throttle_charges_parsing_reads(tmp_path, cache):
+    root = tmp_path / 'lib'
+    (root / 'book').mkdir(parents=True)
+    image = b'\xff\xd8\xff' + bytes(512 * 1024)
+    path = write_mp3(str(root / 'book' / '01.mp3'),
+                     [(frame(1, 128, 44100), 10000)], tag=apic(image))
+    size = os.path.getsize(path)
+
+    # hashed in full, then read again to walk frames for chapters
+    bucket = CountingBucket()
+    books = Books({'CHAPTER_LENGTH': 60, 'COVERS': True}, throttle=bucket)
+    books.scan_books(str(root))
+    assert bucket.taken >= 2 * size + len(image)
+
+def test_unchanged_scan_keeps_index(tmp_path, cache):
+    root = tmp_path / 'lib'
+    for name in ('a', 'b'):
+        (root / name).mkdir(parents=True)
+    write_mp3(str(root / 'a' / '01.mp3'), [(frame(1, 128, 44100), 100)])
+    scan(str(root))
+    json_path = os.path.join(cache, 'audiobooks.json')
+    generation = cache_generation(json_path)
+
+    # a rescan finding nothing new keeps the cache generation, and records
+    # the scan apart from the index
+    scan(str(root))
+    assert cache_generation(json_path) == generation
+    with open(os.path.join(cache, 'scan.json')) as f:
+        assert json.load(f)['changed'] is False
+
+    write_mp3(str(root / 'b' / '01.mp3'), [(frame(1, 128, 44100), 200)])
+    books = scan(str(root))
+    assert cache_generation(json_path) != generation
+    with open(json_path) as f:
+        assert json.load(f)['books'].keys() == books.books.keys()
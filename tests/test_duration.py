@@ -0,0 +1,104 @@
+import pytest
+
+from conftest import (frame, samples_per_frame, vbri_frame, write_mp3,
+                      xing_frame)
+from lib.tinytag import ID3, TinyTag
+
+# version, sample rate, bitrate of CBR fixtures
+FORMATS = [
+    (1, 44100, 128),
+    (2, 22050, 64),
+    (2.5, 11025, 32)
+]
+
+SECONDS = 60
+
+@pytest.fixture(params=FORMATS, ids=lambda x: 'mpeg%s' % x[0])
+def cbr(request, tmp_path):
+    '''
+    Return (path, exact duration) of a SECONDS long CBR MP3
+    '''
+    version, samplerate, bitrate = request.param
+    spf = samples_per_frame(version)
+    frames = SECONDS * samplerate // spf
+    path = write_mp3(str(tmp_path / 'cbr.mp3'),
+                     [(frame(version, bitrate, samplerate), frames)])
+
+    return path, frames * spf / samplerate
+
+def test_estimate(cbr):
+    path, duration = cbr
+    tag = TinyTag.get(path, tags=False)
+    assert tag.duration == pytest.approx(duration, rel=0.01)
+
+def test_exact_duration(cbr):
+    path, duration = cbr
+    for use_mmap in (False, True):
+        tag = TinyTag.get(path, tags=False, exact_duration=True,
+                          use_mmap=use_mmap)
+        assert tag.duration == pytest.approx(duration)
+
+def test_seek_offsets(cbr):
+    path, duration = cbr
+    tag = ID3.get(path, tags=False, seek_times=range(0, SECONDS, 10))
+    assert tag.duration == pytest.approx(duration)
+
+    # offsets are frame boundaries at (or just after) the requested times
+    offsets = tag.get_seek_offsets()
+    assert [round(t) for t, _ in offsets] == list(range(0, SECONDS, 10))
+    with open(path, 'rb') as f:
+        data = f.read()
+    for _, offset in offsets:
+        assert data[offset] == 0xFF and data[offset + 1] & 0xE0 == 0xE0
+
+# VBR header fixtures: frames stated by the header, audio frames actually
+# following it (fewer, the header is trusted)
+HEADER_FRAMES = 2000
+AUDIO_FRAMES = 100
+
+def header_track(tmp_path, header, version=1, samplerate=44100, bitrate=128):
+    return write_mp3(str(tmp_path / 'vbr.mp3'), [
+        (header, 1), (frame(version, bitrate, samplerate), AUDIO_FRAMES)])
+
+@pytest.mark.parametrize('fmt', FORMATS, ids=lambda x: 'mpeg%s' % x[0])
+def test_xing_duration(tmp_path, fmt):
+    version, samplerate, bitrate = fmt
+    nbytes = HEADER_FRAMES * len(frame(version, bitrate, samplerate))
+    path = header_track(tmp_path, xing_frame(version, bitrate, samplerate,
+                                             HEADER_FRAMES, nbytes),
+                        version, samplerate, bitrate)
+    tag = TinyTag.get(path, tags=False)
+    assert tag.duration == pytest.approx(
+        HEADER_FRAMES * samples_per_frame(version) / samplerate)
+    assert tag.bitrate == pytest.approx(bitrate, rel=0.01)
+
+def test_info_lame_gapless_duration(tmp_path):
+    delay, padding = 576, 1200
+    data = xing_frame(1, 128, 44100, HEADER_FRAMES, HEADER_FRAMES * 417,
+                      tag=b'Info', lame=(delay, padding))
+    # LAME extension follows the xing fields of the header
+    assert ID3._parse_lame_header(data, data.index(b'LAME')) == (delay, padding)
+
+    path = header_track(tmp_path, data)
+    tag = TinyTag.get(path, tags=False)
+    assert tag.duration == pytest.approx(
+        (HEADER_FRAMES * 1152 - delay - padding) / 44100)
+    # audio starts after the header frame
+    assert tag.audio_offset == 10 + len(data)
+
+def test_vbri_duration(tmp_path):
+    data = vbri_frame(1, 128, 44100, HEADER_FRAMES, HEADER_FRAMES * 417)
+    frames, nbytes, _ = ID3._parse_vbri_header(data, 36)
+    assert (frames, nbytes) == (HEADER_FRAMES, HEADER_FRAMES * 417)
+
+    path = header_track(tmp_path, data)
+    tag = TinyTag.get(path, tags=False)
+    assert tag.duration == pytest.approx(HEADER_FRAMES * 1152 / 44100)
+    assert tag.audio_offset == 10 + len(data)
+
+def test_vbr_header_ignored_when_disabled(tmp_path, monkeypatch):
+    path = header_track(tmp_path, vbri_frame(1, 128, 44100, HEADER_FRAMES,
+                                             HEADER_FRAMES * 417))
+    monkeypatch.setattr(ID3, '_USE_XING_HEADER', False)
+    tag = TinyTag.get(path, tags=False, exact_duration=True)
+    assert tag.duration == pytest.approx((AUDIO_FRAMES + 1) * 1152 / 44100)
@@ -0,0 +1,36 @@
+import pytest
+
+import roka
+from conftest import frame, write_mp3
+from lib import books as books_module
+from lib.books import Books
+
+@pytest.fixture
+def client(tmp_path, cache, monkeypatch):
+    '''
+    Return (test client of roka serving the test cache, Books of a scanned
+    book)
+    '''
+    root = tmp_path / 'lib'
+    (root / 'book').mkdir(parents=True)
+    write_mp3(str(root / 'book' / '01.mp3'), [(frame(1, 128, 44100), 100)])
+    books = Books()
+    books.scan_books(str(root))
+    books.write_cache()
+
+    monkeypatch.setattr(roka, 'json_path', books_module.JSON_PATH)
+    return roka.app.test_client(), books
+
+def test_feed_revalidates(client):
+    client, books = client
+    path = '/?a=%s' % next(iter(books.books))
+
+    rv = client.get(path)
+    assert rv.status_code == 200 and rv.data
+    etag = rv.headers['ETag']
+
+    rv = client.get(path, headers={'If-None-Match': etag})
+    assert rv.status_code == 304 and not rv.data
+
+    rv = client.get(path, headers={'If-None-Match': '"other"'})
+    assert rv.status_code == 200
@@ -0,0 +1,62 @@
+import os
+import time
+
+import pytest
+
+from conftest import frame, write_mp3
+from lib import books as books_module
+from lib.books import Books
+from lib.scanner import VERIFY_INTERVAL, VERIFY_PAUSE, Verifier
+
+TRACKS = 3
+
+@pytest.fixture
+def library(tmp_path, cache):
+    '''
+    Scan a book of TRACKS tracks into the test cache; return its Books
+    '''
+    root = tmp_path / 'lib'
+    (root / 'book').mkdir(parents=True)
+    for i in range(TRACKS):
+        write_mp3(str(root / 'book' / ('%02d.mp3' % i)),
+                  [(frame(1, 128, 44100), 100 + i)])
+    books = Books()
+    books.scan_books(str(root))
+    books.write_cache()
+
+    return Books()
+
+def test_verifier_waits_between_passes(library):
+    verifier = Verifier({}, rate=1 << 30)
+    assert verifier._due() == 0
+
+    # one track per run: runs follow each other until the pass completes
+    for _ in range(TRACKS - 1):
+        assert library.verify(1) == {}
+        assert 0 < verifier._due() <= VERIFY_PAUSE
+        time.sleep(VERIFY_PAUSE)
+        assert verifier._due() == 0
+    library.verify(1)
+    assert verifier._due() == pytest.approx(VERIFY_INTERVAL, abs=5)
+
+    # the next pass starts over
+    library.verify(1)
+    assert 0 < verifier._due() <= VERIFY_PAUSE
+
+def test_verifier_needs_rate():
+    with pytest.raises(ValueError):
+        Verifier({}, rate=0)
+
+@pytest.mark.skipif(not hasattr(os, 'posix_fadvise'), reason='no fadvise')
+def test_verify_keeps_tracks_cached(library, monkeypatch):
+    advice = []
+    fadvise = os.posix_fadvise
+
+    def record(fd, offset, length, flag):
+        advice.append(flag)
+        return fadvise(fd, offset, length, flag)
+
+    monkeypatch.setattr(books_module.os, 'posix_fadvise', record)
+    assert library.verify() == {}
+    assert os.POSIX_FADV_SEQUENTIAL in advice
+    assert os.POSIX_FADV_DONTNEED not in advice
@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+from lib import throttle
+from lib.throttle import SHAPER_BURST, Shaper, TokenBucket
+
+class Clock:
+    def __init__(self, frozen=False):
+        '''
+        Fake monotonic clock; sleeps are recorded and, unless :frozen:,
+        advance it
+        '''
+        self.now = 0.0
+        self.frozen = frozen
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        if not self.frozen:
+            self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(throttle, 'time', clock)
+    return clock
+
+def test_token_bucket_rate(clock):
+    bucket = TokenBucket(1000, 500)
+    assert bucket.consume(500) == 0
+    # debt is paid by sleeping at the rate, large takes included
+    assert bucket.consume(1000) == pytest.approx(1)
+    assert bucket.consume(100) == pytest.approx(0.1)
+    assert clock.now == pytest.approx(1.1)
+
+    # idle time refills up to the burst only
+    clock.now += 10
+    assert bucket.consume(500) == 0
+    assert bucket.consume(100) == pytest.approx(0.1)
+
+    clock.now += 10
+    bucket.set_rate(100)
+    assert bucket.consume(600) == pytest.approx(1)
+
+def test_token_bucket_real_time():
+    bucket = TokenBucket(1000000, 10000)
+    start = time.monotonic()
+    for _ in range(21):
+        bucket.consume(10000)
+    assert time.monotonic() - start >= 0.18
+
+def stream(shaper, client, n):
+    '''
+    Return started stream of :n: burst sized chunks to :client:, after an
+    empty one so the client is active before it takes anything
+    '''
+    ret = shaper.stream(client, iter([b''] + [bytes(SHAPER_BURST)] * n))
+    assert next(ret) == b''
+    return ret
+
+def test_shaper_shares_per_client(clock):
+    clock.frozen = True
+    shaper = Shaper(rate=2000000)
+    a1 = stream(shaper, 'a', 2)
+    a2 = stream(shaper, 'a', 2)
+    b = stream(shaper, 'b', 2)
+
+    # a and b get half the rate each, however many streams a has open
+    next(a1)
+    next(a2)
+    next(b)
+    next(b)
+    share = SHAPER_BURST / 1000000
+    assert clock.slept == [pytest.approx(share), pytest.approx(share)]
+
+    # a gets all of it once b is done
+    b.close()
+    next(a1)
+    assert clock.slept[2] == pytest.approx(2 * SHAPER_BURST / 2000000)
+
+    stats = shaper.stats()
+    assert stats['streams'] == 3
+    assert stats['active_clients'] == 1 and stats['active_streams'] == 2
+    assert stats['bytes'] == 5 * SHAPER_BURST
+    assert stats['throttled_bytes'] == 3 * SHAPER_BURST
+
+    a1.close()
+    a2.close()
+    assert shaper.stats()['active_clients'] == 0
+
+def test_shaper_client_rate(clock):
+    clock.frozen = True
+    shaper = Shaper(rate=4000000, client_rate=1000000)
+    a = stream(shaper, 'a', 2)
+    b = stream(shaper, 'b', 2)
+
+    # the share is 2MB/s, capped at the client rate
+    for s in (a, b):
+        next(s)
+        next(s)
+    assert clock.slept == [pytest.approx(SHAPER_BURST / 1000000)] * 2
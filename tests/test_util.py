@@ -0,0 +1,221 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from lib import util
+from lib.util import (CACHE_VERSION, FileCache, SingleFlight, get_shard_path,
+                      read_book, read_cache)
+
+# concurrent readers of each test
+THREADS = 16
+
+def write_index(path, books):
+    '''
+    Write cache index of :books: at :path:, as a scan does
+    '''
+    util.write_json(path, {'version': CACHE_VERSION, 'books': books})
+
+def book(title):
+    return {'title': title, 'author': 'a', 'path': '/b/' + title, 'tracks': 1}
+
+def run_threads(fn):
+    '''
+    Call :fn: from THREADS threads released at once; return their results
+    '''
+    barrier = threading.Barrier(THREADS)
+    results = [None] * THREADS
+    errors = []
+
+    def work(i):
+        barrier.wait()
+        try:
+            results[i] = fn()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(i,))
+               for i in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results, errors
+
+@pytest.fixture
+def loads(monkeypatch):
+    '''
+    Count cache loads, slowed down so concurrent readers overlap
+    '''
+    calls = []
+    load = util._load_cache
+
+    def slow_load(json_path):
+        calls.append(json_path)
+        time.sleep(0.2)
+        return load(json_path)
+
+    monkeypatch.setattr(util, '_load_cache', slow_load)
+    return calls
+
+def test_read_cache_loads_each_generation_once(tmp_path, loads):
+    json_path = str(tmp_path / 'audiobooks.json')
+    write_index(json_path, {'aa': book('x')})
+
+    results, errors = run_threads(lambda: read_cache(json_path))
+    assert not errors
+    assert len(loads) == 1
+    assert all(x is results[0] for x in results)
+    assert list(results[0]) == ['aa']
+
+    # unchanged generation is served from memory
+    assert read_cache(json_path) is results[0]
+    assert len(loads) == 1
+
+    # a scan replaces the index: one more load, shared by all readers
+    write_index(json_path, {'aa': book('x'), 'bb': book('y')})
+    results, errors = run_threads(lambda: read_cache(json_path))
+    assert not errors
+    assert len(loads) == 2
+    assert all(x is results[0] for x in results)
+    assert list(results[0]) == ['aa', 'bb']
+
+def test_read_cache_shares_load_errors(tmp_path, loads):
+    json_path = str(tmp_path / 'audiobooks.json')
+    with open(json_path, 'w') as f:
+        f.write('{')
+
+    results, errors = run_threads(lambda: read_cache(json_path))
+    assert len(loads) == 1
+    assert len(errors) == THREADS
+    assert all(isinstance(x, ValueError) for x in errors)
+
+def test_single_flight_coalesces_by_key():
+    flight = SingleFlight()
+    calls = []
+
+    def build(key):
+        calls.append(key)
+        time.sleep(0.2)
+        return object()
+
+    results, errors = run_threads(lambda: flight.do('k', build, 'k'))
+    assert not errors
+    assert calls == ['k']
+    assert all(x is results[0] for x in results)
+
+    # finished calls aren't kept, the next call computes again
+    flight.do('k', build, 'k')
+    assert calls == ['k', 'k']
+
+def test_read_book_upgrades_monolithic_cache(tmp_path):
+    # version 1: unversioned, tracks stored in the index
+    json_path = str(tmp_path / 'audiobooks.json')
+    files = {'ff': {'path': '/b/x/01.mp3', 'size_bytes': 10}}
+    with open(json_path, 'w') as f:
+        json.dump({'aa': dict(book('x'), files=files)}, f)
+
+    # the first read of a book splits the cache and serves its shard
+    assert read_book(json_path, 'aa')['files'] == files
+    assert os.path.exists(get_shard_path(json_path, 'aa'))
+    with open(json_path) as f:
+        data = json.load(f)
+    assert data['version'] == CACHE_VERSION
+    assert 'files' not in data['books']['aa']
+    assert data['books']['aa']['tracks'] == 1
+
+    assert read_book(json_path, 'aa')['files'] == files
+    assert read_book(json_path, 'bb') is None
+
+def test_file_cache_keeps_copies_apart(tmp_path):
+    # identical tracks share their key, e.g. a book also stored in an archive
+    a, b = tmp_path / 'a.mp3', tmp_path / 'b.zip'
+    a.write_bytes(b'track')
+    b.write_bytes(b'header' + b'track')
+    fds = FileCache(4)
+
+    entries = [fds.acquire('ff', str(x)) for x in (a, b)]
+    assert entries[0].fd != entries[1].fd
+    assert [x.st.st_size for x in entries] == [5, 11]
+    assert os.pread(entries[1].fd, 5, 6) == b'track'
+    for entry in entries:
+        fds.release(entry)
+
+def is_open(fd):
+    try:
+        os.fstat(fd)
+    except OSError:
+        return False
+    return True
+
+@pytest.fixture
+def tracks(tmp_path):
+    '''
+    Return paths of four small files, by key
+    '''
+    ret = {}
+    for key in 'abcd':
+        path = tmp_path / (key + '.mp3')
+        path.write_bytes(key.encode() * 10)
+        ret[key] = str(path)
+
+    return ret
+
+def test_file_cache_lru(tracks):
+    fds = FileCache(2)
+    opened = {}
+    for key in 'ab':
+        opened[key] = fds.acquire(key, tracks[key])
+        fds.release(opened[key])
+
+    # a hit refreshes a, b is least recently used and evicted by c
+    assert fds.acquire('a', tracks['a']) is opened['a']
+    fds.release(opened['a'])
+    fds.release(fds.acquire('c', tracks['c']))
+    assert not is_open(opened['b'].fd)
+    assert is_open(opened['a'].fd)
+
+    assert fds.stat('b', tracks['b']).st_size == 10
+    assert fds.stats() == {'hits': 1, 'opens': 4, 'evictions': 2,
+                           'invalidations': 0, 'open': 2}
+
+def test_file_cache_closes_on_last_release(tracks):
+    fds = FileCache(1)
+    entry = fds.acquire('a', tracks['a'])
+    assert fds.acquire('a', tracks['a']) is entry
+
+    # evicted while two responses read it
+    fds.release(fds.acquire('b', tracks['b']))
+    assert entry.evicted and entry.refs == 2
+    fds.release(entry)
+    assert is_open(entry.fd)
+    assert os.pread(entry.fd, 1, 0) == b'a'
+    fds.release(entry)
+    assert not is_open(entry.fd)
+
+def test_file_cache_generation(tracks):
+    fds = FileCache(4)
+    fds.set_generation(1)
+    reading = fds.acquire('a', tracks['a'])
+    idle = fds.acquire('b', tracks['b'])
+    fds.release(idle)
+
+    # same generation keeps entries, a new one drops them all
+    fds.set_generation(1)
+    assert fds.stats()['open'] == 2
+    fds.set_generation(2)
+    assert fds.stats()['open'] == 0
+    assert fds.stats()['invalidations'] == 1
+    assert not is_open(idle.fd)
+    assert is_open(reading.fd)
+    fds.release(reading)
+    assert not is_open(reading.fd)
+
+    # reopened afterwards
+    entry = fds.acquire('a', tracks['a'])
+    assert entry is not reading
+    fds.release(entry)
+    assert fds.stats()['opens'] == 3
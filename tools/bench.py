@@ -0,0 +1,612 @@
+#!/usr/bin/env python3
+
+'''
+Micro-benchmarks of scan and serving paths on a synthetic library (see
+tools/loadtest.py), for comparing changes to them:
+
+    scan        full library scan keyed by MD5 and by sampled fingerprints
+    hash        full-file MD5 by 1 KiB reads (before read buffers) and by
+                read buffer size, on a local disk and, with --latency, on a
+                slow disk simulated by sleeping before each read call
+    tags        bytes read and read calls per track when parsing tags, reading
+                every frame and cover art (as before selective parsing), every
+                field, or only the fields Roka uses, of tracks with a large
+                cover ahead of their text frames
+    walk        MP3 duration by the frame walker and by the walker it replaced
+                (a peek and seeks per frame), estimated and exact, with read
+                calls per track, of the library (CBR) and of VBR tracks
+    parsers     tags and duration per format (MP3, FLAC, Opus, WAV, M4B)
+                through a file handle and through mmap
+    ranges      random Range requests of tracks through the track route, with
+                and without the open file cache, from 1 and --threads threads
+
+Books use a temporary cache, never the one of the server; tracks are read
+from the page cache once the library was generated or read before.
+
+    tools/bench.py scan hash --books 10 --seconds 600 --latency 1
+'''
+
+import argparse
+import contextlib
+import glob
+import hashlib
+import io
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from loadtest import (FRAME_HEADER, FRAME_LENGTH, FRAMES_PER_SECOND, id3_frame,
+                      make_library)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import roka
+from lib import books as books_module
+from lib.books import TAG_FIELDS, Books
+from lib.tinytag import ID3, TinyTag, TinyTagException
+
+BENCHMARKS = ('scan', 'hash', 'tags', 'walk', 'parsers', 'ranges')
+
+# read buffer sizes of the hash benchmark
+HASH_BUFFER_SIZES = (64 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+
+# read size of full-file hashing before read buffers
+LEGACY_HASH_READ = 1024
+
+# tracks and seconds per track of the tags benchmark
+TAG_TRACKS = 10
+TAG_SECONDS = 60
+
+# VBR tracks of the walk benchmark, seconds per track and the bitrate index
+# (kbit/s) byte of their frame headers, cycled through
+VBR_TRACKS = 10
+VBR_SECONDS = 300
+VBR_BITRATES = ((0x70, 96), (0x90, 128), (0xa0, 160))
+
+# files per format of the parsers benchmark, best of this many runs
+FORMAT_FILES = 5
+FORMAT_RUNS = 7
+
+# tags of the parsers benchmark fixtures, padded with comments
+FORMAT_TAGS = ([('TITLE', 'Chapter 1'), ('ARTIST', 'Author'), ('ALBUM', 'Book'),
+                ('TRACKNUMBER', '3')] +
+               [('COMMENT%d' % x, 'x' * 200) for x in range(40)])
+
+class SlowFile(io.RawIOBase):
+    def __init__(self, path, latency):
+        '''
+        Unbuffered file at :path: whose read calls take :latency: seconds
+        longer, as on a slow or remote disk
+        '''
+        self._f = open(path, 'rb', buffering=0)
+        self._latency = latency
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def readinto(self, b):
+        if self._latency:
+            time.sleep(self._latency)
+        return self._f.readinto(b)
+
+    def close(self):
+        self._f.close()
+        super().close()
+
+class CountingFile(io.FileIO):
+    '''
+    Unbuffered file counting bytes read and read calls in :counts:
+    '''
+    def __init__(self, path, counts):
+        super().__init__(path, 'rb')
+        self._counts = counts
+
+    def readinto(self, b):
+        n = super().readinto(b)
+        self._counts['bytes'] += n or 0
+        self._counts['calls'] += 1
+        return n
+
+    def read(self, n=-1):
+        data = super().read(n)
+        self._counts['bytes'] += len(data)
+        self._counts['calls'] += 1
+        return data
+
+class LegacyID3(ID3):
+    '''
+    ID3 parser with the frame walker before block buffering: a peek, unpack
+    and seeks per frame. Frame lengths and samples are per MPEG version as in
+    the current walker, so both find the same durations
+    '''
+    def _determine_duration(self, fh):
+        max_estimation_frames = (ID3._MAX_ESTIMATION_SEC * 44100) // ID3.samples_per_frame
+        frame_size_accu = 0
+        header_bytes = 4
+        frames = 0
+        samples = 0
+        bitrate_accu = 0
+        last_bitrates = []
+        fh.seek(self._bytepos_after_id3v2)
+        while True:
+            b = fh.peek(4)
+            if len(b) < 4:
+                break
+            sync, conf, bitrate_freq, rest = struct.unpack('BBBB', b[0:4])
+            br_id = (bitrate_freq >> 4) & 0x0F
+            sr_id = (bitrate_freq >> 2) & 0x03
+            padding = 1 if bitrate_freq & 0x02 > 0 else 0
+            mpeg_id = (conf >> 3) & 0x03
+            layer_id = (conf >> 1) & 0x03
+            channel_mode = (rest >> 6) & 0x03
+            if not b[:2] > b'\xFF\xE0' or br_id > 14 or br_id == 0 or sr_id == 3 or layer_id == 0 or mpeg_id == 1:
+                idx = b.find(b'\xFF', 1)
+                if idx == -1:
+                    idx = len(b)
+                fh.seek(max(idx, 1), os.SEEK_CUR)
+                continue
+            try:
+                self.channels = self.channels_per_channel_mode[channel_mode]
+                frame_bitrate = ID3.bitrate_by_version_by_layer[mpeg_id][layer_id][br_id]
+                self.samplerate = ID3.samplerates[mpeg_id][sr_id]
+            except (IndexError, TypeError):
+                raise TinyTagException('mp3 parsing failed')
+            spf = ID3.samples_per_frame_by_version_by_layer[mpeg_id][layer_id]
+            frames += 1
+            samples += spf
+            bitrate_accu += frame_bitrate
+            if frames == 1:
+                self.audio_offset = fh.tell()
+            if frames <= ID3._CBR_DETECTION_FRAME_COUNT:
+                last_bitrates.append(frame_bitrate)
+            fh.seek(4, os.SEEK_CUR)
+
+            if layer_id == 3:
+                frame_length = ((12000 * frame_bitrate) // self.samplerate + padding) * 4
+            else:
+                frame_length = (spf * 125 * frame_bitrate) // self.samplerate + padding
+            frame_size_accu += frame_length
+            is_cbr = (frames == ID3._CBR_DETECTION_FRAME_COUNT and
+                      len(set(last_bitrates)) == 1)
+            if (frames == max_estimation_frames or is_cbr) and not self._exact_duration:
+                fh.seek(-128, 2)
+                audio_stream_size = fh.tell() - self.audio_offset
+                est_frame_count = audio_stream_size / (frame_size_accu / float(frames))
+                self.duration = est_frame_count * spf / float(self.samplerate)
+                self.bitrate = bitrate_accu / frames
+                return
+
+            if frame_length > 1:
+                fh.seek(frame_length - header_bytes, os.SEEK_CUR)
+        if self.samplerate:
+            self.duration = samples / float(self.samplerate)
+
+def report(name, elapsed, nbytes=None, n=None):
+    '''
+    Print timing of benchmark :name:, with throughput of :nbytes: bytes or
+    rate of :n: operations if given
+    '''
+    line = '%-32s %8.3fs' % (name, elapsed)
+    if nbytes is not None:
+        line += ' %10.1f MB/s' % (nbytes / 1e6 / max(elapsed, 1e-9))
+    if n is not None:
+        line += ' %10.0f /s' % (n / max(elapsed, 1e-9))
+    print(line)
+
+@contextlib.contextmanager
+def scratch_cache():
+    '''
+    Point Books' cache paths at a temporary directory within the block
+    '''
+    path = tempfile.mkdtemp(prefix='roka-bench-cache-')
+    cache_path = books_module.CACHE_PATH
+    saved = {k: v for k, v in vars(books_module).items()
+             if k.endswith('_PATH') and isinstance(v, str) and
+             v.startswith(cache_path)}
+    for k, v in saved.items():
+        setattr(books_module, k, path + v[len(cache_path):])
+    try:
+        yield path
+    finally:
+        for k, v in saved.items():
+            setattr(books_module, k, v)
+        shutil.rmtree(path, ignore_errors=True)
+
+def bench_scan(library, tracks):
+    '''
+    Scan :library: from an empty cache keyed by MD5 and by fingerprints,
+    checking both find the same books
+    '''
+    nbytes = sum(os.path.getsize(x) for x in tracks)
+    found = dict()
+    for fingerprint in (False, True):
+        with scratch_cache():
+            books = Books({'FINGERPRINT': fingerprint})
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()): # scan log
+                books.scan_books(library)
+            elapsed = time.perf_counter() - start
+        found[fingerprint] = sorted(x['path'] for x in books.books.values())
+        report('scan, %s' % ('fingerprint' if fingerprint else 'md5'),
+               elapsed, nbytes)
+    assert found[False] == found[True], 'scans found different books'
+
+def legacy_hash(path, digest, latency):
+    '''
+    Update :digest: with file at :path: as hashing did before read buffers:
+    1 KiB reads through a default buffered file
+    '''
+    with io.BufferedReader(SlowFile(path, latency)) as f:
+        while True:
+            data = f.read(LEGACY_HASH_READ)
+            if not data:
+                break
+            digest.update(data)
+
+def bench_hash(tracks, latency):
+    '''
+    Hash :tracks: in full by 1 KiB reads and with each buffer size, with
+    :latency: seconds added to each read call
+    '''
+    nbytes = sum(os.path.getsize(x) for x in tracks)
+    label = ', %g ms/read' % (latency * 1e3) if latency else ''
+    digests = set()
+
+    start = time.perf_counter()
+    digest = hashlib.md5()
+    for path in tracks:
+        legacy_hash(path, digest, latency)
+    report('md5, 1 KiB reads' + label, time.perf_counter() - start, nbytes)
+    digests.add(digest.hexdigest())
+
+    for size in HASH_BUFFER_SIZES:
+        # pages are kept, runs read from the page cache alike
+        with scratch_cache():
+            books = Books({'HASH_BUFFER_SIZE': size, 'HASH_DROP_CACHE': False})
+        books._open = lambda path, *args: SlowFile(path, latency)
+        start = time.perf_counter()
+        digest = hashlib.md5()
+        for path in tracks:
+            books._hash_file(path, (digest,))
+        report('md5, %d KiB buffer%s' % (size // 1024, label),
+               time.perf_counter() - start, nbytes)
+        digests.add(digest.hexdigest())
+    assert len(digests) == 1, 'digests differ between read sizes'
+
+def make_tagged_track(path, track, cover):
+    '''
+    Write TAG_SECONDS long MP3 to :path:, tagged with an APIC frame of :cover:
+    bytes ahead of its text frames
+    '''
+    payload = b'\x00image/jpeg\x00\x03\x00' + b'\xff\xd8\xff' + bytes(cover - 3)
+    frames = (b'APIC' + len(payload).to_bytes(4, 'big') + b'\x00\x00' + payload +
+              id3_frame('TIT2', 'Chapter %d' % track) +
+              id3_frame('TPE1', 'Author') + id3_frame('TALB', 'Book') +
+              id3_frame('TRCK', str(track)))
+    size = bytes((len(frames) >> x) & 0x7f for x in (21, 14, 7, 0))
+    frame = FRAME_HEADER + bytes(FRAME_LENGTH - len(FRAME_HEADER))
+    with open(path, 'wb') as f:
+        f.write(b'ID3\x03\x00\x00' + size + frames)
+        f.write(frame * int(TAG_SECONDS * FRAMES_PER_SECOND))
+
+def bench_tags(cover):
+    '''
+    Parse tags and duration of TAG_TRACKS tracks with a :cover: bytes cover
+    in each mode, counting reads; checks modes agree on Roka's fields
+    '''
+    modes = (('tags, all + cover', {'image': True}),
+             ('tags, all fields', {}),
+             ('tags, roka fields', {'fields': TAG_FIELDS}))
+    path = tempfile.mkdtemp(prefix='roka-bench-tags-')
+    try:
+        tracks = [os.path.join(path, '%02d.mp3' % (x + 1))
+                  for x in range(TAG_TRACKS)]
+        for i, track in enumerate(tracks):
+            make_tagged_track(track, i + 1, cover)
+
+        found = set()
+        for name, kwargs in modes:
+            counts = {'bytes': 0, 'calls': 0}
+            start = time.perf_counter()
+            tags = [TinyTag.get(x, file_obj=io.BufferedReader(
+                        CountingFile(x, counts)), **kwargs) for x in tracks]
+            elapsed = time.perf_counter() - start
+            found.add(tuple((x.album, x.artist, x.title, x.track, x.duration)
+                            for x in tags))
+            print('%-32s %8.1f KiB/track %6.1f reads/track %6.2f ms/track' % (
+                name, counts['bytes'] / 1024 / len(tracks),
+                counts['calls'] / len(tracks), elapsed * 1e3 / len(tracks)))
+        assert len(found) == 1, 'fields differ between modes'
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def make_vbr_track(path, seconds):
+    '''
+    Write MP3 of :seconds: to :path: cycling through VBR_BITRATES per frame,
+    without a xing header
+    '''
+    frames = []
+    for byte, bitrate in VBR_BITRATES:
+        header = FRAME_HEADER[:2] + bytes((byte,)) + FRAME_HEADER[3:]
+        frames.append(header + bytes(144000 * bitrate // 44100 - len(header)))
+    with open(path, 'wb') as f:
+        f.write(b''.join(frames) * int(seconds * FRAMES_PER_SECOND /
+                                       len(frames)))
+
+def bench_walk(tracks):
+    '''
+    Parse duration of :tracks: and of VBR tracks by both frame walkers,
+    estimated and exact, checking they agree
+    '''
+    path = tempfile.mkdtemp(prefix='roka-bench-walk-')
+    try:
+        vbr = [os.path.join(path, '%02d.mp3' % (x + 1))
+               for x in range(VBR_TRACKS)]
+        for track in vbr:
+            make_vbr_track(track, VBR_SECONDS)
+        _walk_tracks('cbr', tracks)
+        _walk_tracks('vbr', vbr)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def _walk_tracks(kind, tracks):
+    '''
+    Report duration parsing of :kind: :tracks: by both walkers, see bench_walk
+    '''
+    for exact in (False, True):
+        found = set()
+        for name, parser in (('legacy', LegacyID3), ('blocks', ID3)):
+            counts = {'bytes': 0, 'calls': 0}
+            start = time.perf_counter()
+            tags = [parser.get(x, tags=False, exact_duration=exact,
+                               file_obj=io.BufferedReader(
+                                   CountingFile(x, counts)))
+                    for x in tracks]
+            elapsed = time.perf_counter() - start
+            found.add(tuple((x.duration, x.audio_offset) for x in tags))
+            label = 'walk, %s, %s, %s' % (kind, 'exact' if exact else 'estimate',
+                                          name)
+            print('%-32s %8.3fs %10.0f /s %8.1f reads/track' % (
+                label, elapsed, len(tracks) / max(elapsed, 1e-9),
+                counts['calls'] / len(tracks)))
+        assert len(found) == 1, 'walkers found different durations'
+
+def vorbis_comment(tags):
+    '''
+    Return vorbis comment block of :tags: (list of (key, value))
+    '''
+    ret = struct.pack('<I', 4) + b'roka' + struct.pack('<I', len(tags))
+    for k, v in tags:
+        kv = ('%s=%s' % (k, v)).encode()
+        ret += struct.pack('<I', len(kv)) + kv
+
+    return ret
+
+def make_wav(path, seconds):
+    '''
+    Write 16 bit stereo WAV of :seconds: of silence with an INFO chunk
+    '''
+    info = b''
+    for k, v in ((b'INAM', b'Chapter 1\x00'), (b'IART', b'Author\x00'),
+                 (b'ICMT', b'c' * 4000 + b'\x00')):
+        info += k + struct.pack('<I', len(v)) + v
+    data = bytes(44100 * 4 * seconds)
+    body = (b'WAVE' +
+            b'fmt ' + struct.pack('<IHHIIHH', 16, 1, 2, 44100, 44100 * 4, 4, 16) +
+            b'LIST' + struct.pack('<I', len(info) + 4) + b'INFO' + info +
+            b'data' + struct.pack('<I', len(data)) + data)
+    with open(path, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', len(body)) + body)
+
+def make_flac(path, seconds):
+    '''
+    Write FLAC of :seconds: with a vorbis comment, its audio left empty
+    '''
+    info = struct.pack('>HH', 4096, 4096) + b'\x00\x00\x10\x00\x20\x00'
+    info += ((44100 << 44) | (1 << 41) | (15 << 36) |
+             44100 * seconds).to_bytes(8, 'big') + bytes(16)
+    comment = vorbis_comment(FORMAT_TAGS)
+    with open(path, 'wb') as f:
+        f.write(b'fLaC' + b'\x00' + len(info).to_bytes(3, 'big') + info +
+                b'\x84' + len(comment).to_bytes(3, 'big') + comment +
+                b'\xff\xf8' + bytes(200000))
+
+def ogg_page(data, granule, seq, flags=0):
+    '''
+    Return Ogg page :seq: holding packet :data:
+    '''
+    segments = [255] * (len(data) // 255) + [len(data) % 255]
+    return struct.pack('<4sBBqIIiB', b'OggS', 0, flags, granule, 1, seq, 0,
+                       len(segments)) + bytes(segments) + data
+
+def make_opus(path, seconds):
+    '''
+    Write Ogg Opus of :seconds: with tags, its packets left empty
+    '''
+    pages = [ogg_page(b'OpusHead' + struct.pack('<BBHIHB', 1, 2, 312, 48000,
+                                                0, 0), 0, 0, 2),
+             ogg_page(b'OpusTags' + vorbis_comment(FORMAT_TAGS), 0, 1)]
+    for i in range(200):
+        pages.append(ogg_page(bytes(750), 48000 * seconds * (i + 1) // 200,
+                              i + 2))
+    with open(path, 'wb') as f:
+        f.write(b''.join(pages))
+
+def atom(name, body):
+    return struct.pack('>I', len(body) + 8) + name + body
+
+def make_m4b(path, seconds):
+    '''
+    Write M4B of :seconds: with iTunes tags, its media data left empty
+    '''
+    def text(name, value):
+        return atom(name, atom(b'data', struct.pack('>II', 1, 0) +
+                               value.encode()))
+
+    mvhd = atom(b'mvhd', struct.pack('>B3xIIII', 0, 0, 0, 1000,
+                                     1000 * seconds) + bytes(80))
+    ilst = atom(b'ilst', text(b'\xa9nam', 'Chapter 1') +
+                text(b'\xa9ART', 'Author') + text(b'\xa9alb', 'Book') +
+                atom(b'trkn', atom(b'data', struct.pack('>IIHHHH', 0, 0, 0, 3,
+                                                        10, 0))))
+    meta = atom(b'meta', bytes(4) + atom(b'hdlr', bytes(25)) + ilst)
+    with open(path, 'wb') as f:
+        f.write(atom(b'ftyp', b'M4B ' + bytes(4)) + atom(b'mdat', bytes(300000)) +
+                atom(b'moov', mvhd + atom(b'udta', meta)))
+
+def bench_parsers(tracks):
+    '''
+    Parse FORMAT_FILES files per format (library :tracks: for MP3) through a
+    file handle and through mmap, checking both modes agree
+    '''
+    path = tempfile.mkdtemp(prefix='roka-bench-formats-')
+    try:
+        files = {'mp3': tracks[:FORMAT_FILES]}
+        for ext, make in (('flac', make_flac), ('opus', make_opus),
+                          ('wav', make_wav), ('m4b', make_m4b)):
+            files[ext] = [os.path.join(path, '%02d.%s' % (x, ext))
+                          for x in range(FORMAT_FILES)]
+            for i, name in enumerate(files[ext]):
+                make(name, 20 + i)
+
+        for ext, names in files.items():
+            found = set()
+            for use_mmap in (False, True):
+                best = None
+                for _ in range(FORMAT_RUNS):
+                    start = time.perf_counter()
+                    tags = [TinyTag.get(x, use_mmap=use_mmap) for x in names]
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                found.add(tuple(sorted(str(x.as_dict()) for x in tags)))
+                print('%-32s %8.3f ms/file' % (
+                    'parse, %s%s' % (ext, ', mmap' if use_mmap else ''),
+                    best * 1e3 / len(names)))
+            assert len(found) == 1, '%s tags differ with mmap' % ext
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def bench_ranges(library, requests, size, cache_size, threads):
+    '''
+    Serve :requests: random Range requests of :size: bytes of tracks of
+    :library: through the track route, without and with a file cache of
+    :cache_size: files, from 1 and :threads: threads; every 100th response
+    is checked against the track
+    '''
+    with scratch_cache():
+        books = Books()
+        with contextlib.redirect_stdout(io.StringIO()):
+            books.scan_books(library)
+            books.write_cache()
+        tracks = []
+        for b_key in books.books:
+            for f_key, track in roka.read_book(books_module.JSON_PATH,
+                                               b_key)['files'].items():
+                tracks.append(('/?a=%s&f=%s' % (b_key, f_key), track['path'],
+                               track['size_bytes']))
+
+        json_path = roka.json_path
+        roka.json_path = books_module.JSON_PATH
+        try:
+            for fds in (0, cache_size):
+                for n in (1, threads):
+                    roka.app.config['FILE_CACHE_SIZE'] = fds
+                    roka.app.extensions.pop('file_cache', None)
+                    elapsed = _serve_ranges(tracks, requests, size, n)
+                    report('ranges, file cache %d, %d threads' % (fds, n),
+                           elapsed, requests * size, requests)
+        finally:
+            roka.json_path = json_path
+
+def _serve_ranges(tracks, requests, size, threads):
+    '''
+    Return seconds taken by :threads: test clients sending :requests: Range
+    requests in total, see bench_ranges
+    '''
+    errors = []
+
+    def work(i):
+        rnd = random.Random(i)
+        client = roka.app.test_client()
+        for j in range(requests // threads):
+            url, path, length = rnd.choice(tracks)
+            offset = rnd.randrange(max(length - size, 1))
+            rv = client.get(url, headers={
+                'Range': 'bytes=%d-%d' % (offset, offset + size - 1)})
+            if rv.status_code != 206:
+                errors.append(rv.status_code)
+            elif not j % 100:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    if f.read(size) != rv.data:
+                        errors.append('body')
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=work, args=(x,)) for x in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    assert not errors, 'range requests failed: %s' % errors[:5]
+
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    desc = 'roka micro-benchmarks of scanning and serving'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('benchmarks', nargs='*',
+                        help='benchmarks to run (%s), all by default' %
+                        ', '.join(BENCHMARKS))
+    parser.add_argument('--library', type=str,
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'roka-bench-library'),
+                        help='synthetic library path, generated if missing')
+    parser.add_argument('--books', type=int, default=4)
+    parser.add_argument('--tracks', type=int, default=10,
+                        help='tracks per book')
+    parser.add_argument('--seconds', type=float, default=300,
+                        help='length of each track')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds added to each read call by a '
+                        'second, slow disk run of the hash benchmark')
+    parser.add_argument('--cover', type=int, default=2 * 1024 * 1024,
+                        help='cover size of the tags benchmark tracks')
+    parser.add_argument('--requests', type=int, default=4000,
+                        help='Range requests of the ranges benchmark')
+    parser.add_argument('--range-size', type=int, default=64 * 1024,
+                        help='bytes per Range request')
+    parser.add_argument('--file-cache', type=int, default=64,
+                        help='files kept open by the cached ranges runs')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='concurrent clients of the ranges benchmark')
+    args = parser.parse_args()
+    benchmarks = args.benchmarks or BENCHMARKS
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %s' % name)
+
+    make_library(args.library, args.books, args.tracks, args.seconds)
+    tracks = sorted(glob.glob(os.path.join(args.library, '*', '*', '*.mp3')))
+
+    if 'scan' in benchmarks:
+        bench_scan(args.library, tracks)
+    if 'hash' in benchmarks:
+        bench_hash(tracks, 0)
+        if args.latency:
+            bench_hash(tracks, args.latency / 1e3)
+    if 'tags' in benchmarks:
+        bench_tags(args.cover)
+    if 'walk' in benchmarks:
+        bench_walk(tracks)
+    if 'parsers' in benchmarks:
+        bench_parsers(tracks)
+    if 'ranges' in benchmarks:
+        bench_ranges(args.library, args.requests, args.range_size,
+                     args.file_cache, args.threads)
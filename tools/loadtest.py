@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+
+'''
+Load test of a Roka server with podcast-client traffic: book listing hits,
+feed polls with conditional headers and chunked Range downloads of tracks,
+or replay of a recorded JSONL request log
+
+By default a synthetic library is generated and served from a temporary copy
+of Roka (its cache is kept apart from the real one), using the Flask dev
+server or uwsgi; --url targets a running server instead.
+
+    tools/loadtest.py --server dev --clients 16 --duration 30
+    tools/loadtest.py --server uwsgi --processes 4 --threads 8
+    tools/loadtest.py --url http://127.0.0.1:8085/ --replay requests.jsonl
+
+Replayed logs have one JSON object per line: path (with query), optional
+method, headers and t (seconds since the start of the log); requests are sent
+at their recorded offsets, scaled by --speed, or as fast as clients allow if
+t is missing.
+'''
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import random
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+
+ROKA_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# files copied to the temporary server directory
+ROKA_FILES = ('roka.py', 'lib', 'templates')
+
+# MPEG-1 layer III, 128 kbit/s, 44.1 kHz frame: header and length in bytes
+FRAME_HEADER = b'\xff\xfb\x90\x00'
+FRAME_LENGTH = 417
+FRAMES_PER_SECOND = 44100 / 1152
+
+# seconds to wait for a started server to answer
+SERVER_TIMEOUT = 30
+
+def id3_frame(frame_id, text):
+    '''
+    Return ID3v2.3 text frame :frame_id: holding latin-1 :text:
+    '''
+    payload = b'\x00' + text.encode('latin-1')
+    return frame_id.encode() + struct.pack('>I', len(payload)) + b'\x00\x00' + payload
+
+def make_track(path, title, author, album, track, seconds):
+    '''
+    Write CBR MP3 of :seconds: of random frames with ID3v2 tags to :path:
+    '''
+    frames = b''.join((id3_frame('TIT2', title), id3_frame('TPE1', author),
+                       id3_frame('TALB', album), id3_frame('TRCK', str(track))))
+    size = bytes((len(frames) >> x) & 0x7f for x in (21, 14, 7, 0))
+    with open(path, 'wb') as f:
+        f.write(b'ID3\x03\x00\x00' + size + frames)
+        for _ in range(int(seconds * FRAMES_PER_SECOND)):
+            f.write(FRAME_HEADER + os.urandom(FRAME_LENGTH - len(FRAME_HEADER)))
+
+def make_library(path, books, tracks, seconds):
+    '''
+    Generate library of :books: books of :tracks: tracks at :path:, unless
+    already present
+    '''
+    for b in range(books):
+        book_path = os.path.join(path, 'Author %d' % b, 'Book %d' % b)
+        if os.path.isdir(book_path):
+            continue
+        os.makedirs(book_path)
+        for t in range(tracks):
+            make_track(os.path.join(book_path, '%02d.mp3' % (t + 1)),
+                       'Chapter %d' % (t + 1), 'Author %d' % b, 'Book %d' % b,
+                       t + 1, seconds)
+
+class Server:
+    def __init__(self, kind, library, port, config, processes, threads):
+        '''
+        Roka serving :library: from a temporary copy, with the Flask dev
+        server or uwsgi (:kind:) on :port: (the dev server always uses 8085)
+
+        :config: extra app.cfg key/values, e.g. FILE_CACHE_SIZE
+        '''
+        self.kind = kind
+        self.port = 8085 if kind == 'dev' else port
+        self.url = 'http://127.0.0.1:%d/' % self.port
+        self._processes = processes
+        self._threads = threads
+        self._proc = None
+
+        self._path = tempfile.mkdtemp(prefix='roka-loadtest-')
+        for name in ROKA_FILES:
+            src = os.path.join(ROKA_PATH, name)
+            dst = os.path.join(self._path, name)
+            if os.path.isdir(src):
+                shutil.copytree(src, dst, ignore=shutil.ignore_patterns(
+                    '__pycache__'))
+            else:
+                shutil.copy(src, dst)
+
+        cfg = dict(ROOT_PATH=os.path.abspath(library), BASE_URL=self.url,
+                   USERNAME='loadtest', PASSWORD='loadtest', **config)
+        with open(os.path.join(self._path, 'app.cfg'), 'w') as f:
+            for k, v in cfg.items():
+                f.write('%s = %r\n' % (k, v))
+
+    def start(self):
+        '''
+        Scan library and start server, returning once it answers
+        '''
+        subprocess.run([sys.executable, 'roka.py', '--scan'], cwd=self._path,
+                       stdout=subprocess.DEVNULL, check=True)
+        if self.kind == 'dev':
+            cmd = [sys.executable, 'roka.py']
+        else:
+            cmd = ['uwsgi', '--http', '127.0.0.1:%d' % self.port,
+                   '--wsgi-file', 'roka.py', '--callable', 'app', '--master',
+                   '--processes', str(self._processes),
+                   '--threads', str(self._threads), '--disable-logging']
+        self._proc = subprocess.Popen(cmd, cwd=self._path,
+                                      stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.DEVNULL)
+
+        deadline = time.monotonic() + SERVER_TIMEOUT
+        while time.monotonic() < deadline:
+            if self._proc.poll() is not None:
+                raise RuntimeError('%s server exited' % self.kind)
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port,
+                                                  timeout=1)
+                conn.request('GET', '/')
+                conn.getresponse().read()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError('%s server not answering' % self.kind)
+
+    def stop(self):
+        '''
+        Stop server and remove temporary copy
+        '''
+        if self._proc:
+            self._proc.terminate()
+            self._proc.wait()
+        shutil.rmtree(self._path, ignore_errors=True)
+
+class Stats:
+    def __init__(self):
+        '''
+        Latencies, bytes and errors of requests by kind
+        '''
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(list)
+        self._bytes = defaultdict(int)
+        self._errors = defaultdict(int)
+        self._statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, kind, latency, nbytes, status):
+        '''
+        Record request of :kind:; :status: is None if it failed to complete
+        '''
+        with self._lock:
+            self._latencies[kind].append(latency)
+            self._bytes[kind] += nbytes
+            self._statuses[kind][status or 'error'] += 1
+            if status is None or status >= 400:
+                self._errors[kind] += 1
+
+    def report(self, elapsed):
+        '''
+        Return dict of throughput, latency percentiles (ms) and error rate by
+        kind, and in total, over :elapsed: seconds
+        '''
+        ret = dict()
+        with self._lock:
+            kinds = sorted(self._latencies)
+            everything = [x for k in kinds for x in self._latencies[k]]
+            rows = [(k, self._latencies[k], self._bytes[k], self._errors[k],
+                     dict(self._statuses[k])) for k in kinds]
+            rows.append(('total', everything, sum(self._bytes.values()),
+                         sum(self._errors.values()), None))
+
+        for kind, latencies, nbytes, errors, statuses in rows:
+            latencies = sorted(latencies)
+            n = len(latencies)
+            if not n:
+                continue
+            ret[kind] = {
+                'requests':     n,
+                'rps':          round(n / elapsed, 1),
+                'mb_per_s':     round(nbytes / elapsed / 1e6, 2),
+                'error_rate':   round(errors / n, 4),
+                'p50_ms':       round(latencies[int(0.50 * (n - 1))] * 1e3, 2),
+                'p90_ms':       round(latencies[int(0.90 * (n - 1))] * 1e3, 2),
+                'p99_ms':       round(latencies[int(0.99 * (n - 1))] * 1e3, 2),
+                'max_ms':       round(latencies[-1] * 1e3, 2)
+            }
+            if statuses:
+                ret[kind]['statuses'] = {str(k): v for k, v in statuses.items()}
+
+        return ret
+
+class Client:
+    def __init__(self, url, auth, stats):
+        '''
+        Podcast client keeping a connection to the server at :url:, sending
+        :auth: (user, password) with book listing requests
+        '''
+        parsed = urllib.parse.urlsplit(url)
+        self._base = parsed.path or '/'
+        self._conn = http.client.HTTPConnection(parsed.hostname,
+                                                parsed.port or 80, timeout=30)
+        self.auth = 'Basic ' + base64.b64encode(
+            ('%s:%s' % auth).encode()).decode()
+        self._stats = stats
+        self._validators = dict() # path: (ETag, Last-Modified)
+        self._books = [] # of the last book listing
+
+    def request(self, kind, path, headers=None, method='GET'):
+        '''
+        Send request for :path: and read the response; return (status,
+        headers, body), status is None if the request failed
+        '''
+        start = time.monotonic()
+        try:
+            self._conn.request(method, path, headers=headers or {})
+            rv = self._conn.getresponse()
+            body = rv.read()
+        except (OSError, http.client.HTTPException):
+            self._conn.close()
+            self._stats.record(kind, time.monotonic() - start, 0, None)
+            return (None, {}, b'')
+        self._stats.record(kind, time.monotonic() - start, len(body), rv.status)
+
+        return (rv.status, dict(rv.getheaders()), body)
+
+    def revalidate(self, kind, path, headers=None):
+        '''
+        Send request for :path:, conditional on the validators of its previous
+        response if any; return (status, body), status is 304 if not modified
+        '''
+        headers = dict(headers or {})
+        etag, modified = self._validators.get(path, (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+        status, rv_headers, body = self.request(kind, path, headers)
+        if status == 200:
+            self._validators[path] = (rv_headers.get('ETag'),
+                                      rv_headers.get('Last-Modified'))
+
+        return (status, body)
+
+    def index(self):
+        '''
+        Fetch book listing as browsers do, revalidating the previous response;
+        return list of book hashes in it
+        '''
+        status, body = self.revalidate('index', self._base,
+                                       {'Authorization': self.auth})
+        if status == 200:
+            self._books = re.findall(r'\?a=([0-9a-f]+)',
+                                     body.decode('utf-8', 'replace'))
+
+        return self._books
+
+    def feed(self, book):
+        '''
+        Poll feed of :book: as podcast apps do, revalidating the previous
+        response; return list of (path, length) of its enclosures, empty if
+        not modified
+        '''
+        path = '%s?a=%s' % (self._base, book)
+        status, body = self.revalidate('feed', path)
+        if status != 200:
+            return []
+
+        ret = []
+        for attrs in re.findall(r'<enclosure ([^>]*)>', body.decode()):
+            attrs = dict(re.findall(r'(\w+)="([^"]*)"', attrs))
+            query = urllib.parse.urlsplit(attrs['url'].replace('&amp;', '&')).query
+            ret.append((self._base + '?' + query, int(attrs['length'])))
+
+        return ret
+
+    def download(self, path, length, chunk, chunks, rnd):
+        '''
+        Download up to :chunks: consecutive Range requests of :chunk: bytes of
+        track at :path: of :length: bytes, from the start or a resume point
+        picked by :rnd: (random.Random)
+        '''
+        offset = rnd.choice((0, rnd.randrange(0, max(length, 1))))
+        for _ in range(chunks):
+            if offset >= length:
+                break
+            rng = 'bytes=%d-%d' % (offset, offset + chunk - 1)
+            status, _, body = self.request('download', path, {'Range': rng})
+            if status != 206:
+                break
+            offset += chunk
+
+    def close(self):
+        self._conn.close()
+
+def run_mix(url, auth, clients, duration, weights, chunk, chunks, seed=0):
+    '''
+    Run :clients: threads issuing the weighted mix of index hits, feed polls
+    and downloads for :duration: seconds, each client's choices drawn from
+    :seed:; return (Stats, elapsed seconds)
+    '''
+    stats = Stats()
+    # discover books and tracks once, not counted
+    probe = Client(url, auth, Stats())
+    books = probe.index()
+    tracks = {b: probe.feed(b) for b in books}
+    probe.close()
+    if not books:
+        raise RuntimeError('no books listed at %s' % url)
+
+    kinds = list(weights)
+    deadline = time.monotonic() + duration
+
+    def work(i):
+        rnd = random.Random('%s/%d' % (seed, i))
+        client = Client(url, auth, stats)
+        while time.monotonic() < deadline:
+            kind = rnd.choices(kinds, [weights[x] for x in kinds])[0]
+            book = rnd.choice(books)
+            if kind == 'index':
+                client.index()
+            elif kind == 'feed':
+                client.feed(book)
+            elif tracks[book]:
+                client.download(*rnd.choice(tracks[book]), chunk, chunks, rnd)
+        client.close()
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return (stats, time.monotonic() - start)
+
+def classify(path):
+    '''
+    Return request kind of :path: as logged by Roka's routes
+    '''
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+    if 'a' in query and 'f' in query:
+        return 'download'
+    if 'a' in query:
+        return 'feed'
+    if path.split('?')[0].rstrip('/').endswith('stats'):
+        return 'stats'
+    if '/covers/' in path:
+        return 'cover'
+
+    return 'index'
+
+def run_replay(url, auth, clients, log_path, speed):
+    '''
+    Replay requests of JSONL :log_path: with :clients: threads, at recorded
+    offsets scaled by :speed:; return (Stats, elapsed seconds)
+
+    Entries are timed by offset in seconds ('t') or, as in Roka's ACCESS_LOG,
+    by epoch timestamp ('ts') relative to the first entry
+    '''
+    with open(log_path, 'r') as f:
+        entries = [json.loads(x) for x in f if x.strip()]
+    first = min((x['ts'] for x in entries if 'ts' in x), default=0)
+    for entry in entries:
+        if 't' not in entry:
+            entry['t'] = entry.get('ts', first) - first
+    entries.sort(key=lambda x: x['t'])
+
+    stats = Stats()
+    lock = threading.Lock()
+    pending = iter(entries)
+    start = time.monotonic()
+
+    def work():
+        client = Client(url, auth, stats)
+        while True:
+            with lock:
+                entry = next(pending, None)
+            if entry is None:
+                break
+            delay = start + entry['t'] / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            headers = dict(entry.get('headers') or {})
+            kind = classify(entry['path'])
+            if kind in ('index', 'stats'):
+                headers.setdefault('Authorization', client.auth)
+            client.request(kind, entry['path'], headers,
+                           entry.get('method', 'GET'))
+        client.close()
+
+    threads = [threading.Thread(target=work) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return (stats, time.monotonic() - start)
+
+def print_report(report, label):
+    '''
+    Print :report: (see Stats.report) as a table
+    '''
+    print(label)
+    cols = ('requests', 'rps', 'mb_per_s', 'error_rate', 'p50_ms', 'p90_ms',
+            'p99_ms', 'max_ms')
+    print('%-10s' % 'kind' + ''.join('%12s' % x for x in cols))
+    for kind, row in report.items():
+        print('%-10s' % kind + ''.join('%12s' % row[x] for x in cols))
+
+def parse_mix(s):
+    '''
+    Return dict of kind: weight from 'index=1,feed=6,download=3'
+    '''
+    ret = dict()
+    for part in s.split(','):
+        kind, weight = part.split('=')
+        if kind not in ('index', 'feed', 'download'):
+            raise argparse.ArgumentTypeError('unknown request kind %s' % kind)
+        ret[kind] = float(weight)
+
+    return ret
+
+if __name__ == '__main__':
+    desc = 'roka load test: podcast-client traffic or request log replay'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--server', choices=('dev', 'uwsgi'), default='dev',
+                        help='server started on a synthetic library')
+    parser.add_argument('--url', type=str,
+                        help='test running server at URL instead')
+    parser.add_argument('--auth', type=str, default='loadtest:loadtest',
+                        help='user:password of the book listing')
+    parser.add_argument('--library', type=str,
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'roka-loadtest-library'),
+                        help='synthetic library path, generated if missing')
+    parser.add_argument('--books', type=int, default=20)
+    parser.add_argument('--tracks', type=int, default=10,
+                        help='tracks per book')
+    parser.add_argument('--seconds', type=float, default=120,
+                        help='length of each track')
+    parser.add_argument('--config', type=str, default='{}',
+                        help='JSON of extra app.cfg values of the server')
+    parser.add_argument('--port', type=int, default=8086,
+                        help='uwsgi port')
+    parser.add_argument('--processes', type=int, default=2,
+                        help='uwsgi processes')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='uwsgi threads per process')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds of mixed traffic')
+    parser.add_argument('--mix', type=parse_mix,
+                        default='index=1,feed=6,download=3',
+                        help='relative weights of request kinds')
+    parser.add_argument('--chunk', type=int, default=256 * 1024,
+                        help='bytes per Range request of downloads')
+    parser.add_argument('--chunks', type=int, default=8,
+                        help='Range requests per download')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the clients\' request choices')
+    parser.add_argument('--replay', type=str,
+                        help='JSONL request log to replay instead of the mix')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed-up factor')
+    parser.add_argument('--json', action='store_true',
+                        help='print report as JSON')
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if not url:
+        make_library(args.library, args.books, args.tracks, args.seconds)
+        server = Server(args.server, args.library, args.port,
+                        json.loads(args.config), args.processes, args.threads)
+        server.start()
+        url = server.url
+
+    try:
+        auth = tuple(args.auth.split(':', 1))
+        if args.replay:
+            stats, elapsed = run_replay(url, auth, args.clients, args.replay,
+                                        args.speed)
+        else:
+            stats, elapsed = run_mix(url, auth, args.clients, args.duration,
+                                     args.mix, args.chunk, args.chunks,
+                                     args.seed)
+    finally:
+        if server:
+            server.stop()
+
+    report = stats.report(elapsed)
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        label = '%s, %d clients, %.1fs' % (
+            args.server if server else url, args.clients, elapsed)
+        print_report(report, label)